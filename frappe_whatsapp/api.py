@@ -1,13 +1,12 @@
 import frappe
 from frappe.utils import get_datetime
-from frappe.integrations.utils import make_post_request
 import json
 from crm.api.whatsapp import get_lead_or_deal_from_number
 from frappe.utils.background_jobs import enqueue
 import time
 import json
 import re
-from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.whatsapp_message import send_message_with_delay, send_image as _send_image, create_crm_lead_assignment, create_crm_tagging_assignment, send_interactive_cta_message_with_delay
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.whatsapp_message import send_message as _send_message, send_image as _send_image, create_crm_lead_assignment, create_crm_tagging_assignment, send_interactive_cta_message, get_whatsapp_credentials, post_json
 
 @frappe.whitelist()
 def enqueue_send_whatsapp_template(whatsapp_message_template, whatsapp_template_queues):
@@ -21,13 +20,28 @@ def enqueue_send_whatsapp_template(whatsapp_message_template, whatsapp_template_
 
 def schedule_send_whatsapp_template(whatsapp_message_template, whatsapp_template_queues):
     whatsapp_message_template_doc = frappe.get_doc("WhatsApp Message Templates", whatsapp_message_template)
-    settings = frappe.get_single("WhatsApp Settings")
-    token = settings.get_password("token")
+    settings = get_whatsapp_credentials()
 
     headers = {
-        "authorization": f"Bearer {token}",
+        "authorization": f"Bearer {settings.token}",
         "content-type": "application/json",
     }
+    url = f"{settings.url}/{settings.version}/{settings.phone_id}/messages"
+
+    # the header is the same for every recipient, only the body parameters vary
+    header_components = []
+    if whatsapp_message_template_doc.header_image:
+        header_components.append({
+            "type": "header",
+            "parameters": [
+                {
+                    "type": "image",
+                    "image": {
+                        "link": "https://crm.techmind.com.my{0}".format(whatsapp_message_template_doc.header_image)
+                    }
+                }
+            ]
+        })
 
     for whatsapp_template_queue in whatsapp_template_queues:
         parameters = [{
@@ -59,20 +73,7 @@ def schedule_send_whatsapp_template(whatsapp_message_template, whatsapp_template
                     "type": "body",
                     "parameters": parameters
                 }
-            ]
-
-            if whatsapp_message_template_doc.header_image:
-                components.append({
-                    "type": "header",
-                    "parameters": [
-                        {
-                            "type": "image",
-                            "image": {
-                                "link": "https://crm.techmind.com.my{0}".format(whatsapp_message_template_doc.header_image)
-                            }
-                        }
-                    ]
-                })
+            ] + header_components
 
             data = {
                 "messaging_product": "whatsapp",
@@ -84,11 +85,7 @@ def schedule_send_whatsapp_template(whatsapp_message_template, whatsapp_template
                     "components": components,
                 },
             }
-            response = make_post_request(
-                f"{settings.url}/{settings.version}/{settings.phone_id}/messages",
-                headers=headers,
-                data=json.dumps(data),
-            )
+            response = post_json(url, headers=headers, data=data)
             message_id = response["messages"][0]["id"]
             doc = frappe.new_doc("WhatsApp Message")
             doc.update(
@@ -138,7 +135,7 @@ def send_message(mobile_no, message):
         else:
             crm_lead_doc = frappe.get_doc(doctype, reference_name)
 
-        enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=mobile_no, text=message, queue="short", is_async=True)
+        enqueue(method=_send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=mobile_no, text=message, queue="short", is_async=True, enqueue_after_commit=True)
 
         frappe.response["success"] = True
         frappe.response["message"] = "Message successfully sent."
@@ -167,7 +164,7 @@ def send_cta_message(mobile_no, message, cta_label, cta_url):
         else:
             crm_lead_doc = frappe.get_doc(doctype, reference_name)
 
-        enqueue(method=send_interactive_cta_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=mobile_no, text=message, cta_label=cta_label, cta_url=cta_url, queue="short", is_async=True)
+        enqueue(method=send_interactive_cta_message, crm_lead_doc=crm_lead_doc, whatsapp_id=mobile_no, text=message, cta_label=cta_label, cta_url=cta_url, queue="short", is_async=True, enqueue_after_commit=True)
 
         frappe.response["success"] = True
         frappe.response["message"] = "Message successfully sent."
@@ -1,9 +1,18 @@
 # Copyright (c) 2025, Shridhar Patil and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 
 class CRMLeadAssignment(Document):
 	pass
+
+
+def on_doctype_update():
+	# assignments are looked up per lead and template on every reply; also serves crm_lead-only
+	# filters, so crm_lead carries no search_index of its own
+	frappe.db.add_index("CRM Lead Assignment", ["crm_lead", "whatsapp_message_templates"])
+	# open assignments are scanned by status and template for chat closing reminders; crm_lead makes it covering,
+	# and it replaces the single-column status index
+	frappe.db.add_index("CRM Lead Assignment", ["status", "whatsapp_message_templates", "crm_lead"])
@@ -1,9 +1,14 @@
 # Copyright (c) 2025, Shridhar Patil and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 
 class CRMLeadTagging(Document):
 	pass
+
+
+def on_doctype_update():
+	# taggings are looked up per lead by tagging and status on every inbound message
+	frappe.db.add_index("CRM Lead Tagging", ["crm_lead", "tagging", "status"])
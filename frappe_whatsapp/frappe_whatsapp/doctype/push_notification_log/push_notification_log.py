@@ -9,10 +9,18 @@ import json
 
 class PushNotificationLog(Document):
     def after_insert(self):
+        # create_push_notifications sends its batch from one send_push_notifications job
+        if self.flags.skip_send:
+            return
         enqueue(method=send_push_notification, doc=self, is_async=True)
 
 def send_push_notification(doc):
-    push_notification_subscription = frappe.get_doc("Push Notification Subscription", doc.push_notification_subscription)
+    if deliver_push_notification(doc):
+        doc.sent = True
+        doc.save(ignore_permissions=True)
+
+def deliver_push_notification(doc):
+    push_notification_subscription = frappe.get_cached_doc("Push Notification Subscription", doc.push_notification_subscription)
 
     options = {
         "body": doc.message,
@@ -20,7 +28,7 @@ def send_push_notification(doc):
         "id": doc.name
     }
 
-    result = trigger_push_notification(
+    return trigger_push_notification(
         push_notification_subscription.endpoint,
         push_notification_subscription.p256dh,
         push_notification_subscription.auth,
@@ -28,9 +36,37 @@ def send_push_notification(doc):
         options
     )
 
-    if result:
-        doc.sent = True
-        doc.save(ignore_permissions=True)
+def create_push_notifications(user, title, message, url=None, push_notification_subscriptions=None):
+    """Log a notification for every subscription of user and send them all from one job.
+
+    Pass push_notification_subscriptions when already fetched for several users to skip the lookup.
+    """
+    if push_notification_subscriptions is None:
+        push_notification_subscriptions = frappe.db.get_all("Push Notification Subscription", filters={"user": user}, pluck="name")
+    if not push_notification_subscriptions:
+        return
+
+    names = []
+    for push_notification_subscription in push_notification_subscriptions:
+        push_notification = frappe.get_doc({
+            "doctype": "Push Notification Log",
+            "push_notification_subscription": push_notification_subscription,
+            "title": title,
+            "message": message,
+            "url": url
+        })
+        push_notification.flags.skip_send = True
+        push_notification.insert(ignore_permissions=True)
+        names.append(push_notification.name)
+    enqueue(method=send_push_notifications, names=names, is_async=True, enqueue_after_commit=True)
+
+def send_push_notifications(names):
+    for name in names:
+        # one bad subscription must not stop the rest of the batch or lose the sent flags
+        try:
+            send_push_notification(frappe.get_doc("Push Notification Log", name))
+        except Exception:
+            frappe.log_error(title="Push Notification Failed", message=frappe.get_traceback())
 
 def trigger_push_notification(endpoint, p256dh, auth, title, options):
     try:
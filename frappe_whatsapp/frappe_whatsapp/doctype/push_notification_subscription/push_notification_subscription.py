@@ -21,4 +21,8 @@ class PushNotificationSubscription(Document):
         push_notification.title = title
         push_notification.message = message
         push_notification.url = url
-        push_notification.insert(ignore_permissions=True)
\ No newline at end of file
+        push_notification.insert(ignore_permissions=True)
+
+def on_doctype_update():
+    # subscriptions are looked up by user for every notification
+    frappe.db.add_index("Push Notification Subscription", ["user"])
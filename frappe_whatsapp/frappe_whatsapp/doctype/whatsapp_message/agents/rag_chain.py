@@ -1,5 +1,5 @@
 
-import frappe, requests, json, re, os
+import frappe, requests, json, re, os, logging
 from datetime import datetime, timedelta
 from crm.api.whatsapp import get_whatsapp_messages
 # LangChain imports for AI/RAG functionality
@@ -15,6 +15,69 @@ except ImportError as e:
     print(f"LangChain packages not installed. AI features will be disabled. Error: {str(e)}", "WhatsApp AI Import Error")
 # Cache for RAG chain to avoid recreating on every message
 _rag_chain_cache = None
+# Post-processing patterns for AI answers, compiled once per worker
+MARKDOWN_RES = (
+    re.compile(r'\*\*([^*]+)\*\*'),  # **bold**
+    re.compile(r'\*([^*]+)\*'),  # *bold*
+    re.compile(r'_([^_]+)_'),  # _italic_
+    re.compile(r'~([^~]+)~'),  # ~strikethrough~
+    re.compile(r'`([^`]+)`'),  # `code`
+)
+URL_RE = re.compile(r'https?://[^\s)\]]+')
+EXTRA_BLANK_LINES_RE = re.compile(r'\n\n\n+')
+# Specific details that are likely hallucinated when no map links back them up
+SUSPICIOUS_LINE_RE = re.compile(
+    r'(?P<phone>\b0\d{1,2}[-\s]?\d{3,4}[-\s]?\d{4}\b|\+60\d{1,2}[-\s]?\d{3,4}[-\s]?\d{4}\b)'
+    r'|(?P<price>RM\s*\d+(?:\.\d{2})?\s+for)',
+    re.IGNORECASE
+)
+SUSPICIOUS_PATTERN_NAMES = {'phone': 'Phone number', 'price': 'Specific price'}
+OUTLET_INDICATORS = ('address', 'google map', 'waze', 'outlet', 'location', 'direction')
+# ChatOpenAI clients keyed by their settings, so classifier calls reuse warm HTTP connections
+_chat_llm_cache = {}
+
+def get_chat_llm(openai_key, model, temperature=0, timeout=30, max_retries=2):
+    """
+    Return a cached ChatOpenAI client for the given settings.
+
+    Creating a client per call opens a new connection pool, so every
+    classification paid for a fresh TLS handshake to OpenAI.
+    """
+    key = (openai_key, model, temperature, timeout, max_retries)
+    llm = _chat_llm_cache.get(key)
+    if llm is None:
+        llm = ChatOpenAI(
+            model=model,
+            temperature=temperature,
+            openai_api_key=openai_key,
+            timeout=timeout,
+            max_retries=max_retries
+        )
+        _chat_llm_cache[key] = llm
+    return llm
+
+def log_ai_debug(title, message, *args):
+    """
+    Trace the AI booking flow to the whatsapp_ai log file, or to Error Log when whatsapp_ai_debug is set in site config.
+
+    Like the logging module, message may hold %s placeholders filled from args; dict and
+    list args are JSON-encoded only once the trace is known to be written.
+    """
+    if frappe.conf.get("whatsapp_ai_debug"):
+        frappe.log_error(title, format_ai_debug_message(message, args))
+        return
+
+    logger = frappe.logger("whatsapp_ai", allow_site=True, file_count=5)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(f"{title}: {format_ai_debug_message(message, args)}")
+
+def format_ai_debug_message(message, args):
+    if not args:
+        return message
+    return message % tuple(
+        json.dumps(arg, indent=2, default=str) if isinstance(arg, (dict, list)) else arg
+        for arg in args
+    )
 
 def clear_rag_chain_cache():
     """
@@ -23,7 +86,7 @@ def clear_rag_chain_cache():
     """
     global _rag_chain_cache
     _rag_chain_cache = None
-    frappe.log_error("RAG chain cache cleared", "WhatsApp AI Debug")
+    log_ai_debug("RAG chain cache cleared", "WhatsApp AI Debug")
     return "RAG chain cache cleared successfully"
 
 def detect_yes_no_with_llm(message, context=None):
@@ -54,13 +117,7 @@ def detect_yes_no_with_llm(message, context=None):
             return 'other'
 
         # Create LLM instance with fast model
-        llm = ChatOpenAI(
-            model="gpt-4o-mini",
-            temperature=0,
-            openai_api_key=openai_key,
-            timeout=10,
-            max_retries=1
-        )
+        llm = get_chat_llm(openai_key, model="gpt-4o-mini", temperature=0, timeout=10, max_retries=1)
 
         # Build context-aware prompt
         context_info = ""
@@ -124,7 +181,7 @@ def load_outlet_data():
         with open(outlet_data_path, 'r', encoding='utf-8') as f:
             outlet_data = json.load(f)
 
-        frappe.log_error("Outlet Data Loaded", f"Successfully loaded {len(outlet_data)} outlets from outlet_data.json")
+        log_ai_debug("Outlet Data Loaded", f"Successfully loaded {len(outlet_data)} outlets from outlet_data.json")
         return outlet_data
     except Exception as e:
         frappe.log_error("Outlet Data Load Error", f"Failed to load outlet_data.json: {str(e)}\n{frappe.get_traceback()}")
@@ -149,19 +206,19 @@ def validate_and_correct_outlet_info(ai_response):
     """
     try:
         # Check if response contains outlet-related information
-        outlet_indicators = ['address', 'google map', 'waze', 'outlet', 'location', 'direction']
-        has_outlet_info = any(indicator in ai_response.lower() for indicator in outlet_indicators)
+        response_lower = ai_response.lower()
+        has_outlet_info = any(indicator in response_lower for indicator in OUTLET_INDICATORS)
 
         if not has_outlet_info:
             # No outlet information to validate
             return ai_response
 
-        frappe.log_error("Outlet Validation", "Detected outlet information in response - validating against outlet_data.json")
+        log_ai_debug("Outlet Validation", "Detected outlet information in response - validating against outlet_data.json")
 
         # Load outlet data
         outlets = load_outlet_data()
         if not outlets:
-            frappe.log_error("Outlet Validation", "No outlet data available - returning response as-is")
+            log_ai_debug("Outlet Validation", "No outlet data available - returning response as-is")
             return ai_response
 
         corrected_response = ai_response
@@ -182,17 +239,17 @@ def validate_and_correct_outlet_info(ai_response):
             outlet_name_lower = outlet_name.lower()
 
             # Check if this outlet is mentioned in the response
-            if outlet_name_lower not in corrected_response.lower():
+            if outlet_name_lower not in response_lower:
                 # Try matching by location part (after @)
                 if '@' in outlet_name:
                     location_part = outlet_name.split('@')[1].strip()
-                    if location_part.lower() not in corrected_response.lower():
+                    if location_part.lower() not in response_lower:
                         continue
                 else:
                     continue
 
             # This outlet is mentioned - validate its information
-            frappe.log_error("Outlet Validation", f"Found mention of outlet: {outlet_name}")
+            log_ai_debug("Outlet Validation", f"Found mention of outlet: {outlet_name}")
 
             # Use LLM to extract the address/links associated with this outlet in the response
             from langchain_openai import ChatOpenAI
@@ -232,11 +289,12 @@ OUTPUT: Return the corrected response text only, no explanations."""
             try:
                 validation_result = llm.invoke(validation_prompt)
                 corrected_response = validation_result.content.strip()
+                response_lower = corrected_response.lower()
 
                 # Check if correction was made
                 if corrected_response != ai_response:
                     corrections_made.append(f"Corrected information for: {outlet_name}")
-                    frappe.log_error(
+                    log_ai_debug(
                         "Outlet Info Corrected",
                         f"Fixed outlet information for: {outlet_name}\n"
                         f"Correct Address: {correct_address}\n"
@@ -248,12 +306,12 @@ OUTPUT: Return the corrected response text only, no explanations."""
                 continue
 
         if corrections_made:
-            frappe.log_error(
+            log_ai_debug(
                 "Outlet Validation Complete",
                 f"Made corrections:\n" + "\n".join(corrections_made)
             )
         else:
-            frappe.log_error("Outlet Validation Complete", "No corrections needed - all information is accurate")
+            log_ai_debug("Outlet Validation Complete", "No corrections needed - all information is accurate")
 
         return corrected_response
 
@@ -292,11 +350,11 @@ def search_outlet_data(query):
         if not is_soma_query:
             # Only show HealthLand outlets (filter out SOMA)
             outlets = [o for o in outlets if o.get('Brand', '').lower() != 'soma wellness']
-            frappe.log_error("Outlet Filter", f"Filtered to HealthLand outlets only (user didn't ask for SOMA)")
+            log_ai_debug("Outlet Filter", f"Filtered to HealthLand outlets only (user didn't ask for SOMA)")
         else:
             # User asked for SOMA, only show SOMA outlets
             outlets = [o for o in outlets if o.get('Brand', '').lower() == 'soma wellness']
-            frappe.log_error("Outlet Filter", f"Filtered to SOMA Wellness outlets only (user asked for SOMA)")
+            log_ai_debug("Outlet Filter", f"Filtered to SOMA Wellness outlets only (user asked for SOMA)")
 
         # Extract potential outlet name from query
         # Common patterns: "KD", "Kota Damansara", "Puchong", "KLCC", etc.
@@ -352,7 +410,7 @@ def search_outlet_data(query):
                 result += f"Brand: {outlet.get('Brand', 'N/A')}\n"
                 result += f"Category: {outlet.get('Category', 'N/A')}\n"
 
-            frappe.log_error(
+            log_ai_debug(
                 "Outlet Data Retrieved",
                 f"Found {len(matched_outlets)} matching outlets for query: {query}\n\nResult:\n{result}"
             )
@@ -380,23 +438,12 @@ def clean_message_formatting(text):
     if not text:
         return text
 
-    # Remove bold formatting: *text* or **text**
-    # Match both single and double asterisks
-    text = re.sub(r'\*\*([^*]+)\*\*', r'\1', text)  # Remove **bold**
-    text = re.sub(r'\*([^*]+)\*', r'\1', text)      # Remove *bold*
-
-    # Remove italic formatting: _text_
-    text = re.sub(r'_([^_]+)_', r'\1', text)
-
-    # Remove strikethrough: ~text~
-    text = re.sub(r'~([^~]+)~', r'\1', text)
-
-    # Remove inline code: `text`
-    text = re.sub(r'`([^`]+)`', r'\1', text)
+    # Remove bold (**text**, *text*), italic, strikethrough and inline code formatting, in that order
+    for markdown_re in MARKDOWN_RES:
+        text = markdown_re.sub(r'\1', text)
 
     # Find all URLs in the text
-    url_pattern = r'https?://[^\s)\]]+'
-    urls = re.findall(url_pattern, text)
+    urls = URL_RE.findall(text)
 
     # ANTI-HALLUCINATION: Define whitelist of allowed domains
     # Only URLs from these domains are allowed - everything else is likely hallucinated
@@ -420,7 +467,7 @@ def clean_message_formatting(text):
 
         for line in lines:
             # Check if this line contains a URL
-            line_urls = re.findall(url_pattern, line)
+            line_urls = URL_RE.findall(line)
             has_duplicate = False
             has_hallucinated_url = False
 
@@ -430,7 +477,7 @@ def clean_message_formatting(text):
 
                 if not is_allowed:
                     # This URL is likely hallucinated - log it and mark for removal
-                    frappe.log_error(
+                    log_ai_debug(
                         "Hallucinated URL Detected",
                         f"AI generated a non-whitelisted URL that was removed:\n{url}\n\nFull message:\n{text}"
                     )
@@ -477,7 +524,7 @@ def remove_soma_mentions(text, user_query):
 
     if user_asked_about_soma:
         # User asked about SOMA, keep everything
-        frappe.log_error("SOMA Query", f"User asked about SOMA - keeping SOMA information in response")
+        log_ai_debug("SOMA Query", f"User asked about SOMA - keeping SOMA information in response")
         return text
 
     # User did NOT ask about SOMA - remove all SOMA mentions
@@ -502,10 +549,10 @@ def remove_soma_mentions(text, user_query):
     result = '\n'.join(cleaned_lines)
 
     # Clean up extra blank lines
-    result = re.sub(r'\n\n\n+', '\n\n', result)
+    result = EXTRA_BLANK_LINES_RE.sub('\n\n', result)
 
     if removed_lines:
-        frappe.log_error(
+        log_ai_debug(
             "SOMA Mentions Removed",
             f"User did NOT ask about SOMA - removed {len(removed_lines)} lines:\n" +
             "\n".join(removed_lines) +
@@ -533,8 +580,7 @@ def detect_and_remove_hallucinated_addresses(text):
 
     # Check if the message contains whitelisted URLs (Google Maps, Waze)
     # If it does, the address info is probably from context, so don't remove it
-    url_pattern = r'https?://[^\s)\]]+'
-    urls = re.findall(url_pattern, text)
+    urls = URL_RE.findall(text)
 
     has_maps_or_waze = any(
         'google.com/maps' in url.lower() or
@@ -547,50 +593,37 @@ def detect_and_remove_hallucinated_addresses(text):
 
     # If message has Google Maps or Waze links, it's likely real data from context
     if has_maps_or_waze:
-        frappe.log_error(
+        log_ai_debug(
             "Address Data With Map Links",
             f"Message contains Google Maps/Waze links - assuming real data from context:\n{text}"
         )
         return text  # Don't remove anything, it's probably real
 
     # If no map links, be cautious about specific details that might be hallucinated
-    # Only check for very specific hallucination patterns (not general addresses)
-    suspicious_patterns = [
-        # Only flag specific phone numbers (very precise hallucination indicator)
-        (r'\b0\d{1,2}[-\s]?\d{3,4}[-\s]?\d{4}\b', 'Phone number'),
-        (r'\+60\d{1,2}[-\s]?\d{3,4}[-\s]?\d{4}\b', 'Phone number'),
-        # Only flag specific prices with RM (hallucination indicator)
-        (r'RM\s*\d+(?:\.\d{2})?\s+for', 'Specific price'),
-    ]
-
+    # Only check for very specific hallucination patterns (phone numbers, RM prices), not general addresses
     lines = text.split('\n')
     cleaned_lines = []
     removed_something = False
 
     for line in lines:
-        line_has_hallucination = False
-
-        # Check each pattern
-        for pattern, pattern_name in suspicious_patterns:
-            if re.search(pattern, line, re.IGNORECASE):
-                # Log the detected potential hallucination
-                frappe.log_error(
-                    "Potential Hallucination Detected",
-                    f"Removed line with {pattern_name}:\nLine: {line}\n\nFull message:\n{text}"
-                )
-                line_has_hallucination = True
-                removed_something = True
-                break
+        match = SUSPICIOUS_LINE_RE.search(line)
+        if match:
+            # Log the detected potential hallucination
+            log_ai_debug(
+                "Potential Hallucination Detected",
+                f"Removed line with {SUSPICIOUS_PATTERN_NAMES[match.lastgroup]}:\nLine: {line}\n\nFull message:\n{text}"
+            )
+            removed_something = True
+            continue
 
         # Only keep the line if it doesn't have hallucinated content
-        if not line_has_hallucination:
-            cleaned_lines.append(line)
+        cleaned_lines.append(line)
 
     result = '\n'.join(cleaned_lines)
 
     # If we removed content, log it
     if removed_something:
-        frappe.log_error(
+        log_ai_debug(
             "Hallucination Cleanup",
             f"Removed potentially hallucinated information from AI response.\n\nOriginal:\n{text}\n\nCleaned:\n{result}"
         )
@@ -1049,13 +1082,7 @@ def classify_message_intent_with_llm(message, has_pending_booking=False):
         if not openai_key:
             return _classify_intent_fallback(message)
 
-        llm = ChatOpenAI(
-            model="gpt-4o-mini",
-            temperature=0,
-            openai_api_key=openai_key,
-            timeout=10,
-            max_retries=1
-        )
+        llm = get_chat_llm(openai_key, model="gpt-4o-mini", temperature=0, timeout=10, max_retries=1)
 
         pending_context = ""
         if has_pending_booking:
@@ -1119,7 +1146,7 @@ OUTPUT: Reply with ONLY one word: QUESTION, BOOKING, or OTHER"""
         else:
             intent = 'other'
 
-        frappe.log_error(
+        log_ai_debug(
             "LLM Intent Classification",
             f"Message: {message}\n"
             f"Has pending booking: {has_pending_booking}\n"
@@ -1252,7 +1279,7 @@ def detect_booking_intent_from_recent_context(chat_history, current_message):
     """
     # First check current message with full intent detection
     if has_booking_intent(current_message):
-        frappe.log_error("Booking Intent", f"Intent detected in current message: {current_message}")
+        log_ai_debug("Booking Intent", f"Intent detected in current message: {current_message}")
         return True
 
     # If no chat history, no intent
@@ -1266,10 +1293,10 @@ def detect_booking_intent_from_recent_context(chat_history, current_message):
     for msg in recent_messages:
         message_text = msg.get('message', '') if isinstance(msg, dict) else str(msg)
         if has_booking_intent(message_text):
-            frappe.log_error("Booking Intent", f"Intent detected in recent message: {message_text}")
+            log_ai_debug("Booking Intent", f"Intent detected in recent message: {message_text}")
             return True
 
-    frappe.log_error("Booking Intent", "No booking intent detected in last 3 messages")
+    log_ai_debug("Booking Intent", "No booking intent detected in last 3 messages")
     return False
 
 def is_booking_details_message(message):
@@ -1317,7 +1344,7 @@ def is_booking_details_message(message):
 
         # If message has outlet/location + (date or time or phone), likely booking data
         if has_outlet and (has_date or has_time or has_phone):
-            frappe.log_error(
+            log_ai_debug(
                 "Booking Detection Debug",
                 f"Detected booking data (generic format)\nhas_outlet: {has_outlet}\nhas_date: {has_date}\nhas_time: {has_time}\nhas_phone: {has_phone}"
             )
@@ -1326,7 +1353,7 @@ def is_booking_details_message(message):
         # If message has multiple booking indicators
         booking_indicators = sum([has_outlet, has_date, has_time, has_phone])
         if booking_indicators >= 2:
-            frappe.log_error(
+            log_ai_debug(
                 "Booking Detection Debug",
                 f"Detected booking data (multiple indicators: {booking_indicators})"
             )
@@ -1343,13 +1370,13 @@ def is_booking_details_message(message):
         ])
 
         if has_specifics:
-            frappe.log_error(
+            log_ai_debug(
                 "Booking Detection Debug",
                 f"Detected booking intent with specifics"
             )
             return True
 
-    frappe.log_error(
+    log_ai_debug(
         "Booking Detection Debug",
         f"NOT detected as booking message\nLines: {len(lines)}\nField count: {field_count}\nHas intent: {has_intent}"
     )
@@ -1503,13 +1530,7 @@ def extract_booking_with_llm(chat_history, current_message, existing_data=None):
         formatted_history = format_chat_history(chat_history) if chat_history else "No previous conversation."
 
         # Create LLM instance
-        llm = ChatOpenAI(
-            model="gpt-5-chat-latest",
-            temperature=0,
-            openai_api_key=openai_key,
-            timeout=30,
-            max_retries=2
-        )
+        llm = get_chat_llm(openai_key, model="gpt-5-chat-latest", temperature=0, timeout=30, max_retries=2)
 
         # Create extraction prompt
         extraction_prompt = f"""You are an AI assistant helping to extract booking information from a WhatsApp conversation.
@@ -1581,9 +1602,10 @@ OUTPUT FORMAT (JSON only, no other text):
         # Clean up null values
         cleaned_data = {k: v for k, v in extracted_data.items() if v is not None}
 
-        frappe.log_error(
+        log_ai_debug(
             "LLM Extraction Success",
-            f"LLM Extraction Result:\n{json.dumps(cleaned_data, indent=2, default=str)}"
+            "LLM Extraction Result:\n%s",
+            cleaned_data
         )
 
         return cleaned_data
@@ -1617,9 +1639,10 @@ def extract_booking_details(message, existing_data=None, chat_history=None):
         if chat_history and LANGCHAIN_AVAILABLE:
             try:
                 llm_data = extract_booking_with_llm(chat_history, message, existing_data)
-                frappe.log_error(
+                log_ai_debug(
                     "LLM Extraction Debug",
-                    f"LLM extracted from conversation:\n{json.dumps(llm_data, indent=2, default=str)}"
+                    "LLM extracted from conversation:\n%s",
+                    llm_data
                 )
 
                 # Use LLM data as the primary source
@@ -1627,9 +1650,10 @@ def extract_booking_details(message, existing_data=None, chat_history=None):
                     if value and value != "null":  # Only use non-null LLM values
                         booking_info[key] = value
 
-                frappe.log_error(
+                log_ai_debug(
                     "LLM Extraction Result",
-                    f"Final booking data after LLM:\n{json.dumps(booking_info, indent=2, default=str)}"
+                    "Final booking data after LLM:\n%s",
+                    booking_info
                 )
             except Exception as e:
                 frappe.log_error(
@@ -1645,7 +1669,7 @@ def extract_booking_details(message, existing_data=None, chat_history=None):
                         booking_info[key] = value
         else:
             # No chat history or LLM not available - use regex fallback
-            frappe.log_error(
+            log_ai_debug(
                 "Extraction Fallback",
                 f"LLM not available (chat_history={bool(chat_history)}, LANGCHAIN={LANGCHAIN_AVAILABLE})"
             )
@@ -1658,22 +1682,22 @@ def extract_booking_details(message, existing_data=None, chat_history=None):
         # If pax (number of people) not mentioned, default to 1
         if 'pax' not in booking_info or not booking_info.get('pax'):
             booking_info['pax'] = 1
-            frappe.log_error("Default Pax Applied", "User didn't mention pax - defaulting to 1 person")
+            log_ai_debug("Default Pax Applied", "User didn't mention pax - defaulting to 1 person")
 
         # If session (duration) not mentioned, default to 90 minutes
         if 'session' not in booking_info or not booking_info.get('session'):
             booking_info['session'] = 90
-            frappe.log_error("Default Duration Applied", "User didn't mention duration - defaulting to 90 minutes")
+            log_ai_debug("Default Duration Applied", "User didn't mention duration - defaulting to 90 minutes")
 
         # If treatment_type not mentioned, use special message for on-site selection
         if 'treatment_type' not in booking_info or not booking_info.get('treatment_type'):
             booking_info['treatment_type'] = "You may select treatment at the outlet, but will be subject to availability"
-            frappe.log_error("Default Treatment Applied", "User didn't mention treatment - will select at outlet")
+            log_ai_debug("Default Treatment Applied", "User didn't mention treatment - will select at outlet")
 
         # If using_package not mentioned, default to 'no'
         if 'using_package' not in booking_info or not booking_info.get('using_package'):
             booking_info['using_package'] = 'no'
-            frappe.log_error("Default Package Applied", "User didn't mention package - defaulting to 'no'")
+            log_ai_debug("Default Package Applied", "User didn't mention package - defaulting to 'no'")
 
         # Define required fields
         required_fields = {
@@ -1750,13 +1774,7 @@ def detect_update_intent_with_llm(chat_history, current_message, existing_bookin
         formatted_history = format_chat_history(chat_history) if chat_history else "No previous conversation."
 
         # Create LLM instance
-        llm = ChatOpenAI(
-            model="gpt-5.4-mini",
-            temperature=0,
-            openai_api_key=openai_key,
-            timeout=30,
-            max_retries=2
-        )
+        llm = get_chat_llm(openai_key, model="gpt-5.4-mini", temperature=0, timeout=30, max_retries=2)
 
         # Create detection prompt
         detection_prompt = f"""You are an AI assistant helping to detect if a customer wants to UPDATE an existing booking or make a NEW booking.
@@ -1820,9 +1838,10 @@ UPDATE TYPES:
 
         result = json.loads(response_text)
 
-        frappe.log_error(
+        log_ai_debug(
             "Update Intent Detection",
-            f"LLM Analysis:\n{json.dumps(result, indent=2, default=str)}"
+            "LLM Analysis:\n%s",
+            result
         )
 
         return {
@@ -1937,8 +1956,9 @@ Please choose a time within our operating hours. What time would work better for
 
 def get_pending_booking_data(crm_lead_doc):
     """
-    Get pending booking data from CRM Lead.
-    Falls back to cache if custom field doesn't exist.
+    Get pending booking data for a CRM Lead.
+    In-progress booking state is read from cache first, then falls back
+    to the confirmed booking stored on the custom field.
 
     Args:
         crm_lead_doc: CRM Lead document
@@ -1947,49 +1967,64 @@ def get_pending_booking_data(crm_lead_doc):
         dict: Pending booking data or empty dict
     """
     try:
-        # Try to get from custom field first
-        if hasattr(crm_lead_doc, 'pending_booking_data') and crm_lead_doc.pending_booking_data:
-            return json.loads(crm_lead_doc.pending_booking_data)
-    except Exception as e:
-        frappe.log_error("Booking Data Read Error", f"Error reading pending_booking_data field: {str(e)}")
-
-    # Fallback to cache if custom field doesn't exist
-    try:
-        cache_key = f"pending_booking_{crm_lead_doc.name}"
-        cached_data = frappe.cache().get_value(cache_key)
+        cached_data = frappe.cache().get_value(get_pending_booking_cache_key(crm_lead_doc.name))
         if cached_data:
             return json.loads(cached_data)
     except Exception as e:
         frappe.log_error("Booking Cache Read Error", f"Error reading from cache: {str(e)}")
 
+    try:
+        if hasattr(crm_lead_doc, 'pending_booking_data') and crm_lead_doc.pending_booking_data:
+            return json.loads(crm_lead_doc.pending_booking_data)
+    except Exception as e:
+        frappe.log_error("Booking Data Read Error", f"Error reading pending_booking_data field: {str(e)}")
+
     return {}
 
 def save_pending_booking_data(crm_lead_doc, booking_data):
     """
-    Save pending booking data to CRM Lead.
-    Falls back to cache if custom field doesn't exist.
+    Save pending booking data for a CRM Lead.
+    In-progress state only goes to cache; confirmed bookings are persisted
+    to the custom field so they survive for later updates and cancellations.
 
     Args:
         crm_lead_doc: CRM Lead document
         booking_data: Booking data dictionary to save
     """
     data_json = json.dumps(booking_data, default=str)
-
-    # Try to save to custom field first
-    try:
-        if hasattr(crm_lead_doc, 'pending_booking_data'):
+    cache_key = get_pending_booking_cache_key(crm_lead_doc.name)
+
+    if booking_data.get('confirmed') and hasattr(crm_lead_doc, 'pending_booking_data'):
+        try:
+            frappe.cache().delete_value(cache_key)
+        except Exception as e:
+            frappe.log_error("Booking Cache Clear Error", f"Error clearing cache: {str(e)}")
+
+        try:
+            # Nothing to write if this message left the booking state unchanged
+            if crm_lead_doc.pending_booking_data == data_json:
+                return
+            # Committed with the rest of the message handling at the end of the job
             frappe.db.set_value('CRM Lead', crm_lead_doc.name, 'pending_booking_data', data_json)
-            frappe.db.commit()
-            frappe.log_error("Booking Data Debug", f"Saved pending booking data to field for {crm_lead_doc.name}")
+            crm_lead_doc.pending_booking_data = data_json
+            log_ai_debug("Booking Data Debug", f"Saved confirmed booking data to field for {crm_lead_doc.name}")
             return
+        except Exception as e:
+            frappe.log_error("Booking Data Save Error", f"Error saving to pending_booking_data field: {str(e)}")
+
+    # A new in-progress booking supersedes the stored one; clear the field so an
+    # older booking does not resurface as pending once the cache entry expires
+    try:
+        if hasattr(crm_lead_doc, 'pending_booking_data') and crm_lead_doc.pending_booking_data:
+            frappe.db.set_value('CRM Lead', crm_lead_doc.name, 'pending_booking_data', None)
+            crm_lead_doc.pending_booking_data = None
     except Exception as e:
-        frappe.log_error("Booking Data Save Error", f"Error saving to pending_booking_data field: {str(e)}")
+        frappe.log_error("Booking Data Clear Error", f"Error clearing pending_booking_data field: {str(e)}")
 
-    # Fallback to cache (expires in 24 hours)
+    # In-progress booking state (expires in 24 hours)
     try:
-        cache_key = f"pending_booking_{crm_lead_doc.name}"
         frappe.cache().set_value(cache_key, data_json, expires_in_sec=86400)  # 24 hours
-        frappe.log_error("Booking Data Debug", f"Saved pending booking data to CACHE for {crm_lead_doc.name}")
+        log_ai_debug("Booking Data Debug", f"Saved pending booking data to CACHE for {crm_lead_doc.name}")
     except Exception as e:
         frappe.log_error("Booking Cache Save Error", f"Error saving to cache: {str(e)}")
 
@@ -2003,19 +2038,21 @@ def clear_pending_booking_data(crm_lead_doc):
     """
     # Clear custom field
     try:
-        if hasattr(crm_lead_doc, 'pending_booking_data'):
+        if hasattr(crm_lead_doc, 'pending_booking_data') and crm_lead_doc.pending_booking_data:
             frappe.db.set_value('CRM Lead', crm_lead_doc.name, 'pending_booking_data', None)
-            frappe.db.commit()
+            crm_lead_doc.pending_booking_data = None
     except Exception as e:
         frappe.log_error("Booking Data Clear Error", f"Error clearing pending_booking_data field: {str(e)}")
 
     # Clear cache
     try:
-        cache_key = f"pending_booking_{crm_lead_doc.name}"
-        frappe.cache().delete_value(cache_key)
+        frappe.cache().delete_value(get_pending_booking_cache_key(crm_lead_doc.name))
     except Exception as e:
         frappe.log_error("Booking Cache Clear Error", f"Error clearing cache: {str(e)}")
 
+def get_pending_booking_cache_key(crm_lead_name):
+    return f"pending_booking_{crm_lead_name}"
+
 def format_missing_fields_message(missing_fields, extracted_data=None):
     """
     Format a friendly message asking for missing booking fields.
@@ -2099,13 +2136,7 @@ def generate_smart_missing_fields_prompt(chat_history, current_message, extracte
                 user_provided_data[key] = value
 
         # Create LLM instance
-        llm = ChatOpenAI(
-            model="gpt-5-chat-latest",
-            temperature=0.3,  # Slightly higher for more natural responses
-            openai_api_key=openai_key,
-            timeout=30,
-            max_retries=2
-        )
+        llm = get_chat_llm(openai_key, model="gpt-5-chat-latest", temperature=0.3, timeout=30, max_retries=2)  # Slightly higher for more natural responses
 
         # Create prompt for generating the missing fields message
         generation_prompt = f"""You are a friendly customer service assistant for HealthLand helping to complete a booking.
@@ -2158,7 +2189,7 @@ Generate ONLY the message text (no quotes, no formatting tags, just the raw mess
         # Remove any hallucinated addresses or details
         generated_message = detect_and_remove_hallucinated_addresses(generated_message)
 
-        frappe.log_error(
+        log_ai_debug(
             "Smart Missing Fields Prompt",
             f"Generated smart prompt for missing fields:\n{generated_message}"
         )
@@ -2173,40 +2204,39 @@ Generate ONLY the message text (no quotes, no formatting tags, just the raw mess
         # Fallback to standard message
         return format_missing_fields_message(missing_fields, extracted_data)
 
-def get_rag_chain(crm_lead_doc_name):
+def get_rag_chain(crm_lead_doc_name, chat_history=None):
     """
     Initialize and return the RAG chain for AI-powered WhatsApp responses.
     Retrieves API keys from site config. Uses caching to avoid recreating chain.
 
+    Args:
+        crm_lead_doc_name: CRM Lead name
+        chat_history: Messages already fetched with get_whatsapp_messages(), fetched here if not given
+
     Returns:
         tuple: (retrieval_chain, formatted_chat_history)
     """
     global _rag_chain_cache
 
     # Get chat history for this specific CRM lead
-    print(f"Fetching chat history for {crm_lead_doc_name}", "WhatsApp AI Debug")
-    chat_history = get_whatsapp_messages("CRM Lead", crm_lead_doc_name)
-
-    print('Current chat history: ')
-    print(json.dumps(chat_history, indent=2, default=str))
+    if chat_history is None:
+        chat_history = get_whatsapp_messages("CRM Lead", crm_lead_doc_name)
 
     # Format chat history for use in prompt
     formatted_history = format_chat_history(chat_history)
-    print('\nFormatted chat history:')
-    print(formatted_history)
 
     # Return cached chain with current chat history if available
     if _rag_chain_cache is not None:
-        frappe.log_error("Using cached RAG chain", "WhatsApp AI Debug")
+        log_ai_debug("Using cached RAG chain", "WhatsApp AI Debug")
         return _rag_chain_cache, formatted_history
 
     if not LANGCHAIN_AVAILABLE:
         frappe.throw("LangChain packages are not installed. Please install required dependencies.")
 
-    frappe.log_error("Starting RAG chain initialization", "WhatsApp AI Debug")
+    log_ai_debug("Starting RAG chain initialization", "WhatsApp AI Debug")
 
     # Get API keys from site config
-    frappe.log_error("Fetching WhatsApp Settings", "WhatsApp AI Debug")
+    log_ai_debug("Fetching WhatsApp Settings", "WhatsApp AI Debug")
     whatsapp_settings = frappe.get_single("WhatsApp Settings")
     openai_key = whatsapp_settings.get_password("openai_api_key")
     pinecone_key = whatsapp_settings.get_password("pinecone_api_key")
@@ -2215,29 +2245,29 @@ def get_rag_chain(crm_lead_doc_name):
     if not openai_key or not pinecone_key:
         frappe.throw("OpenAI and Pinecone API keys must be configured in site_config.json")
 
-    frappe.log_error("API keys retrieved successfully", "WhatsApp AI Debug")
+    log_ai_debug("API keys retrieved successfully", "WhatsApp AI Debug")
 
     # Initialize embeddings and vector store with timeout
-    frappe.log_error("Initializing OpenAI embeddings", "WhatsApp AI Debug")
+    log_ai_debug("Initializing OpenAI embeddings", "WhatsApp AI Debug")
     embeddings = OpenAIEmbeddings(
         model="text-embedding-3-large",
         openai_api_key=openai_key
     )
 
-    frappe.log_error("Initializing Pinecone vector store (this may take time)", "WhatsApp AI Debug")
+    log_ai_debug("Initializing Pinecone vector store (this may take time)", "WhatsApp AI Debug")
     try:
         vectorstore = PineconeVectorStore(
             index_name=index_name,
             embedding=embeddings,
             pinecone_api_key=pinecone_key
         )
-        frappe.log_error("Pinecone vector store initialized", "WhatsApp AI Debug")
+        log_ai_debug("Pinecone vector store initialized", "WhatsApp AI Debug")
     except Exception as e:
         frappe.log_error(f"Pinecone initialization failed: {str(e)}", "WhatsApp AI Error")
         raise
 
     # Create retriever with outlet data enhancement
-    frappe.log_error("Creating hybrid retriever (outlet data + vector search)", "WhatsApp AI Debug")
+    log_ai_debug("Creating hybrid retriever (outlet data + vector search)", "WhatsApp AI Debug")
     base_retriever = vectorstore.as_retriever(search_kwargs={"k": 5})
 
     # Create a custom retriever that adds outlet data
@@ -2271,7 +2301,7 @@ def get_rag_chain(crm_lead_doc_name):
             is_outlet_query = any(keyword in query.lower() for keyword in outlet_keywords)
 
             if is_outlet_query:
-                frappe.log_error("Outlet Query Detected", f"Searching outlet_data.json for: {query}")
+                log_ai_debug("Outlet Query Detected", f"Searching outlet_data.json for: {query}")
                 # Search structured outlet data
                 outlet_info = search_outlet_data(query)
 
@@ -2287,23 +2317,23 @@ def get_rag_chain(crm_lead_doc_name):
                         metadata={"source": "outlet_data.json", "priority": "high"}
                     )
                     documents.append(outlet_doc)
-                    frappe.log_error("Outlet Data Added", f"Added structured outlet data to context")
+                    log_ai_debug("Outlet Data Added", f"Added structured outlet data to context")
 
             # Always do vector search to get additional context
             try:
                 vector_docs = self.base_retriever.invoke(query)
                 documents.extend(vector_docs)
-                frappe.log_error("Vector Search Complete", f"Retrieved {len(vector_docs)} documents from vector store")
+                log_ai_debug("Vector Search Complete", f"Retrieved {len(vector_docs)} documents from vector store")
             except Exception as e:
                 frappe.log_error("Vector Search Error", f"Error in vector search: {str(e)}")
 
-            frappe.log_error("Hybrid Retrieval Complete", f"Total documents: {len(documents)}")
+            log_ai_debug("Hybrid Retrieval Complete", f"Total documents: {len(documents)}")
             return documents
 
     retriever = HybridOutletRetriever(base_retriever=base_retriever)
 
     # Create LLM
-    frappe.log_error("Creating ChatOpenAI LLM", "WhatsApp AI Debug")
+    log_ai_debug("Creating ChatOpenAI LLM", "WhatsApp AI Debug")
     llm = ChatOpenAI(
         model="gpt-5-chat-latest",
         temperature=0,
@@ -2313,7 +2343,7 @@ def get_rag_chain(crm_lead_doc_name):
     )
 
     # Create prompt template with conversation history
-    frappe.log_error("Creating prompt template", "WhatsApp AI Debug")
+    log_ai_debug("Creating prompt template", "WhatsApp AI Debug")
 
     prompt = ChatPromptTemplate.from_template("""
 
@@ -2857,13 +2887,13 @@ Answer:""")
 # Answer:""")
 
     # Create chains
-    frappe.log_error("Creating document and retrieval chains", "WhatsApp AI Debug")
+    log_ai_debug("Creating document and retrieval chains", "WhatsApp AI Debug")
     document_chain = create_stuff_documents_chain(llm, prompt)
     retrieval_chain = create_retrieval_chain(retriever, document_chain)
 
     # Cache the chain for reuse
     _rag_chain_cache = retrieval_chain
-    frappe.log_error("RAG chain initialization completed and cached", "WhatsApp AI Debug")
+    log_ai_debug("RAG chain initialization completed and cached", "WhatsApp AI Debug")
 
     return retrieval_chain, formatted_history
 
@@ -1,102 +1,119 @@
 import frappe
+import re
 from datetime import datetime
-
-def is_confirmation_message(message, context=None):
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.agents.rag_chain import log_ai_debug
+
+SIMPLE_CONFIRMATIONS = frozenset(['yes', 'yup', 'yeah', 'yep', 'ok', 'okay', 'confirm', 'ya', 'betul', 'boleh'])
+SIMPLE_REJECTIONS = frozenset(['no', 'nope', 'wrong', 'change', 'tidak', 'tak'])
+
+# Keyword fallbacks used when the LLM is unavailable: keyword followed by space or punctuation
+CONFIRMATION_PREFIX_RE = re.compile(
+    r"^(?:yes|yup|yeah|yep|correct|right|confirm|confirmed|ok|okay|proceed|continue|good|looks good|all good|betul|ya|okie|boleh)[ ,.!]"
+)
+CHANGE_PREFIX_RE = re.compile(
+    r"^(?:no|nope|wrong|change|edit|modify|incorrect|not correct|mistake|error|tidak|tak|salah|ubah|tukar)[ ,.!]"
+)
+
+QUESTION_KEYWORDS = [
+    # English
+    'what', 'when', 'where', 'how', 'why', 'who', 'which',
+    'can you', 'could you', 'do you', 'does', 'is there', 'are there',
+    'can i ask', 'can i know', 'may i know',
+    'tell me', 'explain', 'what is', 'what are', 'how much', 'how long',
+    'want to know', 'like to know', 'interested to know', 'curious',
+    'any info', 'more info', 'information',
+    'price', 'cost', 'location', 'outlet', 'operating hours', 'open',
+    'available', 'offer', 'provide', 'difference', 'compare',
+    'package', 'promotion', 'discount', 'membership',
+    'recommend', 'suggestion', 'suggest',
+    'how to book',  # asking about booking process, not actually booking
+    # Malay
+    'apa', 'bila', 'mana', 'macam mana', 'kenapa', 'siapa',
+    'berapa', 'ada tak', 'ada ke', 'boleh tak', 'boleh ke',
+    'nak tahu', 'nak tanya', 'tanya sikit',
+]
+QUESTION_RE = re.compile("|".join(re.escape(keyword) for keyword in QUESTION_KEYWORDS))
+
+# Definite LLM yes/no answers per (site, message, context); errors and 'other' are never stored
+_YES_NO_CACHE = {}
+YES_NO_CACHE_SIZE = 2048
+
+
+def classify_yes_no(message, context=None):
     """
-    Check if the message is a confirmation (yes, confirm, correct, etc.) using LLM.
+    Classify the message as a confirmation or a change request in one pass.
 
-    Uses LLM to intelligently detect if user is saying "yes" in various forms.
+    Keyword matching handles the common cases; short messages otherwise go
+    through a single LLM call. Definite LLM answers are kept per site, so
+    common replies like "sure thing" only reach the LLM once per worker.
 
     Args:
         message: User's message text
         context: Optional context ('awaiting_confirmation', 'awaiting_update', or None)
 
     Returns:
-        bool: True if message is a confirmation
+        str: 'yes' for a confirmation, 'no' for a change request, otherwise None
     """
-    # First try simple keyword matching for common cases (faster)
     message_lower = message.lower().strip()
-    simple_confirmations = ['yes', 'yup', 'yeah', 'yep', 'ok', 'okay', 'confirm', 'ya', 'betul', 'boleh']
 
-    if message_lower in simple_confirmations:
-        return True
+    if message_lower in SIMPLE_CONFIRMATIONS:
+        return 'yes'
+    if message_lower in SIMPLE_REJECTIONS:
+        return 'no'
 
-    # For more complex cases, use LLM
-    try:
-        # Only use LLM for short messages (under 50 chars) to avoid processing long messages
-        if len(message) > 50:
-            return False
+    # Only use LLM for short messages (under 50 chars) to avoid processing long messages
+    if len(message) > 50:
+        return None
+
+    cache_key = (frappe.local.site, message, context)
+    if cache_key in _YES_NO_CACHE:
+        return _YES_NO_CACHE[cache_key]
 
+    try:
         from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.agents.rag_chain import detect_yes_no_with_llm
         result = detect_yes_no_with_llm(message, context=context)
-        return result == 'yes'
+        if result not in ('yes', 'no'):
+            return None
+        if len(_YES_NO_CACHE) >= YES_NO_CACHE_SIZE:
+            _YES_NO_CACHE.clear()
+        _YES_NO_CACHE[cache_key] = result
+        return result
     except Exception as e:
         frappe.log_error("Confirmation Detection Error", f"Error detecting confirmation with LLM: {str(e)}")
         # Fallback to keyword matching
-        confirmation_keywords = [
-            'yes', 'yup', 'yeah', 'yep', 'correct', 'right',
-            'confirm', 'confirmed', 'ok', 'okay', 'proceed',
-            'continue', 'good', 'looks good', 'all good',
-            'betul', 'ya', 'okie', 'boleh'
-        ]
-
         if len(message_lower) <= 30:
-            for keyword in confirmation_keywords:
-                if (message_lower.startswith(keyword + ' ') or
-                    message_lower.startswith(keyword + ',') or
-                    message_lower.startswith(keyword + '.') or
-                    message_lower.startswith(keyword + '!')):
-                    return True
+            if CONFIRMATION_PREFIX_RE.match(message_lower):
+                return 'yes'
+            if CHANGE_PREFIX_RE.match(message_lower):
+                return 'no'
 
-        return False
+        return None
 
-def is_change_request(message, context=None):
+def is_confirmation_message(message, context=None):
     """
-    Check if the message is requesting to change booking details using LLM.
-
-    Uses LLM to intelligently detect if user is saying "no" or wants to make changes.
+    Check if the message is a confirmation (yes, confirm, correct, etc.) using LLM.
 
     Args:
         message: User's message text
         context: Optional context ('awaiting_confirmation', 'awaiting_update', or None)
 
     Returns:
-        bool: True if message is requesting changes
+        bool: True if message is a confirmation
     """
-    # First try simple keyword matching for common cases (faster)
-    message_lower = message.lower().strip()
-    simple_rejections = ['no', 'nope', 'wrong', 'change', 'tidak', 'tak']
-
-    if message_lower in simple_rejections:
-        return True
-
-    # For more complex cases, use LLM
-    try:
-        # Only use LLM for short messages (under 50 chars) to avoid processing long messages
-        if len(message) > 50:
-            return False
+    return classify_yes_no(message, context=context) == 'yes'
 
-        from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.agents.rag_chain import detect_yes_no_with_llm
-        result = detect_yes_no_with_llm(message, context=context)
-        return result == 'no'
-    except Exception as e:
-        frappe.log_error("Change Request Detection Error", f"Error detecting change request with LLM: {str(e)}")
-        # Fallback to keyword matching
-        change_keywords = [
-            'no', 'nope', 'wrong', 'change', 'edit', 'modify',
-            'incorrect', 'not correct', 'mistake', 'error',
-            'tidak', 'tak', 'salah', 'ubah', 'tukar'
-        ]
+def is_change_request(message, context=None):
+    """
+    Check if the message is requesting to change booking details using LLM.
 
-        if len(message_lower) <= 30:
-            for keyword in change_keywords:
-                if (message_lower.startswith(keyword + ' ') or
-                    message_lower.startswith(keyword + ',') or
-                    message_lower.startswith(keyword + '.') or
-                    message_lower.startswith(keyword + '!')):
-                    return True
+    Args:
+        message: User's message text
+        context: Optional context ('awaiting_confirmation', 'awaiting_update', or None)
 
-        return False
+    Returns:
+        bool: True if message is requesting changes
+    """
+    return classify_yes_no(message, context=context) == 'no'
 
 
 def is_general_question(message):
@@ -110,39 +127,11 @@ def is_general_question(message):
     Returns:
         bool: True if message is a general question
     """
-    # Question patterns - English
-    question_keywords = [
-        'what', 'when', 'where', 'how', 'why', 'who', 'which',
-        'can you', 'could you', 'do you', 'does', 'is there', 'are there',
-        'can i ask', 'can i know', 'may i know',
-        'tell me', 'explain', 'what is', 'what are', 'how much', 'how long',
-        'want to know', 'like to know', 'interested to know', 'curious',
-        'any info', 'more info', 'information',
-        'price', 'cost', 'location', 'outlet', 'operating hours', 'open',
-        'available', 'offer', 'provide', 'difference', 'compare',
-        'package', 'promotion', 'discount', 'membership',
-        'recommend', 'suggestion', 'suggest',
-        'how to book',  # asking about booking process, not actually booking
-    ]
-
-    # Question patterns - Malay
-    malay_question_keywords = [
-        'apa', 'bila', 'mana', 'macam mana', 'kenapa', 'siapa',
-        'berapa', 'ada tak', 'ada ke', 'boleh tak', 'boleh ke',
-        'nak tahu', 'nak tanya', 'tanya sikit',
-    ]
-
-    message_lower = message.lower().strip()
-
-    # Check if it's a question
-    has_question_mark = '?' in message
-    has_question_word = any(keyword in message_lower for keyword in question_keywords)
-    has_malay_question = any(keyword in message_lower for keyword in malay_question_keywords)
+    if '?' not in message and not QUESTION_RE.search(message.lower().strip()):
+        return False
 
     # Exclude confirmation responses (yes/no)
-    is_confirmation = is_confirmation_message(message) or is_change_request(message)
-
-    return (has_question_mark or has_question_word or has_malay_question) and not is_confirmation
+    return classify_yes_no(message) is None
 
 
 def analyze_confirmation_response_intent(message, pending_booking_data):
@@ -244,10 +233,11 @@ If intent is "update_fields", field_updates should contain the extracted updates
 
         result = json.loads(result_text)
 
-        frappe.log_error(
+        log_ai_debug(
             "Confirmation Response Intent Analysis",
-            f"User message: {message}\n"
-            f"LLM analysis:\n{json.dumps(result, indent=2)}"
+            "User message: %s\n"
+            "LLM analysis:\n%s",
+            message, result
         )
 
         return result
@@ -1,9 +1,16 @@
 import frappe, requests, json, re, os
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.agents.rag_chain import log_ai_debug
 
 BOOKING_ENPOINT = "/api/method/soma_wellness.api.make_bookings"
 REGISTER_STAFF_FACE_ENDPOINT = "/api/method/healthland_pos.api.register_staff_face"
 CREATE_AL_APPLICATION_ENDPOINT = "/api/method/healthland_pos.api.create_al_application"
 
+# Shared keep-alive session for the POS/booking integration sites; retries only cover failed connects
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=Retry(total=2, backoff_factor=0.1)))
+
 
 def handle_booking_api_mock(crm_lead_doc, whatsapp_id, booking_details):
     """
@@ -21,7 +28,7 @@ def handle_booking_api_mock(crm_lead_doc, whatsapp_id, booking_details):
     booking_reference = f"BKG{frappe.utils.now_datetime().strftime('%Y%m%d%H%M%S')}"
 
     # Log the booking for debugging
-    frappe.log_error(
+    log_ai_debug(
         title="Mock Booking Creation",
         message=f"""
         Booking Reference: {booking_reference}
@@ -95,7 +102,7 @@ def handle_booking_api(crm_lead_doc, whatsapp_id, booking_details):
         }
 
         try:
-            response = requests.post(url, data=json.dumps(request_body, default=str), headers=headers, timeout=30)
+            response = _SESSION.post(url, data=json.dumps(request_body, default=str), headers=headers, timeout=30)
             response.raise_for_status()
             response_data = response.json()
             return response_data
@@ -123,7 +130,7 @@ def handle_update_booking_api_mock(crm_lead_doc, whatsapp_id, booking_details, b
         booking_reference = f"BKG{frappe.utils.now_datetime().strftime('%Y%m%d%H%M%S')}"
 
     # Log the update for debugging
-    frappe.log_error(
+    log_ai_debug(
         title="Mock Booking Update",
         message=f"""
         Booking Reference: {booking_reference}
@@ -174,7 +181,7 @@ def handle_cancel_booking_api_mock(crm_lead_doc, whatsapp_id, booking_reference=
         booking_reference = f"BKG{frappe.utils.now_datetime().strftime('%Y%m%d%H%M%S')}"
 
     # Log the cancellation for debugging
-    frappe.log_error(
+    log_ai_debug(
         title="Mock Booking Cancellation",
         message=f"""
         Booking Reference: {booking_reference}
@@ -226,7 +233,7 @@ def handle_register_staff_face_api(mobile_no, selfie_image):
         }
 
         try:
-            response = requests.post(url, data=json.dumps(request_body, default=str), headers=headers, timeout=30)
+            response = _SESSION.post(url, data=json.dumps(request_body, default=str), headers=headers, timeout=30)
             response.raise_for_status()
             response_data = response.json()
             return response_data
@@ -265,7 +272,7 @@ def handle_leave_application_api(whatsapp_id, leave_date, reason):
         }
 
         try:
-            response = requests.post(url, data=json.dumps(request_body, default=str), headers=headers, timeout=30)
+            response = _SESSION.post(url, data=json.dumps(request_body, default=str), headers=headers, timeout=30)
             response.raise_for_status()
             response_data = response.json()
             return response_data
@@ -1,16 +1,22 @@
 # Copyright (c) 2022, Shridhar Patil and contributors
 # For license information, please see license.txt
 import json
+import orjson
 import frappe
-from frappe.utils import get_datetime, getdate, flt, cint, add_to_date
+from frappe.utils import get_datetime, getdate, flt, cint, add_to_date, now_datetime
 from frappe.model.document import Document
-from frappe.integrations.utils import make_post_request
+from frappe.utils.password import get_decrypted_password
 import random
 import datetime
+from functools import lru_cache
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
 import time
 import hashlib
-from crm.api.whatsapp import get_lead_or_deal_from_number, create_booking, edit_booking
+from crm.api.whatsapp import get_lead_or_deal_from_number, create_booking, edit_booking, get_whatsapp_messages, fetch_bookings
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from frappe.utils.background_jobs import enqueue
 from frappe.core.doctype.file.utils import find_file_by_url
 import re
@@ -27,7 +33,15 @@ from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.agents.rag_chain i
     format_missing_fields_message,
     generate_smart_missing_fields_prompt,
     validate_booking_timeslot,
-    validate_and_correct_outlet_info
+    validate_and_correct_outlet_info,
+    detect_yes_no_with_llm,
+    has_cancel_intent,
+    detect_update_intent_with_llm,
+    classify_message_intent_with_llm,
+    clean_message_formatting,
+    detect_and_remove_hallucinated_addresses,
+    remove_soma_mentions,
+    log_ai_debug
 )
 from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.handle_api_calls import (
     handle_booking_api,
@@ -38,11 +52,18 @@ from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.handle_api_calls i
     handle_leave_application_api
 )
 from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.ai_utils import (
-    is_confirmation_message,
-    is_change_request,
+    SIMPLE_CONFIRMATIONS,
+    SIMPLE_REJECTIONS,
+    classify_yes_no,
     analyze_confirmation_response_intent,
 )
 
+# Working and booking hours, in the site's system timezone
+OPERATING_HOURS_START = datetime.time(9, 0)   # 9:00 AM
+OPERATING_HOURS_END = datetime.time(17, 0)    # 5:00 PM
+BOOKING_HOURS_START = datetime.time(8, 45)    # 08:45 AM
+BOOKING_HOURS_END = datetime.time(21, 0)      # 9:00 PM
+
 OUT_OF_WORKING_HOURS_MESSAGE = "Hello! 😊 Thanks for reaching out!\n\n📅 Our working hours: 9 AM - 5 PM (Monday - Friday). While we're currently unavailable, drop us a message, and we'll get back to you ASAP!\n\n💡 Want to check out our latest deals or make a purchase? Click the link below for exciting offers! 🎉👇\n\nhttps://book.healthland.com.my/privatelink/nojokepwp\n\nThank you for your patience & support! 💜"
 OUT_OF_BOOKING_HOURS_MESSAGE = "📢 This is an automated message\n\nHello! 😊 Thanks for reaching out!\n\n📅 Our booking hours: 10 AM - 9 PM. While we're currently unavailable, leave us a message, and we'll get back to you ASAP!\n\n💡 Need to book now? Try our Online Booking System for a fast & hassle-free experience! 🚀\n👉 Book here: https://book.healthland.com.my/booking/selectshop \n\nThank you for your patience & understanding! 💜"
 OUT_OF_BOOKING_HOURS_FOLLOW_UP_MESSAGE = "🌞 Good morning!\nThank you for reaching out to HealthLand 💜\n\nOur WhatsApp is for package/voucher redemption bookings only 💆‍♀️💆‍♂️\nFor walk-in or non-package customers, we recommend booking online to enjoy:\n✅ Enjoy better rates compared to walk-in\n✅ Secure your slot in advance\n👉 https://book.healthland.com.my/booking/selectshop \n\n✨ Have you booked online yet?\nIf not, no worries — just fill in the form below and we'll help you make the booking:\n\n• Name\n• Contact No.\n• Date & Time\n• Outlet\n• No. of Pax\n• Treatment (Foot / Thai / Oil)\n• Duration (60 / 90 / 120 min)\n• Preferred Masseur (Male / Female)\n• Voucher / Package\n\n🕒 Filling in the form helps us secure your slot faster and avoid delays.\nWe look forward to serving you soon! 💚"
@@ -72,6 +93,152 @@ PDPA_ACCEPTED_REPLY = "You're now registered as a SOMA Wellness Member 🌿"
 
 CLOCK_IN_ENDPOINT = "/api/method/healthland_pos.api.clock_in"
 
+BOOKING_SUMMARY_TEMPLATE = """{header}
+
+- Name: {customer_name}
+- Phone: {phone}
+- Outlet: {outlet}
+- Date: {booking_date}
+- Time: {timeslot}
+- Pax: {pax}
+- Treatment: {treatment_type}
+- Duration: {session} minutes
+- Preferred Masseur: {preferred_masseur}{voucher_lines}
+
+{footer}"""
+BOOKING_SUMMARY_VOUCHER_LINES = "\n- 3rd Party Voucher: {third_party_voucher}\n- Using Package: {using_package}"
+BOOKING_SUMMARY_DEFAULTS = {
+    'customer_name': None,
+    'phone': None,
+    'outlet': None,
+    'booking_date': None,
+    'timeslot': None,
+    'pax': None,
+    'treatment_type': None,
+    'session': None,
+    'preferred_masseur': None,
+    'third_party_voucher': 'N/A',
+    'using_package': 'N/A'
+}
+BOOKING_CONFIRM_FOOTER = "Is everything correct? Please reply:\n✅ *Yes* to confirm\n❌ *No* to make changes"
+BOOKING_CONFIRM_AGAIN_FOOTER = "Is everything correct now? Please reply:\n✅ *Yes* to confirm\n❌ *No* to make more changes"
+
+# Fields whose change means the customer must see a fresh confirmation
+BOOKING_KEY_FIELDS = ('booking_date', 'timeslot', 'outlet', 'pax', 'treatment_type', 'session')
+
+BOOKING_FIELD_LABELS = {
+    'booking_date': 'Date',
+    'timeslot': 'Time',
+    'outlet': 'Outlet',
+    'pax': 'Number of People',
+    'treatment_type': 'Treatment',
+    'session': 'Duration',
+    'preferred_masseur': 'Masseur Preference',
+    'customer_name': 'Name',
+    'phone': 'Phone'
+}
+
+BOOKING_UPDATED_MESSAGE = """✅ Booking Updated Successfully!
+
+📋 Updated Booking Details:
+- Outlet: {outlet}
+- Date: {booking_date}
+- Time: {timeslot}
+- Treatment: {treatment}
+- Duration: {session} minutes
+- Preferred Therapist: {preferred_therapist}
+
+Thank you for updating your booking with HealthLand! 💚"""
+
+BOOKING_CONFIRMED_MESSAGE = """✅ Booking confirmed!
+
+📋 Booking Reference: {booking_reference}
+- Name: {customer_name}
+- Date: {booking_date}
+- Time: {timeslot}
+- Treatment: {treatment_type}
+- Duration: {session} minutes
+- Pax: {pax}
+
+Thank you for choosing HealthLand! 💚"""
+
+BOOKING_UPDATE_CONFIRMATION_MESSAGE = """📋 Please confirm your booking update:
+
+🔄 Changes:
+{changes_summary}
+
+📋 Updated Booking Details:
+- Outlet: {outlet}
+- Date: {booking_date}
+- Time: {timeslot}
+- Treatment: {treatment}
+- Duration: {session} minutes
+- Preferred Therapist: {preferred_therapist}
+
+Is this correct? Please reply:
+✅ *Yes* to confirm update
+❌ *No* to remain unchanged"""
+
+UPCOMING_BOOKING_EDIT_MESSAGE = """Sure! I can help you update your booking.
+
+📋 Your Upcoming Booking:
+- Outlet: {outlet}
+- Date: {booking_date}
+- Time: {timeslot}
+- Treatment: {treatment}
+- Duration: {session} mins
+- Therapist: {preferred_therapist}
+
+What would you like to change? Just tell me in your own words! 😊
+
+For example:
+• _"Change date to 5th April"_
+• _"Change time to 3pm"_
+• _"Change outlet to Puchong"_
+• _"Change to tomorrow at 2pm"_"""
+
+# Columns of Text Auto Reply read when sending an auto reply
+TEXT_AUTO_REPLY_FIELDS = [
+    "name",
+    "tagging",
+    "whatsapp_message_templates",
+    "whatsapp_interaction_message_templates",
+    "reply_if_button_clicked",
+    "reply_image",
+    "reply_2_if_button_clicked",
+    "reply_image_2",
+    "send_out_of_working_hours_message",
+    "send_out_of_booking_hours_message"
+]
+
+# Columns of CRM Lead loaded by get_crm_lead(minimal=True)
+CRM_LEAD_MINIMAL_FIELDS = ["name", "lead_name", "mobile_no", "last_reply_at", "closed"]
+
+# CRM Lead Assignment statuses other than Case Closed, listed so the status index can be range-scanned
+OPEN_ASSIGNMENT_STATUSES = ("New", "Accepted", "Completed")
+
+# Text Auto Replies sent to a new conversation without a keyword match, in order of preference
+TEXT_AUTO_REPLY_FALLBACKS = ("BookingHL", "automated_message")
+
+NON_DIGIT_RE = re.compile(r'\D')
+# Plain "yes"/"no" style replies, by far the most common answer to a confirmation prompt
+BARE_REPLIES = SIMPLE_CONFIRMATIONS | SIMPLE_REJECTIONS
+NON_CONFIRMATION_RE = re.compile(
+    r"link|share|send|tell me|what|where|how|when|outlet|location|address|price|package|promotion|discount|treatment|massage|service|available",
+    re.IGNORECASE
+)
+# Turn states for a classify_yes_no() answer while awaiting confirmation; anything else is 'unclear'
+CONFIRMATION_REPLY_STATES = {'yes': 'confirmed', 'no': 'change_requested'}
+
+# Graph API credentials per site; settings changes in other workers apply once the entry expires
+CREDENTIALS_TTL = 60
+_CREDENTIALS_CACHE = {}
+
+# Shared keep-alive session so consecutive Graph API calls reuse the TCP/TLS connection (also used by
+# the webhook's media fetches); read=0 keeps retries to failed connects, so a stalled GET is not repeated
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=Retry(total=2, read=0, backoff_factor=0.2)))
+
 class WhatsAppMessage(Document):
     """Send whats app messages."""
 
@@ -116,7 +283,7 @@ class WhatsAppMessage(Document):
             except Exception as e:
                 self.status = "Failed"
                 frappe.throw(f"Failed to send message {str(e)}")
-        elif self.type == "Outgoing" and self.message_type == "Template" and not self.message_id:
+        elif self.type == "Outgoing" and self.message_type == "Template" and not self.message_id and not self.flags.defer_notify:
             self.send_template()
 
     def after_insert(self):
@@ -158,39 +325,18 @@ class WhatsAppMessage(Document):
                 elif self.content_type == "list_reply":
                     handle_interactive_list_reply(self.get("from"), self.get("from_name"), self.interactive_id, self.message, crm_lead_doc)
                 else:
-                    if not crm_lead_doc.last_reply_at or crm_lead_doc.last_reply_at < add_to_date(get_datetime(), days=-1) or crm_lead_doc.closed:
-                        text_auto_replies = frappe.db.get_all("Text Auto Reply", filters={"disabled": 0, "name": "automated_message"}, fields=["*"])
+                    if not crm_lead_doc.last_reply_at or crm_lead_doc.last_reply_at < now_datetime() - datetime.timedelta(days=1) or crm_lead_doc.closed:
+                        text_auto_replies = frappe.db.get_all("Text Auto Reply", filters={"disabled": 0, "name": "automated_message"}, fields=TEXT_AUTO_REPLY_FIELDS, limit=1)
                         if text_auto_replies:
                             frappe.flags.update_conversation_start_at = True
                             frappe.flags.skip_lead_status_update = True
                             create_crm_lead_assignment(crm_lead_doc.name, text_auto_replies[0].whatsapp_message_templates)
                             create_crm_tagging_assignment(crm_lead_doc.name, "Unknown")
-                            if text_auto_replies[0].reply_if_button_clicked:
-                                if text_auto_replies[0].reply_image:
-                                    enqueue(method=send_image_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=self.get("from"), text=text_auto_replies[0].reply_if_button_clicked, image=text_auto_replies[0].reply_image, queue="short", is_async=True)
-                                else:
-                                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=self.get("from"), text=text_auto_replies[0].reply_if_button_clicked, queue="short", is_async=True)
-                            if text_auto_replies[0].reply_2_if_button_clicked:
-                                if text_auto_replies[0].reply_image_2:
-                                    enqueue(method=send_image_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=self.get("from"), text=text_auto_replies[0].reply_2_if_button_clicked, image=text_auto_replies[0].reply_image_2, queue="short", is_async=True)
-                                else:
-                                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=self.get("from"), text=text_auto_replies[0].reply_2_if_button_clicked, queue="short", is_async=True)
-                            if text_auto_replies[0].whatsapp_interaction_message_templates:
-                                enqueue(method=send_interaction_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=self.get("from"), whatsapp_interaction_message_template=text_auto_replies[0].whatsapp_interaction_message_templates, queue="short", is_async=True)
-                            if text_auto_replies[0].send_out_of_working_hours_message and is_not_within_operating_hours():
-                                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=self.get("from"), text=OUT_OF_WORKING_HOURS_MESSAGE, queue="short", is_async=True)
-                            if text_auto_replies[0].send_out_of_booking_hours_message and is_not_within_booking_hours():
-                                if not frappe.db.exists("Booking Follow Up", {"crm_lead": crm_lead_doc.name}):
-                                    frappe.get_doc({
-                                        "doctype": "Booking Follow Up",
-                                        "whatsapp_id": self.get("from"),
-                                        "crm_lead": crm_lead_doc.name
-                                    }).insert(ignore_permissions=True)
-                                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=self.get("from"), text=OUT_OF_BOOKING_HOURS_MESSAGE, queue="short", is_async=True)
+                            queue_auto_reply(text_auto_replies[0], crm_lead_doc, self.get("from"))
 
             crm_lead_doc_dict = {
                 "last_reply_at": get_datetime(),
-                "chat_close_at": add_to_date(get_datetime(), hours=22),
+                "chat_close_at": now_datetime() + datetime.timedelta(hours=22),
                 "last_message_from_me": False,
                 "sent_chat_closing_reminder": False,
                 "closed": 0,
@@ -256,76 +402,47 @@ class WhatsAppMessage(Document):
             },
         }
 
-        if template.sample_values:
-            field_names = template.field_names.split(",") if template.field_names else template.sample_values.split(",")
-            parameters = []
-            template_parameters = []
-
+        has_header_parameters = template.header_type and template.sample
+        if template.sample_values or has_header_parameters:
             ref_doc = frappe.get_doc(self.reference_doctype, self.reference_name)
-            for field_name in field_names:
-                value = ref_doc.get_formatted(field_name.strip())
-
-                parameters.append({"type": "text", "text": value})
-                template_parameters.append(value)
 
+        if template.sample_values:
+            component, template_parameters = build_template_component(ref_doc, template.field_names or template.sample_values, "body")
             self.template_parameters = json.dumps(template_parameters)
+            data["template"]["components"].append(component)
 
-            data["template"]["components"].append(
-                {
-                    "type": "body",
-                    "parameters": parameters,
-                }
-            )
-
-        if template.header_type and template.sample:
-            field_names = template.sample.split(",")
-            header_parameters = []
-            template_header_parameters = []
-
-            ref_doc = frappe.get_doc(self.reference_doctype, self.reference_name)
-            for field_name in field_names:
-                value = ref_doc.get_formatted(field_name.strip())
-                
-                header_parameters.append({"type": "text", "text": value})
-                template_header_parameters.append(value)
-
+        if has_header_parameters:
+            component, template_header_parameters = build_template_component(ref_doc, template.sample, "header")
             self.template_header_parameters = json.dumps(template_header_parameters)
-
-            data["template"]["components"].append({
-                "type": "header",
-                "parameters": header_parameters,
-            })
+            data["template"]["components"].append(component)
 
         self.notify(data)
 
     def notify(self, data):
         """Notify."""
-        settings = frappe.get_doc(
-            "WhatsApp Settings",
-            "WhatsApp Settings",
-        )
-        token = settings.get_password("token")
+        settings = get_whatsapp_credentials()
 
         headers = {
-            "authorization": f"Bearer {token}",
+            "authorization": f"Bearer {settings.token}",
             "content-type": "application/json",
         }
         try:
-            response = make_post_request(
+            response = post_json(
                 f"{settings.url}/{settings.version}/{settings.phone_id}/messages",
                 headers=headers,
-                data=json.dumps(data),
+                data=data,
             )
             self.message_id = response["messages"][0]["id"]
 
         except Exception as e:
-            res = frappe.flags.integration_request.json()["error"]
+            meta_data = orjson.loads(frappe.flags.integration_request.content)
+            res = meta_data["error"]
             error_message = res.get("Error", res.get("message"))
             frappe.get_doc(
                 {
                     "doctype": "WhatsApp Notification Log",
                     "template": "Text Message",
-                    "meta_data": frappe.flags.integration_request.json(),
+                    "meta_data": meta_data,
                 }
             ).insert(ignore_permissions=True)
 
@@ -342,7 +459,38 @@ class WhatsAppMessage(Document):
 #     doc.notify(data)
 
 def on_doctype_update():
-    frappe.db.add_index("WhatsApp Message", ["reference_doctype", "reference_name"])
+    # chat history is read per lead ordered by creation; this index also serves plain reference lookups
+    frappe.db.add_index("WhatsApp Message", ["reference_doctype", "reference_name", "creation"])
+    # the older two-column index is a prefix of the one above
+    if frappe.db.has_index("tabWhatsApp Message", "reference_doctype_reference_name_index"):
+        frappe.db.sql_ddl("ALTER TABLE `tabWhatsApp Message` DROP INDEX `reference_doctype_reference_name_index`")
+
+def build_template_component(ref_doc, field_names, component_type):
+    """Return the Graph API component for comma separated field_names and the formatted values."""
+    values = [ref_doc.get_formatted(field_name.strip()) for field_name in field_names.split(",")]
+    return {"type": component_type, "parameters": [{"type": "text", "text": value} for value in values]}, values
+
+def post_json(url, headers, data):
+    """POST data as JSON over the shared session, mirroring make_post_request."""
+    response = _SESSION.post(url, headers=headers, data=orjson.dumps(data), timeout=(3.05, 10))
+    frappe.flags.integration_request = response
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+def get_whatsapp_credentials():
+    """Return Graph API url, version, phone_id and decrypted token, cached per site for CREDENTIALS_TTL seconds."""
+    cached = _CREDENTIALS_CACHE.get(frappe.local.site)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    settings = frappe.db.get_value("WhatsApp Settings", None, ["url", "version", "phone_id"], as_dict=True)
+    settings.token = get_decrypted_password("WhatsApp Settings", "WhatsApp Settings", "token")
+    _CREDENTIALS_CACHE[frappe.local.site] = (time.monotonic() + CREDENTIALS_TTL, settings)
+    return settings
+
+def clear_whatsapp_credentials():
+    """Drop this worker's cached credentials for the current site."""
+    _CREDENTIALS_CACHE.pop(frappe.local.site, None)
 
 @frappe.whitelist()
 def send_template(to, reference_doctype, reference_name, template):
@@ -358,21 +506,43 @@ def send_template(to, reference_doctype, reference_name, template):
             "template": template
         })
 
+        # Send from a background job so the request doesn't wait on the Graph API
+        doc.flags.defer_notify = True
         doc.save()
+        enqueue(method=send_deferred_template, whatsapp_message=doc.name, user=frappe.session.user, queue="short", is_async=True, enqueue_after_commit=True)
+        return doc.name
     except Exception as e:
         raise e
 
+def send_deferred_template(whatsapp_message, user=None):
+    """Send a template message that was saved with notify deferred (background job)."""
+    doc = frappe.get_doc("WhatsApp Message", whatsapp_message)
+    try:
+        doc.send_template()
+    except Exception as e:
+        # the request that queued this has already returned, so mark the row and tell the sender here
+        frappe.log_error(title="WhatsApp Template Send Failed", message=frappe.get_traceback())
+        doc.db_set("status", "Failed")
+        if user:
+            frappe.publish_realtime("msgprint", f"Failed to send WhatsApp template to {doc.to}: {str(e)}", user=user)
+        return
+
+    doc.db_set({
+        "message_id": doc.message_id,
+        "template_parameters": doc.template_parameters,
+        "template_header_parameters": doc.template_header_parameters,
+    })
+
 def handle_outlet_frontdesk(message, frontdesk_whatsapp_id, crm_lead_doc):
-    front_desk_crm_lead_doc = get_crm_lead(frontdesk_whatsapp_id, frontdesk_whatsapp_id)
+    front_desk_crm_lead_doc = get_crm_lead(frontdesk_whatsapp_id, frontdesk_whatsapp_id, minimal=True)
     customer_whatsapp_id = normalize_phone_number(message)
     if not validate_phone_number(customer_whatsapp_id):
-        enqueue(method=send_message_with_delay, crm_lead_doc=front_desk_crm_lead_doc, whatsapp_id=frontdesk_whatsapp_id, text=PLEASE_KEY_IN_VALID_MOBILE_NO_MESSAGE, queue="short", is_async=True)
+        enqueue(method=send_message, crm_lead_doc=front_desk_crm_lead_doc, whatsapp_id=frontdesk_whatsapp_id, text=PLEASE_KEY_IN_VALID_MOBILE_NO_MESSAGE, queue="short", is_async=True, enqueue_after_commit=True)
         return
-    settings = frappe.get_single("WhatsApp Settings")
-    token = settings.get_password("token")
-    whatsapp_message_template_doc = frappe.get_doc("WhatsApp Message Templates", "outlet_frontdesk_request")
+    settings = get_whatsapp_credentials()
+    whatsapp_message_template_doc = frappe.get_cached_doc("WhatsApp Message Templates", "outlet_frontdesk_request")
     headers = {
-        "authorization": f"Bearer {token}",
+        "authorization": f"Bearer {settings.token}",
         "content-type": "application/json",
     }
     parameters = []
@@ -408,10 +578,10 @@ def handle_outlet_frontdesk(message, frontdesk_whatsapp_id, crm_lead_doc):
                 ],
             },
         }
-        response = make_post_request(
+        response = post_json(
             f"{settings.url}/{settings.version}/{settings.phone_id}/messages",
             headers=headers,
-            data=json.dumps(data),
+            data=data,
         )
         message_id = response["messages"][0]["id"]
         doc = frappe.new_doc("WhatsApp Message")
@@ -430,12 +600,11 @@ def handle_outlet_frontdesk(message, frontdesk_whatsapp_id, crm_lead_doc):
             }
         )
         doc.flags.is_template_queue = True
-        doc.insert(ignore_permissions=True)
-        frappe.db.commit()
-        enqueue(method=send_message_with_delay, crm_lead_doc=front_desk_crm_lead_doc, whatsapp_id=frontdesk_whatsapp_id, text=SUCCESSFULLY_NOTIFIED_CUSTOMER_MESSAGE, queue="short", is_async=True)
+        # reference and template were just loaded, so skip re-checking the links
+        doc.insert(ignore_permissions=True, ignore_links=True)
+        enqueue(method=send_message, crm_lead_doc=front_desk_crm_lead_doc, whatsapp_id=frontdesk_whatsapp_id, text=SUCCESSFULLY_NOTIFIED_CUSTOMER_MESSAGE, queue="short", is_async=True, enqueue_after_commit=True)
 
     except Exception as e:
-        frappe.db.commit()
         frappe.log_error(title="Error", message=str(e))
 
 def normalize_phone_number(number: str) -> str:
@@ -443,12 +612,8 @@ def normalize_phone_number(number: str) -> str:
     Remove all non-digit characters and optionally normalize.
     If number starts with '01', prepend '6'.
     """
-    digits = re.sub(r'\D', '', number)
-    
-    if digits.startswith('01'):
-        digits = '6' + digits
-
-    return digits
+    digits = NON_DIGIT_RE.sub('', number)
+    return '6' + digits if digits.startswith('01') else digits
 
 def validate_phone_number(cleaned_number: str) -> bool:
     """
@@ -506,7 +671,7 @@ def handle_clock_in_api(staff_doc, whatsapp_id, clock_details):
         }
 
         try:
-            response = requests.post(
+            response = _SESSION.post(
                 url,
                 data=json.dumps(request_body, default=str),
                 headers=headers,
@@ -770,7 +935,7 @@ def send_staff_hr_menu(crm_lead_doc, whatsapp_id):
     ]
 
     enqueue(
-        method=send_interactive_list_message_with_delay,
+        method=send_interactive_list_message,
         crm_lead_doc=crm_lead_doc,
         whatsapp_id=whatsapp_id,
         header_text="Staff Menu",
@@ -779,7 +944,8 @@ def send_staff_hr_menu(crm_lead_doc, whatsapp_id):
         button_text="View Menu",
         sections=sections,
         queue="short",
-        is_async=True
+        is_async=True,
+        enqueue_after_commit=True
     )
 
 
@@ -876,12 +1042,13 @@ def handle_outlet_staff_hr(whatsapp_message, crm_lead_doc):
                 )
 
             enqueue(
-                method=send_message_with_delay,
+                method=send_message,
                 crm_lead_doc=crm_lead_doc,
                 whatsapp_id=whatsapp_id,
                 text=reply_text,
                 queue="short",
-                is_async=True
+                is_async=True,
+                enqueue_after_commit=True
             )
             return
         
@@ -930,12 +1097,13 @@ def handle_outlet_staff_hr(whatsapp_message, crm_lead_doc):
                 reply_msg = f"{'✅' if success else '❌'} {response_msg}"
 
                 enqueue(
-                    method=send_message_with_delay,
+                    method=send_message,
                     crm_lead_doc=crm_lead_doc,
                     whatsapp_id=whatsapp_id,
                     text=reply_msg,
                     queue="short",
-                    is_async=True
+                    is_async=True,
+                    enqueue_after_commit=True
                 )
 
             except Exception as e:
@@ -946,12 +1114,13 @@ def handle_outlet_staff_hr(whatsapp_message, crm_lead_doc):
                 set_face_registration_mode(crm_lead_doc, enabled=False)
 
                 enqueue(
-                    method=send_message_with_delay,
+                    method=send_message,
                     crm_lead_doc=crm_lead_doc,
                     whatsapp_id=whatsapp_id,
                     text="❌ Failed to register face. Please try again with a clear selfie photo.",
                     queue="short",
-                    is_async=True
+                    is_async=True,
+                    enqueue_after_commit=True
                 )
 
             return
@@ -978,7 +1147,8 @@ def handle_text_message_ai(message, whatsapp_id, customer_name, crm_lead_doc=Non
     """
 
     try:
-        print(f"AI message handler started for message: {message[:50]}...", "WhatsApp AI Debug")
+        # Lowered once for every keyword check below
+        message_lower = message.lower().strip()
 
         # # Check if AI is enabled in site config
         # ai_enabled = frappe.conf.get("whatsapp_ai_enabled", False)
@@ -987,18 +1157,17 @@ def handle_text_message_ai(message, whatsapp_id, customer_name, crm_lead_doc=Non
 
         # Get or create CRM lead if not provided
         if not crm_lead_doc:
-            frappe.log_error("Getting CRM lead", "WhatsApp AI Debug")
+            log_ai_debug("Getting CRM lead", "WhatsApp AI Debug")
             crm_lead_doc = get_crm_lead(whatsapp_id, customer_name)
 
         # Get any pending booking data from previous messages
         pending_data = get_pending_booking_data(crm_lead_doc)
 
         # Get chat history for context-aware extraction
-        from crm.api.whatsapp import get_whatsapp_messages
         chat_history = get_whatsapp_messages("CRM Lead", crm_lead_doc.name)
 
         # Log for debugging
-        frappe.log_error("Booking Flow Debug", f"Pending data for {whatsapp_id}:\n{json.dumps(pending_data, indent=2, default=str)}\n\nChat history messages: {len(chat_history)}")
+        log_ai_debug("Booking Flow Debug", "Pending data for %s:\n%s\n\nChat history messages: %s", whatsapp_id, pending_data, len(chat_history))
 
         # PRIORITY 0: Check if user is just acknowledging a confirmed booking
         # If booking was recently confirmed and user sends simple acknowledgment like "ok thanks", "tq", etc.
@@ -1015,17 +1184,15 @@ def handle_text_message_ai(message, whatsapp_id, customer_name, crm_lead_doc=Non
 
         if booking_was_confirmed and not is_awaiting_action:
             # Use LLM to detect if this is a simple acknowledgment
-            from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.agents.rag_chain import detect_yes_no_with_llm
             detection_result = detect_yes_no_with_llm(message)
 
             # Check if message is acknowledgment (not yes/no response, just thanks/ok)
-            message_lower = message.lower().strip()
             acknowledgment_keywords = ['thank', 'thanks', 'tq', 'ty', 'noted', 'got it', 'terima kasih']
             is_acknowledgment = any(keyword in message_lower for keyword in acknowledgment_keywords)
 
             # If it's a simple acknowledgment or non-yes/no short message (under 20 chars)
             if is_acknowledgment or (detection_result == 'other' and len(message) <= 20):
-                frappe.log_error(
+                log_ai_debug(
                     "Simple Acknowledgment After Booking",
                     f"User sent simple acknowledgment after confirmed booking: {message}\n"
                     f"Detection: {detection_result}\n"
@@ -1034,16 +1201,15 @@ def handle_text_message_ai(message, whatsapp_id, customer_name, crm_lead_doc=Non
 
                 # Send simple polite response
                 polite_response = "You're welcome! If you need anything else or have questions, feel free to ask. Have a great day! 😊"
-                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=polite_response, queue="short", is_async=True)
+                enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=polite_response, queue="short", is_async=True, enqueue_after_commit=True)
                 return
 
         # PRIORITY 1: Check for CANCEL intent (highest priority, immediate action)
-        from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.agents.rag_chain import has_cancel_intent
         user_wants_to_cancel = has_cancel_intent(message)
 
         if user_wants_to_cancel and pending_data:
             # User wants to cancel their booking
-            frappe.log_error("Booking Cancellation", f"User wants to cancel booking for {whatsapp_id}")
+            log_ai_debug("Booking Cancellation", f"User wants to cancel booking for {whatsapp_id}")
 
             try:
                 # Get booking reference from pending data
@@ -1051,7 +1217,7 @@ def handle_text_message_ai(message, whatsapp_id, customer_name, crm_lead_doc=Non
 
                 # Call mock cancellation API
                 cancel_response = handle_cancel_booking_api_mock(crm_lead_doc, whatsapp_id, booking_reference)
-                frappe.log_error("Cancellation Response", f"Mock API response: {json.dumps(cancel_response, default=str)}")
+                log_ai_debug("Cancellation Response", "Mock API response: %s", cancel_response)
 
                 # Clear pending booking data
                 clear_pending_booking_data(crm_lead_doc)
@@ -1064,17 +1230,16 @@ Cancelled At: {cancel_response['data']['cancelled_at']}
 
 If you'd like to make a new booking in the future, just let us know! 💚"""
 
-                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=cancel_msg, queue="short", is_async=True)
+                enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=cancel_msg, queue="short", is_async=True, enqueue_after_commit=True)
                 return
 
             except Exception as cancel_error:
                 frappe.log_error("Cancellation Error", f"Error cancelling booking: {str(cancel_error)}\n{frappe.get_traceback()}")
                 error_msg = "❌ Sorry, there was an error cancelling your booking. Please contact our outlet directly. Thank you! 🙏"
-                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=error_msg, queue="short", is_async=True)
+                enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=error_msg, queue="short", is_async=True, enqueue_after_commit=True)
                 return
 
         # PRIORITY 2: Check for UPDATE intent using LLM (before new booking flow)
-        from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.agents.rag_chain import detect_update_intent_with_llm
 
         # Only check for update if there's existing confirmed booking data
         # Check if booking was previously confirmed (not just pending)
@@ -1082,7 +1247,7 @@ If you'd like to make a new booking in the future, just let us know! 💚"""
 
         # First check if we're waiting for UPDATE confirmation
         if booking_was_confirmed and pending_data.get('awaiting_update_confirmation'):
-            frappe.log_error(
+            log_ai_debug(
                 "Awaiting Update Confirmation",
                 f"User previously requested update - checking their response\n"
                 f"Message: {message}"
@@ -1090,11 +1255,11 @@ If you'd like to make a new booking in the future, just let us know! 💚"""
 
             # FIRST: Check if user is asking a general question instead of confirming
             # This allows flexible conversation even while waiting for update confirmation
-            from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.agents.rag_chain import classify_message_intent_with_llm
             update_msg_intent = classify_message_intent_with_llm(message, has_pending_booking=True)
+            update_reply = classify_yes_no(message, context='awaiting_update') if update_msg_intent != 'question' else None
 
             if update_msg_intent == 'question':
-                frappe.log_error(
+                log_ai_debug(
                     "General Question During Update Confirmation",
                     f"LLM classified as question while awaiting update confirmation\n"
                     f"Message: {message}\n"
@@ -1103,9 +1268,9 @@ If you'd like to make a new booking in the future, just let us know! 💚"""
                 # Skip all booking logic - fall through to RAG chain
                 # The awaiting_update_confirmation flag stays True for next message
 
-            elif is_confirmation_message(message, context='awaiting_update'):
+            elif update_reply == 'yes':
                 # User confirmed the update - proceed with API call
-                frappe.log_error("Update Confirmed", f"User confirmed update for {whatsapp_id}")
+                log_ai_debug("Update Confirmed", f"User confirmed update for {whatsapp_id}")
 
                 try:
                     pending_update_fields = pending_data.get('pending_update_fields', {})
@@ -1128,16 +1293,17 @@ If you'd like to make a new booking in the future, just let us know! 💚"""
 
                     # Call edit_booking API
                     order_ids = pending_data.get('order_ids') or booking_reference
-                    frappe.log_error(
+                    log_ai_debug(
                         "edit_booking API Call",
-                        f"order_ids: {order_ids}\n"
-                        f"edit_booking_details: {json.dumps(edit_booking_details, indent=2, default=str)}"
+                        "order_ids: %s\n"
+                        "edit_booking_details: %s",
+                        order_ids, edit_booking_details
                     )
                     update_response = edit_booking(
                         order_ids=order_ids,
                         booking_details=edit_booking_details,
                     )
-                    frappe.log_error("Update API Response", f"edit_booking response: {json.dumps(update_response, default=str)}")
+                    log_ai_debug("Update API Response", "edit_booking response: %s", update_response)
 
                     # Handle failed update
                     if update_response and update_response.get("success") == False:
@@ -1147,7 +1313,7 @@ If you'd like to make a new booking in the future, just let us know! 💚"""
                         if 'pending_update_fields' in pending_data:
                             del pending_data['pending_update_fields']
                         save_pending_booking_data(crm_lead_doc, pending_data)
-                        enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=error_msg, queue="short", is_async=True)
+                        enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=error_msg, queue="short", is_async=True, enqueue_after_commit=True)
                         return
 
                     # Save updated booking data
@@ -1158,30 +1324,27 @@ If you'd like to make a new booking in the future, just let us know! 💚"""
                     save_pending_booking_data(crm_lead_doc, updated_booking)
 
                     # Build success message
-                    update_summary = f"""✅ Booking Updated Successfully!
-
-📋 Updated Booking Details:
-- Outlet: {updated_booking.get('outlet')}
-- Date: {updated_booking.get('booking_date')}
-- Time: {updated_booking.get('timeslot')}
-- Treatment: {edit_booking_details.get('treatment')}
-- Duration: {updated_booking.get('session')} minutes
-- Preferred Therapist: {edit_booking_details.get('preferred_therapist')}
-
-Thank you for updating your booking with HealthLand! 💚"""
+                    update_summary = BOOKING_UPDATED_MESSAGE.format(
+                        outlet=updated_booking.get('outlet'),
+                        booking_date=updated_booking.get('booking_date'),
+                        timeslot=updated_booking.get('timeslot'),
+                        treatment=edit_booking_details.get('treatment'),
+                        session=updated_booking.get('session'),
+                        preferred_therapist=edit_booking_details.get('preferred_therapist')
+                    )
 
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=update_summary, queue="short", is_async=True)
+                    enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=update_summary, queue="short", is_async=True, enqueue_after_commit=True)
                     return
 
                 except Exception as update_error:
                     frappe.log_error("Update Error", f"Error updating booking: {str(update_error)}\n{frappe.get_traceback()}")
                     error_msg = "❌ Sorry, there was an error updating your booking. Please contact our outlet directly or try again. Thank you! 🙏"
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=error_msg, queue="short", is_async=True)
+                    enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=error_msg, queue="short", is_async=True, enqueue_after_commit=True)
                     return
 
-            elif is_change_request(message, context='awaiting_update'):
+            elif update_reply == 'no':
                 # User said no - cancel the update
-                frappe.log_error("Update Cancelled", f"User cancelled update for {whatsapp_id}")
+                log_ai_debug("Update Cancelled", f"User cancelled update for {whatsapp_id}")
 
                 # Clear the update flags
                 pending_data['awaiting_update_confirmation'] = False
@@ -1190,13 +1353,13 @@ Thank you for updating your booking with HealthLand! 💚"""
                 save_pending_booking_data(crm_lead_doc, pending_data)
 
                 cancel_msg = "No problem! Your booking update has been cancelled. Your original booking details remain unchanged. If you'd like to try updating again, just let me know! 😊"
-                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=cancel_msg, queue="short", is_async=True)
+                enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=cancel_msg, queue="short", is_async=True, enqueue_after_commit=True)
                 return
 
             else:
                 # Unclear response - remind them
                 reminder_msg = "Please reply with 'Yes' to confirm the update, or 'No' to cancel. 🙏"
-                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=reminder_msg, queue="short", is_async=True)
+                enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=reminder_msg, queue="short", is_async=True, enqueue_after_commit=True)
                 return
 
         # Check if user is selecting a booking to edit (from previously shown list)
@@ -1208,7 +1371,7 @@ Thank you for updating your booking with HealthLand! 💚"""
                     selected_key = number_match.group()
                     if selected_key in fetched_bookings_map:
                         selected_booking = fetched_bookings_map[selected_key]
-                        frappe.log_error("Edit Booking Selected", f"User selected booking #{selected_key}: {json.dumps(selected_booking, default=str)}")
+                        log_ai_debug("Edit Booking Selected", "User selected booking #%s: %s", selected_key, selected_booking)
 
                         # Save the selected booking as the active pending data for editing
                         edit_data = {
@@ -1232,8 +1395,7 @@ Thank you for updating your booking with HealthLand! 💚"""
                         # Ask what they want to change
                         # Format timeslot for display
                         try:
-                            from datetime import datetime as dt
-                            t = dt.strptime(str(selected_booking.get('timeslot', '')), "%H:%M:%S")
+                            t = datetime.datetime.strptime(str(selected_booking.get('timeslot', '')), "%H:%M:%S")
                             time_display = t.strftime("%-I:%M%p").lower()
                         except Exception:
                             time_display = selected_booking.get('timeslot', '')
@@ -1254,12 +1416,12 @@ For example:
 • _"Change outlet to Puchong"_
 • _"Change to tomorrow at 2pm"_"""
 
-                        enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=booking_summary, queue="short", is_async=True)
+                        enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=booking_summary, queue="short", is_async=True, enqueue_after_commit=True)
                         return
 
                 # User didn't pick a valid number
                 reminder_msg = "Please reply with the *number* of the booking you'd like to edit (e.g. *1*, *2*, *3*...) 🙏"
-                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=reminder_msg, queue="short", is_async=True)
+                enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=reminder_msg, queue="short", is_async=True, enqueue_after_commit=True)
                 return
 
         # Detect update intent - check even without local confirmed booking data
@@ -1270,12 +1432,13 @@ For example:
             # User wants to update their existing booking
             updated_fields = update_detection.get('updated_fields', {})
 
-            frappe.log_error(
+            log_ai_debug(
                 "Booking Update",
-                f"User wants to update booking for {whatsapp_id}\n"
-                f"Update type: {update_detection['update_type']}\n"
-                f"Updated fields: {json.dumps(updated_fields, indent=2, default=str)}\n"
-                f"booking_was_confirmed: {booking_was_confirmed}"
+                "User wants to update booking for %s\n"
+                "Update type: %s\n"
+                "Updated fields: %s\n"
+                "booking_was_confirmed: %s",
+                whatsapp_id, update_detection['update_type'], updated_fields, booking_was_confirmed
             )
 
             # If user already has a confirmed booking selected and provided specific fields,
@@ -1291,62 +1454,41 @@ For example:
                         timeslot_validation = validate_booking_timeslot(updated_booking.get('timeslot'))
 
                         if not timeslot_validation['valid']:
-                            frappe.log_error(
+                            log_ai_debug(
                                 "Invalid Update Time",
                                 f"Customer tried to update booking to {updated_booking.get('timeslot')} which is outside operating hours\n"
                                 f"Sending message: {timeslot_validation['message']}"
                             )
-                            enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=timeslot_validation['message'], queue="short", is_async=True)
+                            enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=timeslot_validation['message'], queue="short", is_async=True, enqueue_after_commit=True)
                             return
 
                     # Get booking reference
                     booking_reference = pending_data.get('booking_reference')
 
                     # Build list of what changed
-                    changes_list = []
-                    for field, new_value in updated_fields.items():
-                        old_value = pending_data.get(field)
-                        field_labels = {
-                            'booking_date': 'Date',
-                            'timeslot': 'Time',
-                            'outlet': 'Outlet',
-                            'pax': 'Number of People',
-                            'treatment_type': 'Treatment',
-                            'session': 'Duration',
-                            'preferred_masseur': 'Masseur Preference',
-                            'customer_name': 'Name',
-                            'phone': 'Phone'
-                        }
-                        field_label = field_labels.get(field, field)
-                        changes_list.append(f"• {field_label}: {old_value} → {new_value}")
-
-                    changes_summary = "\n".join(changes_list)
-
-                    update_confirmation_msg = f"""📋 Please confirm your booking update:
-
-🔄 Changes:
-{changes_summary}
-
-📋 Updated Booking Details:
-- Outlet: {updated_booking.get('outlet')}
-- Date: {updated_booking.get('booking_date')}
-- Time: {updated_booking.get('timeslot')}
-- Treatment: {updated_booking.get('treatment_type')}
-- Duration: {updated_booking.get('session')} minutes
-- Preferred Therapist: {updated_booking.get('preferred_masseur')}
+                    changes_summary = "\n".join(
+                        f"• {BOOKING_FIELD_LABELS.get(field, field)}: {pending_data.get(field)} → {new_value}"
+                        for field, new_value in updated_fields.items()
+                    )
 
-Is this correct? Please reply:
-✅ *Yes* to confirm update
-❌ *No* to remain unchanged"""
+                    update_confirmation_msg = BOOKING_UPDATE_CONFIRMATION_MESSAGE.format(
+                        changes_summary=changes_summary,
+                        outlet=updated_booking.get('outlet'),
+                        booking_date=updated_booking.get('booking_date'),
+                        timeslot=updated_booking.get('timeslot'),
+                        treatment=updated_booking.get('treatment_type'),
+                        session=updated_booking.get('session'),
+                        preferred_therapist=updated_booking.get('preferred_masseur')
+                    )
 
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=update_confirmation_msg, queue="short", is_async=True)
+                    enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=update_confirmation_msg, queue="short", is_async=True, enqueue_after_commit=True)
 
                     # Save update intent for next message
                     updated_booking['awaiting_update_confirmation'] = True
                     updated_booking['pending_update_fields'] = updated_fields
                     save_pending_booking_data(crm_lead_doc, updated_booking)
 
-                    frappe.log_error(
+                    log_ai_debug(
                         "Update Confirmation Shown",
                         f"Showing update confirmation to user\n"
                         f"Changes: {changes_summary}\n"
@@ -1357,22 +1499,20 @@ Is this correct? Please reply:
                 except Exception as update_error:
                     frappe.log_error("Update Error", f"Error updating booking: {str(update_error)}\n{frappe.get_traceback()}")
                     error_msg = "❌ Sorry, there was an error updating your booking. Please contact our outlet directly or try again. Thank you! 🙏"
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=error_msg, queue="short", is_async=True)
+                    enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=error_msg, queue="short", is_async=True, enqueue_after_commit=True)
                     return
 
             # No active booking selected yet — fetch all future bookings from API
-            frappe.log_error(
+            log_ai_debug(
                 "Update Request - Fetching Bookings",
                 f"User wants to update booking. Fetching bookings for {whatsapp_id}"
             )
 
             try:
-                from crm.api.whatsapp import fetch_bookings
                 bookings_response = fetch_bookings(whatsapp_id)
                 all_bookings = bookings_response.get('bookings', []) if bookings_response else []
 
                 # Filter for future bookings only
-                from datetime import datetime as dt
                 today_str = frappe.utils.today()
                 future_bookings = []
                 for b in all_bookings:
@@ -1380,15 +1520,16 @@ Is this correct? Please reply:
                     if booking_date and str(booking_date) >= today_str:
                         future_bookings.append(b)
 
-                frappe.log_error(
+                log_ai_debug(
                     "Fetched Bookings",
-                    f"Total bookings: {len(all_bookings)}, Future bookings: {len(future_bookings)}\n"
-                    f"Bookings: {json.dumps(future_bookings, indent=2, default=str)}"
+                    "Total bookings: %s, Future bookings: %s\n"
+                    "Bookings: %s",
+                    len(all_bookings), len(future_bookings), future_bookings
                 )
 
                 if not future_bookings:
                     no_booking_msg = "You don't have any upcoming bookings to update. Would you like to make a new booking instead? 😊"
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=no_booking_msg, queue="short", is_async=True)
+                    enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=no_booking_msg, queue="short", is_async=True, enqueue_after_commit=True)
                     return
 
                 if len(future_bookings) == 1:
@@ -1415,30 +1556,21 @@ Is this correct? Please reply:
                     save_pending_booking_data(crm_lead_doc, edit_data)
 
                     try:
-                        t = dt.strptime(str(booking.get('timeslot', '')), "%H:%M:%S")
+                        t = datetime.datetime.strptime(str(booking.get('timeslot', '')), "%H:%M:%S")
                         time_display = t.strftime("%-I:%M%p").lower()
                     except Exception:
                         time_display = booking.get('timeslot', '')
 
-                    current_booking_summary = f"""Sure! I can help you update your booking.
-
-📋 Your Upcoming Booking:
-- Outlet: {booking.get('outlet')}
-- Date: {booking.get('booking_date')}
-- Time: {time_display}
-- Treatment: {booking.get('treatment')}
-- Duration: {booking.get('session')} mins
-- Therapist: {booking.get('preferred_therapist')}
-
-What would you like to change? Just tell me in your own words! 😊
-
-For example:
-• _"Change date to 5th April"_
-• _"Change time to 3pm"_
-• _"Change outlet to Puchong"_
-• _"Change to tomorrow at 2pm"_"""
+                    current_booking_summary = UPCOMING_BOOKING_EDIT_MESSAGE.format(
+                        outlet=booking.get('outlet'),
+                        booking_date=booking.get('booking_date'),
+                        timeslot=time_display,
+                        treatment=booking.get('treatment'),
+                        session=booking.get('session'),
+                        preferred_therapist=booking.get('preferred_therapist')
+                    )
 
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=current_booking_summary, queue="short", is_async=True)
+                    enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=current_booking_summary, queue="short", is_async=True, enqueue_after_commit=True)
                     return
 
                 else:
@@ -1453,7 +1585,7 @@ For example:
                         num = idx + 1
 
                         try:
-                            t = dt.strptime(str(booking.get('timeslot', '')), "%H:%M:%S")
+                            t = datetime.datetime.strptime(str(booking.get('timeslot', '')), "%H:%M:%S")
                             time_display = t.strftime("%-I:%M%p").lower()
                         except Exception:
                             time_display = booking.get('timeslot', '')
@@ -1472,7 +1604,7 @@ For example:
                     selection_data['fetched_bookings_map'] = fetched_bookings_map
                     save_pending_booking_data(crm_lead_doc, selection_data)
 
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=bookings_msg, queue="short", is_async=True)
+                    enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=bookings_msg, queue="short", is_async=True, enqueue_after_commit=True)
                     return
 
             except Exception as fetch_error:
@@ -1481,19 +1613,20 @@ For example:
                     f"Error fetching bookings for update: {str(fetch_error)}\n{frappe.get_traceback()}"
                 )
                 # Fallback to showing pending_data if fetch fails
+                current = pending_data.get if pending_data else dict.fromkeys(BOOKING_SUMMARY_DEFAULTS, 'N/A').get
                 current_booking_summary = f"""Sure! I can help you update your booking.
 
 📋 Your Current Booking:
-- Booking Reference: {pending_data.get('booking_reference', 'N/A') if pending_data else 'N/A'}
-- Name: {pending_data.get('customer_name') if pending_data else 'N/A'}
-- Phone: {pending_data.get('phone') if pending_data else 'N/A'}
-- Outlet: {pending_data.get('outlet') if pending_data else 'N/A'}
-- Date: {pending_data.get('booking_date') if pending_data else 'N/A'}
-- Time: {pending_data.get('timeslot') if pending_data else 'N/A'}
-- Pax: {pending_data.get('pax') if pending_data else 'N/A'}
-- Treatment: {pending_data.get('treatment_type') if pending_data else 'N/A'}
-- Duration: {pending_data.get('session') if pending_data else 'N/A'} minutes
-- Preferred Masseur: {pending_data.get('preferred_masseur') if pending_data else 'N/A'}
+- Booking Reference: {current('booking_reference', 'N/A')}
+- Name: {current('customer_name')}
+- Phone: {current('phone')}
+- Outlet: {current('outlet')}
+- Date: {current('booking_date')}
+- Time: {current('timeslot')}
+- Pax: {current('pax')}
+- Treatment: {current('treatment_type')}
+- Duration: {current('session')} minutes
+- Preferred Masseur: {current('preferred_masseur')}
 
 What would you like to change? You can update:
 • Date and/or Time
@@ -1506,13 +1639,11 @@ What would you like to change? You can update:
 
 Please let me know what you'd like to update! 😊"""
 
-                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=current_booking_summary, queue="short", is_async=True)
+                enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=current_booking_summary, queue="short", is_async=True, enqueue_after_commit=True)
                 return
 
         # PRIORITY 2.5: Slot selection flow (when booking failed and suggested slots were offered)
         if pending_data and pending_data.get('awaiting_slot_selection'):
-            message_lower = message.lower().strip()
-
             # Detect which slot the customer chose (numbered slots)
             selected_slot = None
             slot_label = None
@@ -1537,9 +1668,10 @@ Please let me know what you'd like to update! 😊"""
                     slot_label = "Slot 2"
 
             if selected_slot:
-                frappe.log_error(
+                log_ai_debug(
                     "Slot Selection",
-                    f"Customer chose {slot_label}: {json.dumps(selected_slot, default=str)}"
+                    "Customer chose %s: %s",
+                    slot_label, selected_slot
                 )
 
                 try:
@@ -1566,11 +1698,7 @@ Please let me know what you'd like to update! 😊"""
                         "package": str(raw_package).lower() not in ("no", "false", "0", ""),
                     }
 
-                    print("=== DEBUG create_booking (slot selection) ===")
-                    print(f"crm_lead={crm_lead_doc.name}")
-                    print(f"booking_details={json.dumps(slot_booking_details, default=str)}")
-                    print(f"message={message}")
-                    print("=== END DEBUG ===")
+                    log_ai_debug("create_booking (slot selection)", "crm_lead=%s\nbooking_details=%s\nmessage=%s", crm_lead_doc.name, slot_booking_details, message)
 
                     api_response = create_booking(
                         crm_lead=crm_lead_doc.name,
@@ -1586,17 +1714,18 @@ Please let me know what you'd like to update! 😊"""
                         # Clear slot selection state
                         pending_data['awaiting_slot_selection'] = False
                         save_pending_booking_data(crm_lead_doc, pending_data)
-                        enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=error_msg, queue="short", is_async=True)
+                        enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=error_msg, queue="short", is_async=True, enqueue_after_commit=True)
                         return
 
                     # Success - get booking reference
-                    booking_reference = api_response.get('booking_reference') or api_response.get('data', {}).get('booking_reference', f"BKG{frappe.utils.now_datetime().strftime('%Y%m%d%H%M%S')}")
+                    now = frappe.utils.now_datetime()
+                    booking_reference = api_response.get('booking_reference') or api_response.get('data', {}).get('booking_reference', f"BKG{now.strftime('%Y%m%d%H%M%S')}")
 
                     # Save confirmed booking data
                     confirmed_data = pending_data.copy()
                     confirmed_data['confirmed'] = True
                     confirmed_data['booking_reference'] = booking_reference
-                    confirmed_data['confirmed_at'] = frappe.utils.now_datetime().isoformat()
+                    confirmed_data['confirmed_at'] = now.isoformat()
                     confirmed_data['awaiting_slot_selection'] = False
                     confirmed_data['booking_date'] = slot_booking_details.get('booking_date')
                     confirmed_data['timeslot'] = slot_booking_details.get('timeslot')
@@ -1608,19 +1737,17 @@ Please let me know what you'd like to update! 😊"""
                     # Use confirmation_message from API if available, otherwise build our own
                     confirmation_msg = api_response.get('confirmation_message', '') if api_response else ''
                     if not confirmation_msg:
-                        confirmation_msg = (
-                            f"✅ Booking confirmed!\n\n"
-                            f"📋 Booking Reference: {booking_reference}\n"
-                            f"- Name: {pending_data.get('customer_name')}\n"
-                            f"- Date: {slot_booking_details.get('booking_date')}\n"
-                            f"- Time: {slot_booking_details.get('timeslot')}\n"
-                            f"- Treatment: {pending_data.get('treatment_type')}\n"
-                            f"- Duration: {pending_data.get('session')} minutes\n"
-                            f"- Pax: {slot_booking_details.get('pax')}\n\n"
-                            f"Thank you for choosing HealthLand! 💚"
+                        confirmation_msg = BOOKING_CONFIRMED_MESSAGE.format(
+                            booking_reference=booking_reference,
+                            customer_name=pending_data.get('customer_name'),
+                            booking_date=slot_booking_details.get('booking_date'),
+                            timeslot=slot_booking_details.get('timeslot'),
+                            treatment_type=pending_data.get('treatment_type'),
+                            session=pending_data.get('session'),
+                            pax=slot_booking_details.get('pax')
                         )
 
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=str(confirmation_msg), queue="short", is_async=True)
+                    enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=str(confirmation_msg), queue="short", is_async=True, enqueue_after_commit=True)
                     return
 
                 except Exception as slot_error:
@@ -1630,12 +1757,11 @@ Please let me know what you'd like to update! 😊"""
                     )
                     clear_pending_booking_data(crm_lead_doc)
                     error_msg = "❌ Sorry, there was an error processing your booking. Please contact our outlet directly or try again later. Thank you for your patience! 🙏"
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=error_msg, queue="short", is_async=True)
+                    enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=error_msg, queue="short", is_async=True, enqueue_after_commit=True)
                     return
 
         # PRIORITY 3: Normal booking flow (new bookings)
         # Use LLM to classify message intent - much smarter than keyword matching
-        from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.agents.rag_chain import classify_message_intent_with_llm
 
         has_specific_details = is_booking_details_message(message)
         has_pending_data = bool(pending_data and len(pending_data) > 0 and not booking_was_confirmed)
@@ -1647,7 +1773,7 @@ Please let me know what you'd like to update! 😊"""
         user_wants_to_book = llm_intent == 'booking' or detect_booking_intent_from_recent_context(chat_history, message)
         is_asking_question = llm_intent == 'question'
 
-        frappe.log_error(
+        log_ai_debug(
             "Booking Flow Debug",
             f"Booking triggers - LLM intent: {llm_intent}, Intent (last 3 msgs): {user_wants_to_book}, "
             f"Details: {has_specific_details}, Pending: {has_pending_data}, Question: {is_asking_question}"
@@ -1656,7 +1782,7 @@ Please let me know what you'd like to update! 😊"""
         # If LLM classified as question, skip booking flow and let RAG handle it
         # Only override if message has structured booking details (e.g., filled form)
         if is_asking_question and not has_specific_details:
-            frappe.log_error(
+            log_ai_debug(
                 "General Question Detected (LLM)",
                 f"LLM classified message as question\n"
                 f"Message: {message}\n"
@@ -1666,8 +1792,6 @@ Please let me know what you'd like to update! 😊"""
 
         # Trigger booking flow if user wants to book, has specific details, or has pending data
         elif user_wants_to_book or has_specific_details or has_pending_data:
-            print("Booking flow triggered - extracting from conversation history", "WhatsApp AI Debug")
-
             # Extract booking information using LLM + regex
             # LLM scans ENTIRE conversation history to find all mentioned fields
             # This allows "I want to book" to work even if details were mentioned earlier
@@ -1676,16 +1800,15 @@ Please let me know what you'd like to update! 😊"""
             missing_fields = extraction_result['missing_fields']
             is_complete = extraction_result['is_complete']
 
-            frappe.log_error(
+            log_ai_debug(
                 "Booking Extraction Debug",
-                f"Booking Intent: {user_wants_to_book}\n"
-                f"Current Message: {message}\n"
-                f"Extracted from conversation: {json.dumps(booking_data, indent=2, default=str)}\n"
-                f"Missing fields: {missing_fields}\n"
-                f"Complete: {is_complete}"
+                "Booking Intent: %s\n"
+                "Current Message: %s\n"
+                "Extracted from conversation: %s\n"
+                "Missing fields: %s\n"
+                "Complete: %s",
+                user_wants_to_book, message, booking_data, missing_fields, is_complete
             )
-            print(f"Extracted data from conversation: {json.dumps(booking_data, default=str)}", "WhatsApp Booking Debug")
-            print(f"Missing fields: {missing_fields}", "WhatsApp Booking Debug")
 
             if is_complete:
                 # All required fields are present
@@ -1694,7 +1817,7 @@ Please let me know what you'd like to update! 😊"""
 
                 if not timeslot_validation['valid']:
                     # Timeslot is outside operating hours - inform customer and ask for new time
-                    frappe.log_error(
+                    log_ai_debug(
                         "Invalid Booking Time",
                         f"Customer tried to book at {booking_data.get('timeslot')} which is outside operating hours\n"
                         f"Sending message: {timeslot_validation['message']}"
@@ -1705,36 +1828,30 @@ Please let me know what you'd like to update! 😊"""
                     save_pending_booking_data(crm_lead_doc, booking_data)
 
                     # Send the validation error message
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=timeslot_validation['message'], queue="short", is_async=True)
+                    enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=timeslot_validation['message'], queue="short", is_async=True, enqueue_after_commit=True)
                     return
 
                 # CRITICAL: Detect if booking details have CHANGED (new booking vs existing booking)
                 # If details changed, user needs to see NEW confirmation even if they confirmed before
 
                 # Compare key booking fields to detect if this is a NEW booking
-                booking_changed = False
+                changed_fields = []
                 if pending_data and pending_data.get('awaiting_confirmation'):
                     # Check if critical fields have changed
-                    key_fields = ['booking_date', 'timeslot', 'outlet', 'pax', 'treatment_type', 'session']
-                    for field in key_fields:
-                        old_value = pending_data.get(field)
-                        new_value = booking_data.get(field)
-                        if old_value != new_value:
-                            booking_changed = True
-                            frappe.log_error(
-                                "Booking Details Changed",
-                                f"Field '{field}' changed:\n"
-                                f"Old: {old_value}\n"
-                                f"New: {new_value}\n"
-                                f"This is a NEW booking - must show confirmation again!"
-                            )
-                            break
+                    changed_fields = [field for field in BOOKING_KEY_FIELDS if pending_data.get(field) != booking_data.get(field)]
+                    if changed_fields:
+                        log_ai_debug(
+                            "Booking Details Changed",
+                            "\n".join(f"Field '{field}' changed: {pending_data.get(field)} -> {booking_data.get(field)}" for field in changed_fields)
+                            + "\nThis is a NEW booking - must show confirmation again!"
+                        )
+                booking_changed = bool(changed_fields)
 
                 # Determine if we're waiting for confirmation
                 # If booking details changed, RESET awaiting_confirmation to False
                 if booking_changed:
                     awaiting_confirmation = False  # NEW booking - need to show confirmation
-                    frappe.log_error(
+                    log_ai_debug(
                         "New Booking Detected",
                         f"Booking details changed - resetting awaiting_confirmation to False\n"
                         f"User MUST confirm the new booking details"
@@ -1742,7 +1859,7 @@ Please let me know what you'd like to update! 😊"""
                 else:
                     awaiting_confirmation = pending_data.get('awaiting_confirmation', False) if pending_data else False
 
-                frappe.log_error(
+                log_ai_debug(
                     "Booking Confirmation Flow - IMPORTANT",
                     f"⭐ Booking is COMPLETE! ⭐\n"
                     f"Booking changed since last confirmation: {booking_changed}\n"
@@ -1754,9 +1871,25 @@ Please let me know what you'd like to update! 😊"""
 
                 # FIRST: Check if user is asking a general question instead of confirming
                 # This allows flexible conversation even while waiting for confirmation
-                confirm_msg_intent = classify_message_intent_with_llm(message, has_pending_booking=True)
-                if confirm_msg_intent == 'question' and awaiting_confirmation:
-                    frappe.log_error(
+                # A bare yes/no reply to the confirmation prompt is never a question or another topic
+                is_bare_reply = awaiting_confirmation and message_lower in BARE_REPLIES
+                confirm_msg_intent = classify_message_intent_with_llm(message, has_pending_booking=True) if awaiting_confirmation and not is_bare_reply else None
+
+                # Resolve this turn's state once, then dispatch on it below
+                if not awaiting_confirmation:
+                    turn_state = 'show_confirmation'
+                elif confirm_msg_intent == 'question':
+                    turn_state = 'question'
+                # Check if message is clearly about something OTHER than booking confirmation
+                # e.g., "ya share me the link", "yes tell me about packages", etc.
+                elif not is_bare_reply and NON_CONFIRMATION_RE.search(message):
+                    turn_state = 'other_topic'
+                else:
+                    # Message is NOT about other topics, so check if it's a confirmation response
+                    turn_state = CONFIRMATION_REPLY_STATES.get(classify_yes_no(message, context='awaiting_confirmation'), 'unclear')
+
+                if turn_state == 'question':
+                    log_ai_debug(
                         "General Question During Confirmation",
                         f"LLM classified as question while awaiting confirmation\n"
                         f"Message: {message}\n"
@@ -1765,356 +1898,276 @@ Please let me know what you'd like to update! 😊"""
                     # Skip all booking logic - fall through to RAG chain
                     # The awaiting_confirmation flag stays True for next message
 
-                elif awaiting_confirmation:
-                    # We already showed details, now check user's response
-                    # IMPORTANT: Only treat as confirmation/change if message is CLEARLY about booking
-                    # Not if it's asking about something else (e.g., "ya share me the link")
-
-                    message_lower = message.lower().strip()
-
-                    # Check if message is clearly about something OTHER than booking confirmation
-                    # e.g., "ya share me the link", "yes tell me about packages", etc.
-                    non_confirmation_patterns = [
-                        'link', 'share', 'send', 'tell me', 'what', 'where', 'how', 'when',
-                        'outlet', 'location', 'address', 'price', 'package', 'promotion',
-                        'discount', 'treatment', 'massage', 'service', 'available'
-                    ]
+                elif turn_state == 'other_topic':
+                    # User is asking about something else, not confirming booking
+                    # Treat as general question and answer via RAG
+                    log_ai_debug(
+                        "Non-Confirmation Message During Confirmation Wait",
+                        f"User said something that's not a booking confirmation: {message}\n"
+                        f"Treating as general question and keeping awaiting_confirmation=True"
+                    )
+                    # Skip all booking confirmation logic - fall through to RAG chain
+                    # awaiting_confirmation stays True for when they're ready to confirm
 
-                    # If message contains these keywords, it's likely NOT a booking confirmation
-                    is_about_other_topic = any(pattern in message_lower for pattern in non_confirmation_patterns)
+                elif turn_state == 'confirmed':
+                    # User confirmed - proceed with booking
+                    log_ai_debug("Booking Confirmation", f"User confirmed booking for {whatsapp_id}")
 
-                    if is_about_other_topic:
-                        # User is asking about something else, not confirming booking
-                        # Treat as general question and answer via RAG
+                    # CRITICAL SAFETY CHECK: Verify that awaiting_confirmation was previously set
+                    # This ensures confirmation was shown before calling API
+                    if not pending_data or not pending_data.get('awaiting_confirmation'):
                         frappe.log_error(
-                            "Non-Confirmation Message During Confirmation Wait",
-                            f"User said something that's not a booking confirmation: {message}\n"
-                            f"Treating as general question and keeping awaiting_confirmation=True"
+                            "⚠️ API CALL BLOCKED ⚠️",
+                            f"CRITICAL: Attempted to call API without proper confirmation!\n"
+                            f"awaiting_confirmation flag not found in pending_data\n"
+                            f"Showing confirmation now to be safe"
                         )
-                        # Skip all booking confirmation logic - fall through to RAG chain
-                        # awaiting_confirmation stays True for when they're ready to confirm
+                        # Show confirmation now as safety measure
+                        booking_data['awaiting_confirmation'] = True
+                        save_pending_booking_data(crm_lead_doc, booking_data)
 
-                    else:
-                        # Message is NOT about other topics, so check if it's a confirmation response
-                        if is_confirmation_message(message, context='awaiting_confirmation'):
-                            # User confirmed - proceed with booking
-                            frappe.log_error("Booking Confirmation", f"User confirmed booking for {whatsapp_id}")
-
-                            # CRITICAL SAFETY CHECK: Verify that awaiting_confirmation was previously set
-                            # This ensures confirmation was shown before calling API
-                            if not pending_data or not pending_data.get('awaiting_confirmation'):
-                                frappe.log_error(
-                                    "⚠️ API CALL BLOCKED ⚠️",
-                                    f"CRITICAL: Attempted to call API without proper confirmation!\n"
-                                    f"awaiting_confirmation flag not found in pending_data\n"
-                                    f"Showing confirmation now to be safe"
-                                )
-                                # Show confirmation now as safety measure
-                                booking_data['awaiting_confirmation'] = True
-                                save_pending_booking_data(crm_lead_doc, booking_data)
-
-                                safety_msg = f"""📋 Please confirm your booking details before we proceed:
-
-- Name: {booking_data.get('customer_name')}
-- Phone: {booking_data.get('phone')}
-- Outlet: {booking_data.get('outlet')}
-- Date: {booking_data.get('booking_date')}
-- Time: {booking_data.get('timeslot')}
-- Pax: {booking_data.get('pax')}
-- Treatment: {booking_data.get('treatment_type')}
-- Duration: {booking_data.get('session')} minutes
-- Preferred Masseur: {booking_data.get('preferred_masseur')}
-
-Is everything correct? Please reply:
-✅ *Yes* to confirm
-❌ *No* to make changes"""
-
-                                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=safety_msg, queue="short", is_async=True)
-                                return
-
-                            # Convert outlet shop_full_name to branch_code for the API
-                            outlet_name = booking_data.get("outlet")
-                            outlet_branch_code = frappe.db.get_value("Outlet", {"shop_full_name": outlet_name}, "branch_code") or outlet_name
-                            booking_data["outlet"] = outlet_branch_code
-
-                            # Log booking details one more time before API call for verification
+                        safety_msg = format_booking_summary(booking_data, "📋 Please confirm your booking details before we proceed:", BOOKING_CONFIRM_FOOTER, include_voucher=False)
+
+                        enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=safety_msg, queue="short", is_async=True, enqueue_after_commit=True)
+                        return
+
+                    # Convert outlet shop_full_name to branch_code for the API
+                    outlet_name = booking_data.get("outlet")
+                    outlet_branch_code = frappe.db.get_value("Outlet", {"shop_full_name": outlet_name}, "branch_code") or outlet_name
+                    booking_data["outlet"] = outlet_branch_code
+
+                    # Log booking details one more time before API call for verification
+                    log_ai_debug(
+                        "📋 CALLING API - BOOKING DETAILS",
+                        "User has confirmed. Calling booking API with:\n"
+                        "%s\n"
+                        "Confirmation was previously shown: %s",
+                        booking_data, pending_data.get('awaiting_confirmation') == True
+                    )
+
+                    try:
+                        outlet_name = booking_data.get("outlet")
+                        outlet_branch_code = frappe.db.get_value("Outlet", outlet_name, "branch_code") or outlet_name
+                        booking_data["outlet"] = outlet_branch_code
+                        # Map booking_data fields to the CRM create_booking API field names
+                        api_booking_details = {
+                            "customer_name": booking_data.get("customer_name"),
+                            "booking_mobile": whatsapp_id,
+                            "member_mobile": booking_data.get("phone"),
+                            "outlet": outlet_branch_code,
+                            "booking_date": booking_data.get("booking_date"),
+                            "timeslot": booking_data.get("timeslot"),
+                            "pax": booking_data.get("pax"),
+                            "treatment": booking_data.get("treatment_type"),
+                            "session": booking_data.get("session"),
+                            "preferred_therapist": booking_data.get("preferred_masseur"),
+                            "third_party_voucher": str(booking_data.get("third_party_voucher", "no")).lower() not in ("no", "false", "0", ""),
+                            "package": str(booking_data.get("using_package", "no")).lower() not in ("no", "false", "0", ""),
+                        }
+
+
+                        api_response = create_booking(
+                            crm_lead=crm_lead_doc.name,
+                            booking_details=json.dumps(api_booking_details, default=str),
+                            message=message,
+                            booking_info_with_regex=json.dumps(booking_data, default=str),
+                            booking_info=json.dumps(booking_data, default=str),
+                        )
+                        # Handle failed booking (e.g., slot unavailable, date overed)
+                        if api_response and api_response.get("success") == False:
                             frappe.log_error(
-                                "📋 CALLING API - BOOKING DETAILS",
-                                f"User has confirmed. Calling booking API with:\n"
-                                f"{json.dumps(booking_data, indent=2, default=str)}\n"
-                                f"Confirmation was previously shown: {pending_data.get('awaiting_confirmation') == True}"
+                                "📋 create_booking FAILED RESPONSE",
+                                f"Full api_response keys: {list(api_response.keys())}\n"
+                                f"Full api_response: {json.dumps(api_response, indent=2, default=str)}"
                             )
-
-#                             # Send "Processing..." message showing booking details one more time
-#                             processing_msg = f"""⏳ Processing your booking...
-
-# 📋 Booking Details Being Submitted:
-# - Name: {booking_data.get('customer_name')}
-# - Phone: {booking_data.get('phone')}
-# - Outlet: {booking_data.get('outlet')}
-# - Date: {booking_data.get('booking_date')}
-# - Time: {booking_data.get('timeslot')}
-# - Pax: {booking_data.get('pax')}
-# - Treatment: {booking_data.get('treatment_type')}
-# - Duration: {booking_data.get('session')} minutes
-
-# Please wait while we confirm your appointment..."""
-
-#                             enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=processing_msg, queue="short", is_async=True)
-
-#                             # Small delay to ensure processing message is sent before API call
-#                             import time
-#                             time.sleep(1)
-
-                            try:
-                                outlet_name = booking_data.get("outlet")
-                                outlet_branch_code = frappe.db.get_value("Outlet", outlet_name, "branch_code") or outlet_name
-                                booking_data["outlet"] = outlet_branch_code
-                                # Map booking_data fields to the CRM create_booking API field names
-                                api_booking_details = {
-                                    "customer_name": booking_data.get("customer_name"),
-                                    "booking_mobile": whatsapp_id,
-                                    "member_mobile": booking_data.get("phone"),
-                                    "outlet": outlet_branch_code,
-                                    "booking_date": booking_data.get("booking_date"),
-                                    "timeslot": booking_data.get("timeslot"),
-                                    "pax": booking_data.get("pax"),
-                                    "treatment": booking_data.get("treatment_type"),
-                                    "session": booking_data.get("session"),
-                                    "preferred_therapist": booking_data.get("preferred_masseur"),
-                                    "third_party_voucher": str(booking_data.get("third_party_voucher", "no")).lower() not in ("no", "false", "0", ""),
-                                    "package": str(booking_data.get("using_package", "no")).lower() not in ("no", "false", "0", ""),
-                                }
-
-
-                                api_response = create_booking(
-                                    crm_lead=crm_lead_doc.name,
-                                    booking_details=json.dumps(api_booking_details, default=str),
-                                    message=message,
-                                    booking_info_with_regex=json.dumps(booking_data, default=str),
-                                    booking_info=json.dumps(booking_data, default=str),
-                                )
-                                # Handle failed booking (e.g., slot unavailable, date overed)
-                                if api_response and api_response.get("success") == False:
-                                    frappe.log_error(
-                                        "📋 create_booking FAILED RESPONSE",
-                                        f"Full api_response keys: {list(api_response.keys())}\n"
-                                        f"Full api_response: {json.dumps(api_response, indent=2, default=str)}"
-                                    )
-                                    error_message = api_response.get("message", "Booking could not be completed.")
-                                    available_slots = api_response.get("available_slots", [])
-
-                                    suggested_slot_1 = api_response.get("suggested_slot_1", [])
-                                    suggested_slot_2 = api_response.get("suggested_slot_2", [])
-
-                                    if suggested_slot_1 or suggested_slot_2:
-                                        # Build numbered list of all suggested slots
-                                        numbered_slots = {}
-                                        slot_number = 1
-                                        number_emojis = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣"]
-
-                                        pax_val = api_response.get("pax", booking_data.get("pax", 1))
-                                        therapist_val = api_response.get("preferred_therapist", booking_data.get("preferred_masseur", "Any"))
-                                        session_val = api_response.get("session", booking_data.get("session", 60))
-                                        treatment_val = api_response.get("treatment", booking_data.get("treatment_type", ""))
-
-                                        suggested_msg = f"❌ {error_message}\n\nHere are the available alternatives:\n"
-
-                                        # Add suggested_slot_1 (same outlet)
-                                        if suggested_slot_1:
-                                            first_slot = suggested_slot_1[0]
-                                            outlet_name_1 = first_slot.get("shop_full_name", first_slot.get("outlet", ""))
-                                            suggested_msg += f"\n📍 *{outlet_name_1}*\n"
-                                            for slot in suggested_slot_1:
+                            error_message = api_response.get("message", "Booking could not be completed.")
+                            available_slots = api_response.get("available_slots", [])
+
+                            suggested_slot_1 = api_response.get("suggested_slot_1", [])
+                            suggested_slot_2 = api_response.get("suggested_slot_2", [])
+
+                            if suggested_slot_1 or suggested_slot_2:
+                                # Build numbered list of all suggested slots
+                                numbered_slots = {}
+                                slot_number = 1
+                                number_emojis = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣"]
+
+                                pax_val = api_response.get("pax", booking_data.get("pax", 1))
+                                therapist_val = api_response.get("preferred_therapist", booking_data.get("preferred_masseur", "Any"))
+                                session_val = api_response.get("session", booking_data.get("session", 60))
+                                treatment_val = api_response.get("treatment", booking_data.get("treatment_type", ""))
+
+                                suggested_msg = f"❌ {error_message}\n\nHere are the available alternatives:\n"
+
+                                # Add suggested_slot_1 (same outlet)
+                                if suggested_slot_1:
+                                    first_slot = suggested_slot_1[0]
+                                    outlet_name_1 = first_slot.get("shop_full_name", first_slot.get("outlet", ""))
+                                    suggested_msg += f"\n📍 *{outlet_name_1}*\n"
+                                    for slot in suggested_slot_1:
+                                        if slot_number <= len(number_emojis):
+                                            # Format timeslot for display
+                                            try:
+                                                t = datetime.datetime.strptime(str(slot.get("timeslot", "")), "%H:%M:%S")
+                                                time_display = t.strftime("%-I:%M%p").lower()
+                                            except Exception:
+                                                time_display = slot.get("timeslot", "")
+                                            date_display = slot.get("booking_date", "")
+                                            suggested_msg += f"{number_emojis[slot_number - 1]}  {date_display} at {time_display}\n"
+                                            numbered_slots[str(slot_number)] = {
+                                                "outlet": slot.get("outlet", ""),
+                                                "shop_full_name": slot.get("shop_full_name", outlet_name_1),
+                                                "booking_date": slot.get("booking_date", ""),
+                                                "timeslot": slot.get("timeslot", ""),
+                                            }
+                                            slot_number += 1
+
+                                # Add suggested_slot_2 (other outlets)
+                                if suggested_slot_2:
+                                    for outlet_group in suggested_slot_2:
+                                        outlet_name_2 = outlet_group.get("shop_full_name", outlet_group.get("outlet", ""))
+                                        outlet_code_2 = outlet_group.get("outlet", "")
+                                        inner_slots = outlet_group.get("slots", [])
+                                        if inner_slots:
+                                            suggested_msg += f"\n📍 *{outlet_name_2}*\n"
+                                            for slot in inner_slots:
                                                 if slot_number <= len(number_emojis):
-                                                    # Format timeslot for display
-                                                    from datetime import datetime as dt
                                                     try:
-                                                        t = dt.strptime(str(slot.get("timeslot", "")), "%H:%M:%S")
+                                                        t = datetime.datetime.strptime(str(slot.get("timeslot", "")), "%H:%M:%S")
                                                         time_display = t.strftime("%-I:%M%p").lower()
                                                     except Exception:
                                                         time_display = slot.get("timeslot", "")
                                                     date_display = slot.get("booking_date", "")
                                                     suggested_msg += f"{number_emojis[slot_number - 1]}  {date_display} at {time_display}\n"
                                                     numbered_slots[str(slot_number)] = {
-                                                        "outlet": slot.get("outlet", ""),
-                                                        "shop_full_name": slot.get("shop_full_name", outlet_name_1),
+                                                        "outlet": slot.get("outlet", outlet_code_2),
+                                                        "shop_full_name": outlet_name_2,
                                                         "booking_date": slot.get("booking_date", ""),
                                                         "timeslot": slot.get("timeslot", ""),
                                                     }
                                                     slot_number += 1
 
-                                        # Add suggested_slot_2 (other outlets)
-                                        if suggested_slot_2:
-                                            for outlet_group in suggested_slot_2:
-                                                outlet_name_2 = outlet_group.get("shop_full_name", outlet_group.get("outlet", ""))
-                                                outlet_code_2 = outlet_group.get("outlet", "")
-                                                inner_slots = outlet_group.get("slots", [])
-                                                if inner_slots:
-                                                    suggested_msg += f"\n📍 *{outlet_name_2}*\n"
-                                                    for slot in inner_slots:
-                                                        if slot_number <= len(number_emojis):
-                                                            try:
-                                                                t = dt.strptime(str(slot.get("timeslot", "")), "%H:%M:%S")
-                                                                time_display = t.strftime("%-I:%M%p").lower()
-                                                            except Exception:
-                                                                time_display = slot.get("timeslot", "")
-                                                            date_display = slot.get("booking_date", "")
-                                                            suggested_msg += f"{number_emojis[slot_number - 1]}  {date_display} at {time_display}\n"
-                                                            numbered_slots[str(slot_number)] = {
-                                                                "outlet": slot.get("outlet", outlet_code_2),
-                                                                "shop_full_name": outlet_name_2,
-                                                                "booking_date": slot.get("booking_date", ""),
-                                                                "timeslot": slot.get("timeslot", ""),
-                                                            }
-                                                            slot_number += 1
-
-                                        suggested_msg += f"\n👥 Pax: {pax_val} ({therapist_val})\n⏳ Duration: {session_val}mins {treatment_val}\n"
-                                        suggested_msg += "\n⚠️ Please note: This is NOT a booking confirmation.\nYour booking will only be confirmed after you receive our official confirmation message 💆‍♀️✨\n"
-                                        suggested_msg += "\n*Reply with the number* of your preferred slot (e.g. *1*, *2*, *3*...)"
-
-                                        # Save state so user can pick a slot
-                                        slot_selection_data = booking_data.copy()
-                                        slot_selection_data['awaiting_slot_selection'] = True
-                                        slot_selection_data['awaiting_confirmation'] = False
-                                        slot_selection_data['numbered_slots'] = numbered_slots
-                                        slot_selection_data['available_slots'] = available_slots
-                                        # Preserve API field mappings for re-booking
-                                        slot_selection_data['_member_mobile'] = api_response.get("member_mobile", booking_data.get("phone"))
-                                        slot_selection_data['_pax'] = api_response.get("pax", booking_data.get("pax"))
-                                        slot_selection_data['_treatment'] = api_response.get("treatment", booking_data.get("treatment_type"))
-                                        slot_selection_data['_session'] = api_response.get("session", booking_data.get("session"))
-                                        slot_selection_data['_preferred_therapist'] = api_response.get("preferred_therapist", booking_data.get("preferred_masseur"))
-                                        slot_selection_data['_third_party_voucher'] = api_response.get("third_party_voucher", booking_data.get("third_party_voucher"))
-                                        slot_selection_data['_package'] = api_response.get("package", booking_data.get("using_package"))
-                                        save_pending_booking_data(crm_lead_doc, slot_selection_data)
-
-                                        enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=suggested_msg, queue="short", is_async=True)
-                                    else:
-                                        error_msg = f"❌ {error_message}\n\nPlease try a different date/time or contact our outlet directly."
-                                        enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=error_msg, queue="short", is_async=True)
-                                    return
-
-                                # Get booking reference from API response
-                                api_booking_data = api_response.get('booking_data', [{}])
-                                first_booking = api_booking_data[0] if api_booking_data else {}
-                                booking_reference = first_booking.get('booking_id') or first_booking.get('order_id') or f"BKG{frappe.utils.now_datetime().strftime('%Y%m%d%H%M%S')}"
-                                order_id = first_booking.get('order_id', '')
-
-                                # Save confirmed booking data (don't clear it - needed for update/cancel)
-                                confirmed_booking_data = booking_data.copy()
-                                confirmed_booking_data['confirmed'] = True
-                                confirmed_booking_data['booking_reference'] = booking_reference
-                                confirmed_booking_data['order_id'] = order_id
-                                confirmed_booking_data['confirmed_at'] = frappe.utils.now_datetime().isoformat()
-                                save_pending_booking_data(crm_lead_doc, confirmed_booking_data)
-
-                                # Use confirmation_message from API if available, otherwise build our own
-                                confirmation_msg = api_response.get('confirmation_message', '')
-                                if not confirmation_msg:
-                                    confirmation_msg = (
-                                        f"✅ Booking confirmed!\n\n"
-                                        f"📋 Booking Reference: {booking_reference}\n"
-                                        f"- Name: {booking_data.get('customer_name')}\n"
-                                        f"- Date: {booking_data.get('booking_date')}\n"
-                                        f"- Time: {booking_data.get('timeslot')}\n"
-                                        f"- Treatment: {booking_data.get('treatment_type')}\n"
-                                        f"- Duration: {booking_data.get('session')} minutes\n"
-                                        f"- Pax: {booking_data.get('pax')}\n\n"
-                                        f"Thank you for choosing HealthLand! 💚"
-                                    )
-
-                                print(confirmation_msg)
-                                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=str(confirmation_msg), queue="short", is_async=True)
-
-                                frappe.log_error(
-                                    "WhatsApp Booking Success",
-                                    f"Booking processed successfully\nCustomer: {customer_name}\nDetails: {json.dumps(booking_data, indent=2, default=str)}"
-                                )
-                                return  # Exit after handling booking
+                                suggested_msg += f"\n👥 Pax: {pax_val} ({therapist_val})\n⏳ Duration: {session_val}mins {treatment_val}\n"
+                                suggested_msg += "\n⚠️ Please note: This is NOT a booking confirmation.\nYour booking will only be confirmed after you receive our official confirmation message 💆‍♀️✨\n"
+                                suggested_msg += "\n*Reply with the number* of your preferred slot (e.g. *1*, *2*, *3*...)"
+
+                                # Save state so user can pick a slot
+                                slot_selection_data = booking_data.copy()
+                                slot_selection_data['awaiting_slot_selection'] = True
+                                slot_selection_data['awaiting_confirmation'] = False
+                                slot_selection_data['numbered_slots'] = numbered_slots
+                                slot_selection_data['available_slots'] = available_slots
+                                # Preserve API field mappings for re-booking
+                                slot_selection_data['_member_mobile'] = api_response.get("member_mobile", booking_data.get("phone"))
+                                slot_selection_data['_pax'] = api_response.get("pax", booking_data.get("pax"))
+                                slot_selection_data['_treatment'] = api_response.get("treatment", booking_data.get("treatment_type"))
+                                slot_selection_data['_session'] = api_response.get("session", booking_data.get("session"))
+                                slot_selection_data['_preferred_therapist'] = api_response.get("preferred_therapist", booking_data.get("preferred_masseur"))
+                                slot_selection_data['_third_party_voucher'] = api_response.get("third_party_voucher", booking_data.get("third_party_voucher"))
+                                slot_selection_data['_package'] = api_response.get("package", booking_data.get("using_package"))
+                                save_pending_booking_data(crm_lead_doc, slot_selection_data)
+
+                                enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=suggested_msg, queue="short", is_async=True, enqueue_after_commit=True)
+                            else:
+                                error_msg = f"❌ {error_message}\n\nPlease try a different date/time or contact our outlet directly."
+                                enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=error_msg, queue="short", is_async=True, enqueue_after_commit=True)
+                            return
 
-                            except Exception as booking_error:
-                                frappe.log_error(
-                                    "WhatsApp Booking Error",
-                                    f"Booking API error: {str(booking_error)}\nTraceback: {frappe.get_traceback()}"
-                                )
-                                # Clear pending data on error
-                                clear_pending_booking_data(crm_lead_doc)
-                                # Send error message to customer
-                                error_msg = "❌ Sorry, there was an error processing your booking. Please contact our outlet directly or try again later. Thank you for your patience! 🙏"
-                                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=error_msg, queue="short", is_async=True)
-                                return
-
-                        elif is_change_request(message, context='awaiting_confirmation'):
-                            # User's response contains change-related keywords (e.g., "no", "change", "wrong")
-                            # Use LLM to intelligently determine if they want to:
-                            # 1. Update specific fields with provided values (e.g., "no change name to duxton"), OR
-                            # 2. Make changes but haven't specified what (e.g., just "no")
-
-                            frappe.log_error("Booking Confirmation", f"Analyzing user intent for change request: {whatsapp_id}")
-
-                            intent_analysis = analyze_confirmation_response_intent(message, booking_data)
-                            intent = intent_analysis.get('intent')
-                            field_updates = intent_analysis.get('field_updates', {})
-
-                            if intent == 'update_fields' and field_updates:
-                                # User provided specific field updates - apply them automatically
-                                frappe.log_error(
-                                    "Field Updates Detected",
-                                    f"User wants to update fields:\n{json.dumps(field_updates, indent=2)}"
+                        # Get booking reference from API response
+                        api_booking_data = api_response.get('booking_data', [{}])
+                        first_booking = api_booking_data[0] if api_booking_data else {}
+                        now = frappe.utils.now_datetime()
+                        booking_reference = first_booking.get('booking_id') or first_booking.get('order_id') or f"BKG{now.strftime('%Y%m%d%H%M%S')}"
+                        order_id = first_booking.get('order_id', '')
+
+                        # Save confirmed booking data (don't clear it - needed for update/cancel)
+                        booking_data['confirmed'] = True
+                        booking_data['booking_reference'] = booking_reference
+                        booking_data['order_id'] = order_id
+                        booking_data['confirmed_at'] = now.isoformat()
+                        save_pending_booking_data(crm_lead_doc, booking_data)
+
+                        # Use confirmation_message from API if available, otherwise build our own
+                        confirmation_msg = api_response.get('confirmation_message', '')
+                        if not confirmation_msg:
+                            confirmation_msg = BOOKING_CONFIRMED_MESSAGE.format_map(ChainMap(booking_data, BOOKING_SUMMARY_DEFAULTS))
+
+                        enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=str(confirmation_msg), queue="short", is_async=True, enqueue_after_commit=True)
+
+                        log_ai_debug(
+                            "WhatsApp Booking Success",
+                            "Booking processed successfully\nCustomer: %s\nDetails: %s",
+                            customer_name, booking_data
+                        )
+                        return  # Exit after handling booking
+
+                    except Exception as booking_error:
+                        frappe.log_error(
+                            "WhatsApp Booking Error",
+                            f"Booking API error: {booking_error}\nTraceback: {frappe.get_traceback()}"
+                        )
+                        # Clear pending data on error
+                        clear_pending_booking_data(crm_lead_doc)
+                        # Send error message to customer
+                        error_msg = "❌ Sorry, there was an error processing your booking. Please contact our outlet directly or try again later. Thank you for your patience! 🙏"
+                        enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=error_msg, queue="short", is_async=True, enqueue_after_commit=True)
+                        return
+
+                elif turn_state == 'change_requested':
+                    # User's response contains change-related keywords (e.g., "no", "change", "wrong")
+                    # Use LLM to intelligently determine if they want to:
+                    # 1. Update specific fields with provided values (e.g., "no change name to duxton"), OR
+                    # 2. Make changes but haven't specified what (e.g., just "no")
+
+                    log_ai_debug("Booking Confirmation", f"Analyzing user intent for change request: {whatsapp_id}")
+
+                    intent_analysis = analyze_confirmation_response_intent(message, booking_data)
+                    intent = intent_analysis.get('intent')
+                    field_updates = intent_analysis.get('field_updates', {})
+
+                    if intent == 'update_fields' and field_updates:
+                        # User provided specific field updates - apply them automatically
+                        log_ai_debug(
+                            "Field Updates Detected",
+                            "User wants to update fields:\n%s",
+                            field_updates
+                        )
+
+                        # Apply field updates to booking data
+                        for field, new_value in field_updates.items():
+                            if field in booking_data:
+                                old_value = booking_data.get(field)
+                                booking_data[field] = new_value
+                                log_ai_debug(
+                                    "Field Updated",
+                                    f"Updated {field}: '{old_value}' → '{new_value}'"
                                 )
 
-                                # Apply field updates to booking data
-                                for field, new_value in field_updates.items():
-                                    if field in booking_data:
-                                        old_value = booking_data.get(field)
-                                        booking_data[field] = new_value
-                                        frappe.log_error(
-                                            "Field Updated",
-                                            f"Updated {field}: '{old_value}' → '{new_value}'"
-                                        )
-
-                                # Keep awaiting_confirmation = True, show updated details
-                                booking_data['awaiting_confirmation'] = True
-                                save_pending_booking_data(crm_lead_doc, booking_data)
-
-                                # Show updated booking details
-                                updated_summary = f"""✅ Updated! Here are your revised booking details:
-
-- Name: {booking_data.get('customer_name')}
-- Phone: {booking_data.get('phone')}
-- Outlet: {booking_data.get('outlet')}
-- Date: {booking_data.get('booking_date')}
-- Time: {booking_data.get('timeslot')}
-- Pax: {booking_data.get('pax')}
-- Treatment: {booking_data.get('treatment_type')}
-- Duration: {booking_data.get('session')} minutes
-- Preferred Masseur: {booking_data.get('preferred_masseur')}
-- 3rd Party Voucher: {booking_data.get('third_party_voucher', 'N/A')}
-- Using Package: {booking_data.get('using_package', 'N/A')}
-
-Is everything correct now? Please reply:
-✅ *Yes* to confirm
-❌ *No* to make more changes"""
-
-                                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=updated_summary, queue="short", is_async=True)
-                                return
+                        # Keep awaiting_confirmation = True, show updated details
+                        booking_data['awaiting_confirmation'] = True
+                        save_pending_booking_data(crm_lead_doc, booking_data)
 
-                            else:
-                                # User wants to make changes but didn't provide specific field values
-                                # Ask them what they'd like to change
-                                frappe.log_error("Booking Confirmation", f"User wants to make changes (no specific updates provided) for {whatsapp_id}")
-                                booking_data['awaiting_confirmation'] = False
-                                save_pending_booking_data(crm_lead_doc, booking_data)
+                        # Show updated booking details
+                        updated_summary = format_booking_summary(booking_data, "✅ Updated! Here are your revised booking details:", BOOKING_CONFIRM_AGAIN_FOOTER)
 
-                                change_msg = "No problem! What would you like to change? Please let me know which details need to be updated. 😊"
-                                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=change_msg, queue="short", is_async=True)
-                                return
+                        enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=updated_summary, queue="short", is_async=True, enqueue_after_commit=True)
+                        return
 
-                else:
+                    else:
+                        # User wants to make changes but didn't provide specific field values
+                        # Ask them what they'd like to change
+                        log_ai_debug("Booking Confirmation", f"User wants to make changes (no specific updates provided) for {whatsapp_id}")
+                        booking_data['awaiting_confirmation'] = False
+                        save_pending_booking_data(crm_lead_doc, booking_data)
+
+                        change_msg = "No problem! What would you like to change? Please let me know which details need to be updated. 😊"
+                        enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=change_msg, queue="short", is_async=True, enqueue_after_commit=True)
+                        return
+
+                elif turn_state == 'show_confirmation':
                     # First time all fields are complete - show details and ask for confirmation
                     # ⭐ CRITICAL: This is where we ask user to confirm BEFORE calling API
-                    frappe.log_error(
+                    log_ai_debug(
                         "⭐ SHOWING CONFIRMATION TO USER ⭐",
                         f"ALL FIELDS COMPLETE - ASKING USER TO CONFIRM\n"
                         f"WhatsApp ID: {whatsapp_id}\n"
@@ -2123,36 +2176,20 @@ Is everything correct now? Please reply:
                         f"Setting awaiting_confirmation = True"
                     )
 
-                    booking_summary = f"""📋 Please confirm your booking details:
-
-- Name: {booking_data.get('customer_name')}
-- Phone: {booking_data.get('phone')}
-- Outlet: {booking_data.get('outlet')}
-- Date: {booking_data.get('booking_date')}
-- Time: {booking_data.get('timeslot')}
-- Pax: {booking_data.get('pax')}
-- Treatment: {booking_data.get('treatment_type')}
-- Duration: {booking_data.get('session')} minutes
-- Preferred Masseur: {booking_data.get('preferred_masseur')}
-- 3rd Party Voucher: {booking_data.get('third_party_voucher', 'N/A')}
-- Using Package: {booking_data.get('using_package', 'N/A')}
-
-Is everything correct? Please reply:
-✅ *Yes* to confirm
-❌ *No* to make changes"""
+                    booking_summary = format_booking_summary(booking_data, "📋 Please confirm your booking details:", BOOKING_CONFIRM_FOOTER)
 
                     # Save with awaiting_confirmation flag - THIS PREVENTS CALLING API UNTIL USER CONFIRMS
                     booking_data['awaiting_confirmation'] = True
                     save_pending_booking_data(crm_lead_doc, booking_data)
 
-                    frappe.log_error(
+                    log_ai_debug(
                         "Confirmation Message Queued",
                         f"Sending confirmation message to {whatsapp_id}\n"
                         f"Message: {booking_summary}\n"
                         f"Awaiting_confirmation saved: True"
                     )
 
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=booking_summary, queue="short", is_async=True)
+                    enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=booking_summary, queue="short", is_async=True, enqueue_after_commit=True)
                     return  # EXIT WITHOUT CALLING API - Wait for user response
 
             else:
@@ -2166,63 +2203,46 @@ Is everything correct? Please reply:
                     extracted_data=booking_data,
                     missing_fields=missing_fields
                 )
-                frappe.log_error("WhatsApp Booking Debug", f"Missing fields: {missing_fields}\nGenerated prompt:\n{missing_msg}")
-                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=missing_msg, queue="short", is_async=True)
+                log_ai_debug("WhatsApp Booking Debug", f"Missing fields: {missing_fields}\nGenerated prompt:\n{missing_msg}")
+                enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=missing_msg, queue="short", is_async=True, enqueue_after_commit=True)
                 return
 
         # Initialize RAG chain and get chat history
-        print("Calling get_rag_chain()", "WhatsApp AI Debug")
-        rag_chain, chat_history = get_rag_chain(crm_lead_doc.name)
-        print("RAG chain retrieved successfully", "WhatsApp AI Debug")
+        rag_chain, chat_history = get_rag_chain(crm_lead_doc.name, chat_history=chat_history)
 
         # Get AI response with conversation history
-        print(f"Invoking RAG chain with message: {message[:50]}...", "WhatsApp AI Debug")
         response = rag_chain.invoke({"input": message, "chat_history": chat_history})
         ai_answer = response.get("answer", "")
-        print(f"AI response received: {ai_answer[:100]}...", "WhatsApp AI Debug")
 
         if ai_answer:
             # Clean markdown formatting and remove duplicate links
-            from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.agents.rag_chain import (
-                clean_message_formatting,
-                detect_and_remove_hallucinated_addresses,
-                remove_soma_mentions
-            )
             ai_answer = clean_message_formatting(ai_answer)
-            print(f"AI response cleaned (formatting): {ai_answer[:100]}...", "WhatsApp AI Debug")
 
             # Remove any hallucinated addresses, phone numbers, or specific details
             ai_answer = detect_and_remove_hallucinated_addresses(ai_answer)
-            print(f"AI response cleaned (hallucinations): {ai_answer[:100]}...", "WhatsApp AI Debug")
 
             # Remove SOMA mentions unless user asked about SOMA
             ai_answer = remove_soma_mentions(ai_answer, message)
-            print(f"AI response cleaned (SOMA filter): {ai_answer[:100]}...", "WhatsApp AI Debug")
 
             # Validate and correct outlet information against outlet_data.json
             ai_answer = validate_and_correct_outlet_info(ai_answer)
-            print(f"AI response validated (outlet info): {ai_answer[:100]}...", "WhatsApp AI Debug")
 
             # Send AI response back to user
-            print("Enqueuing AI response", "WhatsApp AI Debug")
-            enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=ai_answer, queue="short", is_async=True)
+            enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=ai_answer, queue="short", is_async=True, enqueue_after_commit=True)
 
             # Removed: Confirmation reminder after answering questions
             # Users don't want to be reminded about pending bookings after asking questions
 
             # Log the interaction for monitoring
-            print(
-                f"User: {message}\nAI: {ai_answer}",
-                "WhatsApp AI Conversation"
-            )
+            log_ai_debug("WhatsApp AI Conversation", f"User: {message}\nAI: {ai_answer}")
         else:
-            print("AI response was empty", "WhatsApp AI Debug")
+            log_ai_debug("WhatsApp AI Debug", "AI response was empty")
 
     except Exception as e:
         # Log error but don't break the flow
-        print(
-            f"Error in AI message handling: {str(e)}\nMessage: {message}\nTraceback: {frappe.get_traceback()}",
-            "WhatsApp AI Error"
+        frappe.log_error(
+            "WhatsApp AI Error",
+            f"Error in AI message handling: {str(e)}\nMessage: {message}\nTraceback: {frappe.get_traceback()}"
         )
 
 def handle_text_message(message, whatsapp_id, customer_name, crm_lead_doc=None):
@@ -2248,166 +2268,124 @@ def handle_text_message(message, whatsapp_id, customer_name, crm_lead_doc=None):
     elif integration_keyword_settings.reset_password_keyword and integration_keyword_settings.reset_password_keyword in message:
         handle_reset_password(crm_lead_doc, whatsapp_id, message)
     elif message.isdigit() and crm_lead_doc.latest_whatsapp_message_templates:
-        whatsapp_message_template_doc = frappe.get_doc("WhatsApp Message Templates", crm_lead_doc.latest_whatsapp_message_templates)
-        for whatsapp_message_template_button in whatsapp_message_template_doc.whatsapp_message_template_buttons:
-            if message == whatsapp_message_template_button.button_label:
-                frappe.flags.skip_lead_status_update = True
-                create_crm_lead_assignment(crm_lead_doc.name, whatsapp_message_template_doc.name)
-                create_crm_tagging_assignment(crm_lead_doc.name, whatsapp_message_template_doc.tagging)
-                if whatsapp_message_template_button.reply_if_button_clicked:
-                    if whatsapp_message_template_button.reply_image:
-                        enqueue(method=send_image_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=whatsapp_message_template_button.reply_if_button_clicked, image=whatsapp_message_template_button.reply_image, queue="short", is_async=True)
-                    else:
-                        enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=whatsapp_message_template_button.reply_if_button_clicked, queue="short", is_async=True)
-                if whatsapp_message_template_button.reply_2_if_button_clicked:
-                    if whatsapp_message_template_button.reply_image_2:
-                        enqueue(method=send_image_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=whatsapp_message_template_button.reply_2_if_button_clicked, image=whatsapp_message_template_button.reply_image_2, queue="short", is_async=True)
-                    else:
-                        enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=whatsapp_message_template_button.reply_2_if_button_clicked, queue="short", is_async=True)
-                if whatsapp_message_template_button.reply_whatsapp_interaction_if_button_clicked:
-                    enqueue(method=send_interaction_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, whatsapp_interaction_message_template=whatsapp_message_template_button.reply_whatsapp_interaction_if_button_clicked, queue="short", is_async=True)
-                return
+        whatsapp_message_template_doc = frappe.get_cached_doc("WhatsApp Message Templates", crm_lead_doc.latest_whatsapp_message_templates)
+        whatsapp_message_template_button = get_template_button(whatsapp_message_template_doc, "whatsapp_message_template_buttons", message)
+        if whatsapp_message_template_button:
+            frappe.flags.skip_lead_status_update = True
+            create_crm_lead_assignment(crm_lead_doc.name, whatsapp_message_template_doc.name)
+            create_crm_tagging_assignment(crm_lead_doc.name, whatsapp_message_template_doc.tagging)
+            queue_auto_reply(whatsapp_message_template_button, crm_lead_doc, whatsapp_id, interaction_field="reply_whatsapp_interaction_if_button_clicked")
+            return
     elif message.isdigit() and crm_lead_doc.latest_whatsapp_interaction_message_templates:
-        whatsapp_interaction_message_template_doc = frappe.get_doc("WhatsApp Interaction Message Templates", crm_lead_doc.latest_whatsapp_interaction_message_templates)
-        for whatsapp_interaction_message_template_button in whatsapp_interaction_message_template_doc.whatsapp_interaction_message_template_buttons:
-            if message == whatsapp_interaction_message_template_button.button_label:
-                frappe.flags.skip_lead_status_update = True
-                create_crm_lead_assignment(crm_lead_doc.name, whatsapp_interaction_message_template_button.whatsapp_message_templates)
-                create_crm_tagging_assignment(crm_lead_doc.name, whatsapp_interaction_message_template_button.tagging)
-                if whatsapp_interaction_message_template_button.reply_if_button_clicked and (whatsapp_interaction_message_template_button.reply_id != "book-appointment" or (whatsapp_interaction_message_template_button.reply_id == "book-appointment" and not is_not_within_booking_hours())):
-                    if whatsapp_interaction_message_template_button.reply_image:
-                        enqueue(method=send_image_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=whatsapp_interaction_message_template_button.reply_if_button_clicked, image=whatsapp_interaction_message_template_button.reply_image, queue="short", is_async=True)
-                    else:
-                        enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=whatsapp_interaction_message_template_button.reply_if_button_clicked, queue="short", is_async=True)
-                if whatsapp_interaction_message_template_button.reply_2_if_button_clicked:
-                    if whatsapp_interaction_message_template_button.reply_image_2:
-                        enqueue(method=send_image_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=whatsapp_interaction_message_template_button.reply_2_if_button_clicked, image=whatsapp_interaction_message_template_button.reply_image_2, queue="short", is_async=True)
-                    else:
-                        enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=whatsapp_interaction_message_template_button.reply_2_if_button_clicked, queue="short", is_async=True)
-                if whatsapp_interaction_message_template_button.send_out_of_working_hours_message and is_not_within_operating_hours():
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=OUT_OF_WORKING_HOURS_MESSAGE, queue="short", is_async=True)
-                if whatsapp_interaction_message_template_button.send_out_of_booking_hours_message and is_not_within_booking_hours():
-                    if not frappe.db.exists("Booking Follow Up", {"crm_lead": crm_lead_doc.name}):
-                        frappe.get_doc({
-                            "doctype": "Booking Follow Up",
-                            "whatsapp_id": whatsapp_id,
-                            "crm_lead": crm_lead_doc.name
-                        }).insert(ignore_permissions=True)
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=OUT_OF_BOOKING_HOURS_MESSAGE, queue="short", is_async=True)
-                return
+        whatsapp_interaction_message_template_doc = frappe.get_cached_doc("WhatsApp Interaction Message Templates", crm_lead_doc.latest_whatsapp_interaction_message_templates)
+        whatsapp_interaction_message_template_button = get_template_button(whatsapp_interaction_message_template_doc, "whatsapp_interaction_message_template_buttons", message)
+        if whatsapp_interaction_message_template_button:
+            frappe.flags.skip_lead_status_update = True
+            create_crm_lead_assignment(crm_lead_doc.name, whatsapp_interaction_message_template_button.whatsapp_message_templates)
+            create_crm_tagging_assignment(crm_lead_doc.name, whatsapp_interaction_message_template_button.tagging)
+            queue_auto_reply(whatsapp_interaction_message_template_button, crm_lead_doc, whatsapp_id, booking_hours_only=whatsapp_interaction_message_template_button.reply_id == "book-appointment")
+            return
     else:
-        text_auto_replies = frappe.db.get_all("Text Auto Reply", filters={"disabled": 0, "keyword": message}, fields=["*"])
-        if not text_auto_replies:
-            keywords = [
-                "book" in message.lower(),
-                "slot" in message.lower(),
-                "date" in message.lower() and "time" in message.lower(),
-                "cancel" in message.lower(),
-            ]
-            unknown_and_promotion_taggings = frappe.db.get_all("CRM Lead Tagging", filters={"crm_lead": crm_lead_doc.name, "tagging": ["in", ["Unknown", "Promotion"]], "status": "Open"}, pluck="name")
-            if not crm_lead_doc.last_reply_at or crm_lead_doc.last_reply_at < add_to_date(get_datetime(), days=-1) or crm_lead_doc.closed:
-                text_auto_replies = frappe.db.get_all("Text Auto Reply", filters={"disabled": 0, "name": "BookingHL"}, fields=["*"])
-        if text_auto_replies:
+        is_new_conversation = not crm_lead_doc.last_reply_at or crm_lead_doc.last_reply_at < now_datetime() - datetime.timedelta(days=1) or crm_lead_doc.closed
+        text_auto_reply, tagging = get_text_auto_reply(message, is_new_conversation)
+        if text_auto_reply:
             frappe.flags.update_conversation_start_at = True
             frappe.flags.skip_lead_status_update = True
-            create_crm_lead_assignment(crm_lead_doc.name, text_auto_replies[0].whatsapp_message_templates)
-            create_crm_tagging_assignment(crm_lead_doc.name, text_auto_replies[0].tagging)
-            if text_auto_replies[0].reply_if_button_clicked and (text_auto_replies[0].name != "BookingHL" or (text_auto_replies[0].name == "BookingHL" and not is_not_within_booking_hours())):
-                if text_auto_replies[0].reply_image:
-                    enqueue(method=send_image_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=text_auto_replies[0].reply_if_button_clicked, image=text_auto_replies[0].reply_image, queue="short", is_async=True)
-                else:
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=text_auto_replies[0].reply_if_button_clicked, queue="short", is_async=True)
-            if text_auto_replies[0].reply_2_if_button_clicked:
-                if text_auto_replies[0].reply_image_2:
-                    enqueue(method=send_image_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=text_auto_replies[0].reply_2_if_button_clicked, image=text_auto_replies[0].reply_image_2, queue="short", is_async=True)
-                else:
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=text_auto_replies[0].reply_2_if_button_clicked, queue="short", is_async=True)
-            if text_auto_replies[0].whatsapp_interaction_message_templates:
-                enqueue(method=send_interaction_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, whatsapp_interaction_message_template=text_auto_replies[0].whatsapp_interaction_message_templates, queue="short", is_async=True)
-            if text_auto_replies[0].send_out_of_working_hours_message and is_not_within_operating_hours():
-                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=OUT_OF_WORKING_HOURS_MESSAGE, queue="short", is_async=True)
-            if text_auto_replies[0].send_out_of_booking_hours_message and is_not_within_booking_hours():
-                if not frappe.db.exists("Booking Follow Up", {"crm_lead": crm_lead_doc.name}):
-                    frappe.get_doc({
-                        "doctype": "Booking Follow Up",
-                        "whatsapp_id": whatsapp_id,
-                        "crm_lead": crm_lead_doc.name
-                    }).insert(ignore_permissions=True)
-                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=OUT_OF_BOOKING_HOURS_MESSAGE, queue="short", is_async=True)
-        elif not crm_lead_doc.last_reply_at or crm_lead_doc.last_reply_at < add_to_date(get_datetime(), days=-1) or crm_lead_doc.closed:
-            text_auto_replies = frappe.db.get_all("Text Auto Reply", filters={"disabled": 0, "name": "automated_message"}, fields=["*"])
-            if text_auto_replies:
-                frappe.flags.update_conversation_start_at = True
-                frappe.flags.skip_lead_status_update = True
-                create_crm_lead_assignment(crm_lead_doc.name, text_auto_replies[0].whatsapp_message_templates)
-                create_crm_tagging_assignment(crm_lead_doc.name, "Unknown")
-                if text_auto_replies[0].reply_if_button_clicked:
-                    if text_auto_replies[0].reply_image:
-                        enqueue(method=send_image_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=text_auto_replies[0].reply_if_button_clicked, image=text_auto_replies[0].reply_image, queue="short", is_async=True)
-                    else:
-                        enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=text_auto_replies[0].reply_if_button_clicked, queue="short", is_async=True)
-                if text_auto_replies[0].reply_2_if_button_clicked:
-                    if text_auto_replies[0].reply_image_2:
-                        enqueue(method=send_image_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=text_auto_replies[0].reply_2_if_button_clicked, image=text_auto_replies[0].reply_image_2, queue="short", is_async=True)
-                    else:
-                        enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=text_auto_replies[0].reply_2_if_button_clicked, queue="short", is_async=True)
-                if text_auto_replies[0].whatsapp_interaction_message_templates:
-                    enqueue(method=send_interaction_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, whatsapp_interaction_message_template=text_auto_replies[0].whatsapp_interaction_message_templates, queue="short", is_async=True)
-                if text_auto_replies[0].send_out_of_working_hours_message and is_not_within_operating_hours():
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=OUT_OF_WORKING_HOURS_MESSAGE, queue="short", is_async=True)
-                if text_auto_replies[0].send_out_of_booking_hours_message and is_not_within_booking_hours():
-                    if not frappe.db.exists("Booking Follow Up", {"crm_lead": crm_lead_doc.name}):
-                        frappe.get_doc({
-                            "doctype": "Booking Follow Up",
-                            "whatsapp_id": whatsapp_id,
-                            "crm_lead": crm_lead_doc.name
-                        }).insert(ignore_permissions=True)
-                    enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=OUT_OF_BOOKING_HOURS_MESSAGE, queue="short", is_async=True)
+            create_crm_lead_assignment(crm_lead_doc.name, text_auto_reply.whatsapp_message_templates)
+            create_crm_tagging_assignment(crm_lead_doc.name, tagging)
+            queue_auto_reply(text_auto_reply, crm_lead_doc, whatsapp_id, booking_hours_only=text_auto_reply.name == "BookingHL")
+
+def get_text_auto_reply(message, is_new_conversation):
+    """Return the Text Auto Reply for message and the tagging to apply, in one query.
+
+    A keyword match wins; a new conversation otherwise falls back to BookingHL, then automated_message (tagged Unknown).
+    """
+    fallbacks = TEXT_AUTO_REPLY_FALLBACKS if is_new_conversation else ()
+    or_filters = {"keyword": message}
+    if fallbacks:
+        or_filters["name"] = ["in", fallbacks]
+    text_auto_replies = frappe.db.get_all("Text Auto Reply", filters={"disabled": 0}, or_filters=or_filters, fields=TEXT_AUTO_REPLY_FIELDS + ["keyword"], limit=len(fallbacks) + 1)
+
+    by_name = {text_auto_reply.name: text_auto_reply for text_auto_reply in text_auto_replies}
+    for text_auto_reply in text_auto_replies:
+        if text_auto_reply.name not in fallbacks or (text_auto_reply.keyword or "").casefold() == message.casefold():
+            return text_auto_reply, text_auto_reply.tagging
+    if "BookingHL" in by_name:
+        return by_name["BookingHL"], by_name["BookingHL"].tagging
+    if "automated_message" in by_name:
+        return by_name["automated_message"], "Unknown"
+    return None, None
+
+def queue_auto_reply(reply, crm_lead_doc, whatsapp_id, interaction_field="whatsapp_interaction_message_templates", booking_hours_only=False):
+    """Queue the replies configured on an auto reply row (Text Auto Reply or a template button) as one ordered batch.
+
+    booking_hours_only holds back the first reply outside booking hours, where the out of booking hours notice replaces it.
+    """
+    outside_booking_hours = is_not_within_booking_hours()
+    outbox = []
+    if reply.reply_if_button_clicked and not (booking_hours_only and outside_booking_hours):
+        if reply.reply_image:
+            outbox.append({"text": reply.reply_if_button_clicked, "image": reply.reply_image})
+        else:
+            outbox.append({"text": reply.reply_if_button_clicked})
+    if reply.reply_2_if_button_clicked:
+        if reply.reply_image_2:
+            outbox.append({"text": reply.reply_2_if_button_clicked, "image": reply.reply_image_2})
+        else:
+            outbox.append({"text": reply.reply_2_if_button_clicked})
+    if reply.get(interaction_field):
+        outbox.append({"interaction": reply.get(interaction_field)})
+    if reply.get("send_out_of_working_hours_message") and is_not_within_operating_hours():
+        outbox.append({"text": OUT_OF_WORKING_HOURS_MESSAGE})
+    if reply.get("send_out_of_booking_hours_message") and outside_booking_hours:
+        ensure_booking_follow_up(crm_lead_doc.name, whatsapp_id)
+        outbox.append({"text": OUT_OF_BOOKING_HOURS_MESSAGE})
+    if outbox:
+        enqueue(method=send_messages, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, messages=outbox, queue="short", is_async=True, enqueue_after_commit=True)
+
+def format_booking_summary(booking_data, header, footer, include_voucher=True):
+    """Render booking_data as the bulleted booking summary between header and footer."""
+    values = ChainMap(booking_data, BOOKING_SUMMARY_DEFAULTS)
+    voucher_lines = BOOKING_SUMMARY_VOUCHER_LINES.format_map(values) if include_voucher else ""
+    return BOOKING_SUMMARY_TEMPLATE.format_map(ChainMap({"header": header, "footer": footer, "voucher_lines": voucher_lines}, values))
+
+def get_template_button(template_doc, buttons_field, button_label):
+    """Return the first button row of template_doc labelled button_label, or None."""
+    return get_template_button_index(frappe.local.site, template_doc.doctype, template_doc.name, template_doc.modified, buttons_field).get(button_label)
+
+@lru_cache(maxsize=512)
+def get_template_button_index(site, doctype, name, modified, buttons_field):
+    """Map button labels to rows, built once per template version (a new modified is a new cache key)."""
+    index = {}
+    for button in frappe.get_cached_doc(doctype, name).get(buttons_field):
+        index.setdefault(button.button_label, button)
+    return index
 
 def handle_interactive_message(interactive_id, whatsapp_id, customer_name, crm_lead_doc=None):
     if not crm_lead_doc:
-        crm_lead_doc = get_crm_lead(whatsapp_id, customer_name)
+        crm_lead_doc = get_crm_lead(whatsapp_id, customer_name, minimal=True)
 
     if interactive_id == "agree-pdpa":
         frappe.flags.agree_pdpa = True
-        enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=PDPA_ACCEPTED_REPLY, queue="short", is_async=True)
+        enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=PDPA_ACCEPTED_REPLY, queue="short", is_async=True, enqueue_after_commit=True)
 
     whatsapp_interaction_message_template_buttons = frappe.db.get_all("WhatsApp Interaction Message Template Buttons", filters={"reply_id": interactive_id}, fields=["*"])
 
     if whatsapp_interaction_message_template_buttons:
         create_crm_lead_assignment(crm_lead_doc.name, whatsapp_interaction_message_template_buttons[0].whatsapp_message_templates)
         create_crm_tagging_assignment(crm_lead_doc.name, whatsapp_interaction_message_template_buttons[0].tagging)
-        if whatsapp_interaction_message_template_buttons[0].reply_if_button_clicked and (interactive_id != "book-appointment" or (interactive_id == "book-appointment" and not is_not_within_booking_hours())):
-            if whatsapp_interaction_message_template_buttons[0].reply_image:
-                enqueue(method=send_image_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=whatsapp_interaction_message_template_buttons[0].reply_if_button_clicked, image=whatsapp_interaction_message_template_buttons[0].reply_image, queue="short", is_async=True)
-            else:
-                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=whatsapp_interaction_message_template_buttons[0].reply_if_button_clicked, queue="short", is_async=True)
-        if whatsapp_interaction_message_template_buttons[0].reply_2_if_button_clicked:
-            if whatsapp_interaction_message_template_buttons[0].reply_image_2:
-                enqueue(method=send_image_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=whatsapp_interaction_message_template_buttons[0].reply_2_if_button_clicked, image=whatsapp_interaction_message_template_buttons[0].reply_image_2, queue="short", is_async=True)
-            else:
-                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=whatsapp_interaction_message_template_buttons[0].reply_2_if_button_clicked, queue="short", is_async=True)
-        if whatsapp_interaction_message_template_buttons[0].send_out_of_working_hours_message and is_not_within_operating_hours():
-            enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=OUT_OF_WORKING_HOURS_MESSAGE, queue="short", is_async=True)
-        if whatsapp_interaction_message_template_buttons[0].send_out_of_booking_hours_message and is_not_within_booking_hours():
-            if not frappe.db.exists("Booking Follow Up", {"crm_lead": crm_lead_doc.name}):
-                frappe.get_doc({
-                    "doctype": "Booking Follow Up",
-                    "whatsapp_id": whatsapp_id,
-                    "crm_lead": crm_lead_doc.name
-                }).insert(ignore_permissions=True)
-            enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=OUT_OF_BOOKING_HOURS_MESSAGE, queue="short", is_async=True)
+        queue_auto_reply(whatsapp_interaction_message_template_buttons[0], crm_lead_doc, whatsapp_id, booking_hours_only=interactive_id == "book-appointment")
 
 def handle_template_message_reply(whatsapp_id, customer_name, message, reply_to_message_id, crm_lead_doc=None):
-    reply_to_messages = frappe.db.get_all("WhatsApp Message", filters={"message_id": reply_to_message_id}, fields=["name", "whatsapp_message_templates", "replied"])
-    if reply_to_messages and reply_to_messages[0].whatsapp_message_templates and not reply_to_messages[0].replied:
-        frappe.db.set_value("WhatsApp Message", reply_to_messages[0].name, "replied", 1)
-        whatsapp_message_template_doc = frappe.get_doc("WhatsApp Message Templates", reply_to_messages[0].whatsapp_message_templates)
+    reply_to_message = frappe.db.get_value("WhatsApp Message", {"message_id": reply_to_message_id}, ["name", "whatsapp_message_templates", "replied"], as_dict=True)
+    if reply_to_message and reply_to_message.whatsapp_message_templates and not reply_to_message.replied:
+        frappe.db.set_value("WhatsApp Message", reply_to_message.name, "replied", 1)
+        whatsapp_message_template_doc = frappe.get_cached_doc("WhatsApp Message Templates", reply_to_message.whatsapp_message_templates)
 
         # Special handling for pending notification template
         if whatsapp_message_template_doc.is_pending_notification_template:
             if not crm_lead_doc:
-                crm_lead_doc = get_crm_lead(whatsapp_id, customer_name)
+                crm_lead_doc = get_crm_lead(whatsapp_id, customer_name, minimal=True)
             enqueue(
                 method=send_pending_messages_for_lead,
                 crm_lead_name=crm_lead_doc.name,
@@ -2417,25 +2395,13 @@ def handle_template_message_reply(whatsapp_id, customer_name, message, reply_to_
             )
             return
 
-        for whatsapp_message_template_button in whatsapp_message_template_doc.whatsapp_message_template_buttons:
-            if message == whatsapp_message_template_button.button_label:
-                if not crm_lead_doc:
-                    crm_lead_doc = get_crm_lead(whatsapp_id, customer_name)
-                create_crm_lead_assignment(crm_lead_doc.name, whatsapp_message_template_doc.name)
-                create_crm_tagging_assignment(crm_lead_doc.name, whatsapp_message_template_doc.tagging)
-                if whatsapp_message_template_button.reply_if_button_clicked:
-                    if whatsapp_message_template_button.reply_image:
-                        enqueue(method=send_image_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=whatsapp_message_template_button.reply_if_button_clicked, image=whatsapp_message_template_button.reply_image, queue="short", is_async=True)
-                    else:
-                        enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=whatsapp_message_template_button.reply_if_button_clicked, queue="short", is_async=True)
-                if whatsapp_message_template_button.reply_2_if_button_clicked:
-                    if whatsapp_message_template_button.reply_image_2:
-                        enqueue(method=send_image_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=whatsapp_message_template_button.reply_2_if_button_clicked, image=whatsapp_message_template_button.reply_image_2, queue="short", is_async=True)
-                    else:
-                        enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=whatsapp_message_template_button.reply_2_if_button_clicked, queue="short", is_async=True)
-                if whatsapp_message_template_button.reply_whatsapp_interaction_if_button_clicked:
-                    enqueue(method=send_interaction_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, whatsapp_interaction_message_template=whatsapp_message_template_button.reply_whatsapp_interaction_if_button_clicked, queue="short", is_async=True)
-                break
+        whatsapp_message_template_button = get_template_button(whatsapp_message_template_doc, "whatsapp_message_template_buttons", message)
+        if whatsapp_message_template_button:
+            if not crm_lead_doc:
+                crm_lead_doc = get_crm_lead(whatsapp_id, customer_name, minimal=True)
+            create_crm_lead_assignment(crm_lead_doc.name, whatsapp_message_template_doc.name)
+            create_crm_tagging_assignment(crm_lead_doc.name, whatsapp_message_template_doc.tagging)
+            queue_auto_reply(whatsapp_message_template_button, crm_lead_doc, whatsapp_id, interaction_field="reply_whatsapp_interaction_if_button_clicked")
 
 def send_pending_messages_for_lead(crm_lead_name, whatsapp_id):
     """Send all pending WhatsApp messages for a CRM Lead in creation order (background job)."""
@@ -2500,45 +2466,65 @@ def send_image(crm_lead_doc, whatsapp_id, text, image):
     whatsapp_message_reply.attach = image
     whatsapp_message_reply.insert(ignore_permissions=True)
 
+def send_messages(crm_lead_doc, whatsapp_id, messages):
+    """Send a reply's messages in order from one job: {"text", "image"} or {"interaction": template}."""
+    for message in messages:
+        try:
+            if message.get("interaction"):
+                send_interaction(crm_lead_doc, whatsapp_id, message["interaction"])
+            elif message.get("image"):
+                send_image(crm_lead_doc, whatsapp_id, message["text"], message["image"])
+            else:
+                send_message(crm_lead_doc, whatsapp_id, message["text"])
+        except Exception:
+            frappe.log_error(title="Auto Reply Send Error")
+
 def send_interaction_with_delay(crm_lead_doc, whatsapp_id, whatsapp_interaction_message_template):
     time.sleep(2)
-    whatsapp_interaction_message_template_doc = frappe.get_doc("WhatsApp Interaction Message Templates", whatsapp_interaction_message_template)
-    settings = frappe.get_single("WhatsApp Settings")
-    token = settings.get_password("token")
-    headers = {
-        "authorization": f"Bearer {token}",
-        "content-type": "application/json",
-    }
-
-    buttons = []
-
-    for button in whatsapp_interaction_message_template_doc.whatsapp_interaction_message_template_buttons:
-        buttons.append({
-            "type": "reply",
-            "reply": {
-                "id": button.reply_id,
-                "title": button.button_label 
-            }
-        })
+    send_interaction(crm_lead_doc, whatsapp_id, whatsapp_interaction_message_template)
 
+@lru_cache(maxsize=256)
+def build_interaction_payload(site, name, modified):
+    """Build the interactive block for a template once per template version (a new modified is a new cache key)."""
+    template_doc = frappe.get_cached_doc("WhatsApp Interaction Message Templates", name)
     interactive = {
         "type": "button",
         "body": {
-            "text": whatsapp_interaction_message_template_doc.message
+            "text": template_doc.message
         },
         "action": {
-            "buttons": buttons
+            "buttons": [
+                {
+                    "type": "reply",
+                    "reply": {
+                        "id": button.reply_id,
+                        "title": button.button_label
+                    }
+                }
+                for button in template_doc.whatsapp_interaction_message_template_buttons
+            ]
         }
     }
 
-    if whatsapp_interaction_message_template_doc.header_image:
+    if template_doc.header_image:
         interactive["header"] = {
             "type": "image",
             "image": {
-                "link": frappe.utils.get_url() + "/" + whatsapp_interaction_message_template_doc.header_image
+                "link": frappe.utils.get_url() + "/" + template_doc.header_image
             }
         }
 
+    return interactive
+
+def send_interaction(crm_lead_doc, whatsapp_id, whatsapp_interaction_message_template):
+    whatsapp_interaction_message_template_doc = frappe.get_cached_doc("WhatsApp Interaction Message Templates", whatsapp_interaction_message_template)
+    interactive = build_interaction_payload(frappe.local.site, whatsapp_interaction_message_template_doc.name, whatsapp_interaction_message_template_doc.modified)
+    settings = get_whatsapp_credentials()
+    headers = {
+        "authorization": f"Bearer {settings.token}",
+        "content-type": "application/json",
+    }
+
     data = {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
@@ -2546,10 +2532,10 @@ def send_interaction_with_delay(crm_lead_doc, whatsapp_id, whatsapp_interaction_
         "type": "interactive",
         "interactive": interactive
     }
-    response = make_post_request(
+    response = post_json(
         f"{settings.url}/{settings.version}/{settings.phone_id}/messages",
         headers=headers,
-        data=json.dumps(data),
+        data=data,
     )
     message_id = response["messages"][0]["id"]
     frappe.db.set_value("CRM Lead", crm_lead_doc.name, "latest_whatsapp_interaction_message_templates", whatsapp_interaction_message_template)
@@ -2582,10 +2568,10 @@ def send_message(crm_lead_doc, whatsapp_id, text):
     whatsapp_message_reply.insert(ignore_permissions=True)
 
 def send_interactive_message(crm_lead_doc, whatsapp_id, text, buttons):
-    whatsapp_settings = frappe.get_single("WhatsApp Settings")
+    whatsapp_settings = get_whatsapp_credentials()
 
     WHATSAPP_SEND_MESSAGE_URL = "{0}/{1}/{2}/messages".format(whatsapp_settings.url, whatsapp_settings.version, whatsapp_settings.phone_id)
-    BEARER_TOKEN = whatsapp_settings.get_password("token")
+    BEARER_TOKEN = whatsapp_settings.token
 
     request_body = {
         "messaging_product": "whatsapp",
@@ -2609,7 +2595,7 @@ def send_interactive_message(crm_lead_doc, whatsapp_id, text, buttons):
     }
 
     try:
-        response = requests.post(WHATSAPP_SEND_MESSAGE_URL, data=json.dumps(request_body), headers=headers, timeout=5)
+        response = _SESSION.post(WHATSAPP_SEND_MESSAGE_URL, data=orjson.dumps(request_body), headers=headers, timeout=5)
         message_id = response.json()["messages"][0]["id"]
         doc = frappe.new_doc("WhatsApp Message")
         doc.update(
@@ -2643,12 +2629,12 @@ def send_location_request_message(crm_lead_doc, whatsapp_id, text):
     Based on WhatsApp Cloud API:
     https://developers.facebook.com/docs/whatsapp/cloud-api/messages/location-request-messages
     """
-    whatsapp_settings = frappe.get_single("WhatsApp Settings")
+    whatsapp_settings = get_whatsapp_credentials()
 
     WHATSAPP_SEND_MESSAGE_URL = "{0}/{1}/{2}/messages".format(
         whatsapp_settings.url, whatsapp_settings.version, whatsapp_settings.phone_id
     )
-    BEARER_TOKEN = whatsapp_settings.get_password("token")
+    BEARER_TOKEN = whatsapp_settings.token
 
     request_body = {
         "messaging_product": "whatsapp",
@@ -2672,9 +2658,9 @@ def send_location_request_message(crm_lead_doc, whatsapp_id, text):
     }
 
     try:
-        response = requests.post(
+        response = _SESSION.post(
             WHATSAPP_SEND_MESSAGE_URL,
-            data=json.dumps(request_body),
+            data=orjson.dumps(request_body),
             headers=headers,
             timeout=5
         )
@@ -2712,10 +2698,10 @@ def send_interactive_cta_message_with_delay(crm_lead_doc, whatsapp_id, text, cta
     send_interactive_cta_message(crm_lead_doc, whatsapp_id, text, cta_label, cta_url)
 
 def send_interactive_cta_message(crm_lead_doc, whatsapp_id, text, cta_label, cta_url):
-    whatsapp_settings = frappe.get_single("WhatsApp Settings")
+    whatsapp_settings = get_whatsapp_credentials()
 
     WHATSAPP_SEND_MESSAGE_URL = "{0}/{1}/{2}/messages".format(whatsapp_settings.url, whatsapp_settings.version, whatsapp_settings.phone_id)
-    BEARER_TOKEN = whatsapp_settings.get_password("token")
+    BEARER_TOKEN = whatsapp_settings.token
 
     request_body = {
         "messaging_product": "whatsapp",
@@ -2743,7 +2729,7 @@ def send_interactive_cta_message(crm_lead_doc, whatsapp_id, text, cta_label, cta
     }
 
     try:
-        response = requests.post(WHATSAPP_SEND_MESSAGE_URL, data=json.dumps(request_body), headers=headers, timeout=5)
+        response = _SESSION.post(WHATSAPP_SEND_MESSAGE_URL, data=orjson.dumps(request_body), headers=headers, timeout=5)
         message_id = response.json()["messages"][0]["id"]
         doc = frappe.new_doc("WhatsApp Message")
         doc.update(
@@ -2821,12 +2807,12 @@ def send_interactive_list_message(crm_lead_doc, whatsapp_id, header_text, body_t
     Returns:
         dict: Response containing success status and message_id if successful
     """
-    whatsapp_settings = frappe.get_single("WhatsApp Settings")
+    whatsapp_settings = get_whatsapp_credentials()
 
     WHATSAPP_SEND_MESSAGE_URL = "{0}/{1}/{2}/messages".format(
         whatsapp_settings.url, whatsapp_settings.version, whatsapp_settings.phone_id
     )
-    BEARER_TOKEN = whatsapp_settings.get_password("token")
+    BEARER_TOKEN = whatsapp_settings.token
 
     # Build the interactive list message payload
     interactive = {
@@ -2867,9 +2853,9 @@ def send_interactive_list_message(crm_lead_doc, whatsapp_id, header_text, body_t
     }
 
     try:
-        response = requests.post(
+        response = _SESSION.post(
             WHATSAPP_SEND_MESSAGE_URL,
-            data=json.dumps(request_body),
+            data=orjson.dumps(request_body),
             headers=headers,
             timeout=5
         )
@@ -2938,12 +2924,13 @@ def handle_interactive_list_reply(whatsapp_id, customer_name, list_reply_id, lis
             # Handle face registration for clock in
             set_face_registration_mode(crm_lead_doc, enabled=True)
             enqueue(
-                method=send_message_with_delay,
+                method=send_message,
                 crm_lead_doc=crm_lead_doc,
                 whatsapp_id=whatsapp_id,
                 text="📸 *Face Registration*\n\nPlease take a clear selfie photo of your face and send it here to register for clock in.\n\nMake sure:\n• Your face is clearly visible\n• Good lighting\n• No sunglasses or face coverings",
                 queue="short",
-                is_async=True
+                is_async=True,
+                enqueue_after_commit=True
             )
             return True
 
@@ -2953,22 +2940,24 @@ def handle_interactive_list_reply(whatsapp_id, customer_name, list_reply_id, lis
             if action == "in":
                 set_clock_log_type(crm_lead_doc, "IN")
                 enqueue(
-                    method=send_location_request_message_with_delay,
+                    method=send_location_request_message,
                     crm_lead_doc=crm_lead_doc,
                     whatsapp_id=whatsapp_id,
                     text="Please share your location to complete clock in.",
                     queue="short",
-                    is_async=True
+                    is_async=True,
+                    enqueue_after_commit=True
                 )
             elif action == "out":
                 set_clock_log_type(crm_lead_doc, "OUT")
                 enqueue(
-                    method=send_location_request_message_with_delay,
+                    method=send_location_request_message,
                     crm_lead_doc=crm_lead_doc,
                     whatsapp_id=whatsapp_id,
                     text="Please share your location to complete clock out.",
                     queue="short",
-                    is_async=True
+                    is_async=True,
+                    enqueue_after_commit=True
                 )
             return True
 
@@ -2997,12 +2986,13 @@ def handle_interactive_list_reply(whatsapp_id, customer_name, list_reply_id, lis
             )
 
             enqueue(
-                method=send_message_with_delay,
+                method=send_message,
                 crm_lead_doc=crm_lead_doc,
                 whatsapp_id=whatsapp_id,
                 text=leave_prompt,
                 queue="short",
-                is_async=True
+                is_async=True,
+                enqueue_after_commit=True
             )
             return True
 
@@ -3010,12 +3000,13 @@ def handle_interactive_list_reply(whatsapp_id, customer_name, list_reply_id, lis
             # Handle schedule viewing options
             schedule_option = list_reply_id.replace("schedule_", "")
             enqueue(
-                method=send_message_with_delay,
+                method=send_message,
                 crm_lead_doc=crm_lead_doc,
                 whatsapp_id=whatsapp_id,
                 text=f"Fetching your {schedule_option} schedule...",
                 queue="short",
-                is_async=True
+                is_async=True,
+                enqueue_after_commit=True
             )
             return True
 
@@ -3043,8 +3034,17 @@ def handle_interactive_list_reply(whatsapp_id, customer_name, list_reply_id, lis
         )
         return False
 
-def get_crm_lead(whatsapp_id, customer_name):
+def get_crm_lead(whatsapp_id, customer_name, minimal=False):
+    """Return the CRM Lead for whatsapp_id, creating it if missing.
+
+    minimal returns only the columns reply senders read (no controller or child tables); use it when the lead is not modified.
+    """
     reference_name, doctype = get_lead_or_deal_from_number(whatsapp_id)
+    if reference_name and minimal:
+        crm_lead = frappe.db.get_value("CRM Lead", reference_name, CRM_LEAD_MINIMAL_FIELDS, as_dict=True)
+        if crm_lead:
+            crm_lead.doctype = "CRM Lead"
+            return crm_lead
     if not reference_name:
         crm_lead_doc = frappe.new_doc("CRM Lead")
         crm_lead_doc.lead_name = customer_name
@@ -3058,89 +3058,83 @@ def get_crm_lead(whatsapp_id, customer_name):
     return crm_lead_doc
 
 def is_not_within_operating_hours():
-    current_datetime = get_datetime()
-
-    # Define time range
-    start = datetime.time(9, 0)   # 9:00 AM
-    end = datetime.time(17, 0)    # 5:00 PM
-
-    # Check if current time is within range
-    if start <= current_datetime.time() <= end:
-        return False
-
-    return True
+    return not OPERATING_HOURS_START <= now_datetime().time() <= OPERATING_HOURS_END
 
 def is_not_within_booking_hours():
-    current_datetime = get_datetime()
-
-    # Define time range
-    start = datetime.time(8, 45)   # 08:45 AM
-    end = datetime.time(21, 0)    # 9:00 PM
+    return not BOOKING_HOURS_START <= now_datetime().time() <= BOOKING_HOURS_END
 
-    # Check if current time is within range
-    if start <= current_datetime.time() <= end:
-        return False
-
-    return True
+def ensure_booking_follow_up(crm_lead, whatsapp_id):
+    """Queue the next booking-hours follow-up for a lead; the unique crm_lead index drops repeats."""
+    try:
+        frappe.get_doc({
+            "doctype": "Booking Follow Up",
+            "whatsapp_id": whatsapp_id,
+            "crm_lead": crm_lead
+        }).insert(ignore_permissions=True)
+    except frappe.UniqueValidationError:
+        frappe.clear_last_message()
 
 def send_booking_follow_up():
-    booking_follow_ups = frappe.db.get_all("Booking Follow Up", fields=["whatsapp_id", "crm_lead"])
+    booking_follow_ups = frappe.db.get_all("Booking Follow Up", fields=["name", "whatsapp_id", "crm_lead"])
     for booking_follow_up in booking_follow_ups:
-        enqueue(method=send_message_with_delay, crm_lead_doc=frappe.get_doc("CRM Lead", booking_follow_up.crm_lead), whatsapp_id=booking_follow_up.whatsapp_id, text=OUT_OF_BOOKING_HOURS_FOLLOW_UP_MESSAGE, queue="short", is_async=True)
-    frappe.db.truncate("Booking Follow Up")
+        # send_message only links the reply to the lead, so its name is all the job needs
+        crm_lead = frappe._dict(doctype="CRM Lead", name=booking_follow_up.crm_lead)
+        enqueue(method=send_message, crm_lead_doc=crm_lead, whatsapp_id=booking_follow_up.whatsapp_id, text=OUT_OF_BOOKING_HOURS_FOLLOW_UP_MESSAGE, queue="short", is_async=True, enqueue_after_commit=True)
+    # delete only what was sent; follow-ups added meanwhile wait for the next run
+    if booking_follow_ups:
+        frappe.db.delete("Booking Follow Up", {"name": ["in", [booking_follow_up.name for booking_follow_up in booking_follow_ups]]})
 
 def send_chat_closing_reminder():
-    unclosed_crm_leads = frappe.db.get_all("CRM Lead Assignment", filters={"whatsapp_message_templates": ["!=", "BookingHL"], "status": ["!=", "Case Closed"]}, pluck="crm_lead")
-    unclosed_crm_leads = list(set(unclosed_crm_leads))
+    unclosed_crm_leads = frappe.db.get_all("CRM Lead Assignment", filters={"status": ["in", OPEN_ASSIGNMENT_STATUSES], "whatsapp_message_templates": ["!=", "BookingHL"]}, pluck="crm_lead", distinct=True)
     crm_leads = frappe.db.get_all("CRM Lead", filters={"name": ["in", unclosed_crm_leads], "sent_chat_closing_reminder": 0, "last_message_from_me": 1, "chat_close_at": ["<=", get_datetime()]}, fields=["name", "mobile_no"])
     for crm_lead in crm_leads:
         if crm_lead.mobile_no:
             crm_lead_doc = frappe.get_doc("CRM Lead", crm_lead.name)
-            enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=crm_lead.mobile_no, text=CHAT_CLOSING_MESSAGE, queue="short", is_async=True)
+            enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=crm_lead.mobile_no, text=CHAT_CLOSING_MESSAGE, queue="short", is_async=True, enqueue_after_commit=True)
             crm_lead_doc.sent_chat_closing_reminder = True
             crm_lead_doc.save(ignore_permissions=True)
 
-    unclosed_crm_leads = frappe.db.get_all("CRM Lead Assignment", filters={"status": "Completed"}, pluck="crm_lead")
-    unclosed_crm_leads = list(set(unclosed_crm_leads))
-    if unclosed_crm_leads:
-        crm_leads = frappe.db.get_all("CRM Lead", filters={"name": ["in", unclosed_crm_leads], "chat_close_at": ["<=", add_to_date(get_datetime(), hours=-2)], "last_reply_at": ["<=", add_to_date(get_datetime(), days=-1)]}, pluck="name")
-        if crm_leads:
-            crm_leads_to_close = frappe.db.get_all("CRM Lead Assignment", filters={"crm_lead": ["in", crm_leads], "status": "Completed"}, pluck="name")
-            for crm_lead_to_close in crm_leads_to_close:
-                frappe.db.set_value("CRM Lead Assignment", crm_lead_to_close, {
-                    "status": "Case Closed",
-                    "accepted_by": None
-                })
-            taggings_to_close = frappe.db.get_all("CRM Lead Tagging", filters={"crm_lead": ["in", crm_leads], "status": "Open"}, pluck="name")
-            for tagging_to_close in taggings_to_close:
-                frappe.db.set_value("CRM Lead Tagging", tagging_to_close, {
-                    "status": "Closed"
-                })
-
-    frappe.db.commit()
-    crm_leads = frappe.db.get_all("CRM Lead", filters=[["CRM Lead", "chat_close_at", "is", "set"], ["CRM Lead", "chat_close_at", "<=", add_to_date(get_datetime(), hours=-2)]], pluck="name")
-    for crm_lead in crm_leads:
-        frappe.db.set_value("CRM Lead", crm_lead, {
-            "conversation_start_at": None,
-            "last_reply_by_user": None,
-            "last_reply_by": None,
-            "last_reply_at": None,
-            "chat_close_at": None,
+    crm_leads = frappe.db.sql_list(
+        """SELECT DISTINCT `tabCRM Lead Assignment`.crm_lead
+        FROM `tabCRM Lead Assignment`
+        INNER JOIN `tabCRM Lead` ON `tabCRM Lead`.name = `tabCRM Lead Assignment`.crm_lead
+        WHERE `tabCRM Lead Assignment`.status = 'Completed'
+            AND `tabCRM Lead`.chat_close_at <= %(chat_close_before)s
+            AND `tabCRM Lead`.last_reply_at <= %(last_reply_before)s""",
+        {
+            "chat_close_before": add_to_date(get_datetime(), hours=-2),
+            "last_reply_before": add_to_date(get_datetime(), days=-1),
+        }
+    )
+    if crm_leads:
+        # filter-based set_value issues one UPDATE for all matching rows
+        frappe.db.set_value("CRM Lead Assignment", {"crm_lead": ["in", crm_leads], "status": "Completed"}, {
+            "status": "Case Closed",
+            "accepted_by": None
+        })
+        frappe.db.set_value("CRM Lead Tagging", {"crm_lead": ["in", crm_leads], "status": "Open"}, {
+            "status": "Closed"
         })
 
-def get_existing_crm_lead_assignments(crm_lead, whatsapp_message_templates):
-    return frappe.db.get_all("CRM Lead Assignment", filters={"crm_lead": crm_lead, "whatsapp_message_templates": whatsapp_message_templates}, pluck="name")
+    frappe.db.commit()
+    # chat_close_at <= cutoff already excludes leads where it is not set
+    frappe.db.set_value("CRM Lead", {"chat_close_at": ["<=", add_to_date(get_datetime(), hours=-2)]}, {
+        "conversation_start_at": None,
+        "last_reply_by_user": None,
+        "last_reply_by": None,
+        "last_reply_at": None,
+        "chat_close_at": None,
+    })
 
 def create_crm_lead_assignment(crm_lead, whatsapp_message_templates, status=None):
     if not whatsapp_message_templates:
         return
-    is_crm_agent_template = frappe.db.get_value("WhatsApp Message Templates", whatsapp_message_templates, "is_crm_agent_template")
-    existing_crm_lead_assignments = get_existing_crm_lead_assignments(crm_lead, whatsapp_message_templates)
-    if existing_crm_lead_assignments:
-        for existing_crm_lead_assignment in existing_crm_lead_assignments:
-            frappe.db.set_value("CRM Lead Assignment", existing_crm_lead_assignment, {
-                "status": status or ("New" if is_crm_agent_template else "Completed")
-            })
+    is_crm_agent_template = frappe.get_cached_value("WhatsApp Message Templates", whatsapp_message_templates, "is_crm_agent_template")
+    filters = {"crm_lead": crm_lead, "whatsapp_message_templates": whatsapp_message_templates}
+    if frappe.db.exists("CRM Lead Assignment", filters):
+        frappe.db.set_value("CRM Lead Assignment", filters, {
+            "status": status or ("New" if is_crm_agent_template else "Completed")
+        })
     else:
         frappe.get_doc({
             "doctype": "CRM Lead Assignment",
@@ -3155,16 +3149,12 @@ def create_crm_lead_assignment(crm_lead, whatsapp_message_templates, status=None
             "whatsapp_message_templates": "automated_message"
         })
 
-def get_existing_crm_taggings(crm_lead, tagging):
-    return frappe.db.get_all("CRM Lead Tagging", filters={"crm_lead": crm_lead, "tagging": tagging}, pluck="name")
-
 def create_crm_tagging_assignment(crm_lead, tagging, status=None):
     if not tagging:
         return
-    existing_crm_taggings = get_existing_crm_taggings(crm_lead, tagging)
-    if existing_crm_taggings:
-        for existing_crm_tagging in existing_crm_taggings:
-            frappe.db.set_value("CRM Lead Tagging", existing_crm_tagging, "status", status if status else "Open")
+    filters = {"crm_lead": crm_lead, "tagging": tagging}
+    if frappe.db.exists("CRM Lead Tagging", filters):
+        frappe.db.set_value("CRM Lead Tagging", filters, "status", status if status else "Open")
     else:
         frappe.get_doc({
             "doctype": "CRM Lead Tagging",
@@ -3178,69 +3168,73 @@ def create_crm_tagging_assignment(crm_lead, tagging, status=None):
             "tagging": "Unknown"
         })
 
-def handle_membership_rate_request(crm_lead_doc, whatsapp_id):
-    frappe.flags.skip_lead_status_update = True
-    create_crm_lead_assignment(crm_lead_doc.name, "BookingHL", "Completed")
-    integration_settings = frappe.db.get_all("Integration Settings", filters={"active": 1}, pluck="name")
-    for integration_setting in integration_settings:
-        integration_settings_doc = frappe.get_doc("Integration Settings", integration_setting)
-        url = integration_settings_doc.site_url + REQUEST_MEMBERSHIP_RATE_ENDPOINT
+def post_to_integrations(endpoint, request_body):
+    """POST request_body to endpoint on every active Integration Settings site and return the JSON of those that answered.
 
+    request_body may be a callable taking the settings doc for per-site fields. Sites are called concurrently so one slow
+    site does not add its timeout to the others; failures are logged, not raised.
+    """
+    integration_requests = []
+    for integration_setting in frappe.db.get_all("Integration Settings", filters={"active": 1}, pluck="name"):
+        integration_settings_doc = frappe.get_doc("Integration Settings", integration_setting)
         headers = {
             "Authorization": "Basic {0}".format(integration_settings_doc.get_password("access_token")),
             "Content-Type": "application/json"
         }
+        body = request_body(integration_settings_doc) if callable(request_body) else request_body
+        integration_requests.append((integration_settings_doc.site_url + endpoint, body, headers))
+
+    # worker threads only do HTTP; all frappe calls stay on this thread
+    def post(integration_request):
+        url, body, headers = integration_request
+        response = _SESSION.post(url, json=body, headers=headers, timeout=30)  # 30 seconds timeout
+        response.raise_for_status()
+        return response.json()
+
+    if len(integration_requests) > 1:
+        with ThreadPoolExecutor(max_workers=len(integration_requests)) as executor:
+            futures = [executor.submit(post, integration_request) for integration_request in integration_requests]
+    else:
+        futures = None
 
-        request_body = {
-            "mobile": whatsapp_id,
-        }
-
+    results = []
+    for index, integration_request in enumerate(integration_requests):
         try:
-            response = requests.post(url, json=request_body, headers=headers, timeout=30)  # 30 seconds timeout
-            response.raise_for_status()
-            response_data = response.json()
-            if response_data.get("message"):
-                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=response_data["message"], queue="short", is_async=True)
-        except requests.Timeout:
-            frappe.throw("Request timed out after 30 seconds")
-        except requests.RequestException as e:
-            frappe.throw(f"An error occurred: {e}")
+            response_data = futures[index].result() if futures else post(integration_request)
+        except requests.RequestException:
+            frappe.log_error(title="Integration Request Error", message=f"{integration_request[0]}\n{frappe.get_traceback()}")
+            continue
+        results.append(response_data)
+    return results
 
-def handle_free_membership_redemption(crm_lead_doc, whatsapp_id, message):
+def handle_membership_rate_request(crm_lead_doc, whatsapp_id):
     frappe.flags.skip_lead_status_update = True
     create_crm_lead_assignment(crm_lead_doc.name, "BookingHL", "Completed")
-    free_member_subscription_id = message.split(":")[-1].strip().lower()
-    integration_settings = frappe.db.get_all("Integration Settings", filters={"active": 1}, pluck="name")
-    for integration_setting in integration_settings:
-        integration_settings_doc = frappe.get_doc("Integration Settings", integration_setting)
-        url = integration_settings_doc.site_url + FREE_MEMBERSHIP_REDEMPTION_ENDPOINT
+    request_body = {
+        "mobile": whatsapp_id,
+    }
 
-        headers = {
-            "Authorization": "Basic {0}".format(integration_settings_doc.get_password("access_token")),
-            "Content-Type": "application/json"
-        }
+    for response_data in post_to_integrations(REQUEST_MEMBERSHIP_RATE_ENDPOINT, request_body):
+        if response_data.get("message"):
+            enqueue(method=send_message, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=response_data["message"], queue="short", is_async=True, enqueue_after_commit=True)
 
-        request_body = {
-            "mobile": whatsapp_id,
-            "free_member_subscription_id": free_member_subscription_id,
-        }
+def handle_free_membership_redemption(crm_lead_doc, whatsapp_id, message):
+    frappe.flags.skip_lead_status_update = True
+    create_crm_lead_assignment(crm_lead_doc.name, "BookingHL", "Completed")
+    free_member_subscription_id = message.split(":")[-1].strip().lower()
+    request_body = {
+        "mobile": whatsapp_id,
+        "free_member_subscription_id": free_member_subscription_id,
+    }
 
-        try:
-            response = requests.post(url, json=request_body, headers=headers, timeout=30)  # 30 seconds timeout
-            response.raise_for_status()
-            response_data = response.json()
-            if response_data.get("message"):
-                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=response_data["message"], queue="short", is_async=True)
-            if response_data.get("message_2"):
-                enqueue(method=send_message_with_delay, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, text=response_data["message_2"], queue="short", is_async=True)
-            if response_data.get("shared_by") and response_data.get("message_shared_by"):
-                reference_name, doctype = get_lead_or_deal_from_number(response_data["shared_by"])
-                shared_by_crm_lead_doc = frappe.get_doc(doctype, reference_name)
-                enqueue(method=send_message_with_delay, crm_lead_doc=shared_by_crm_lead_doc, whatsapp_id=response_data["shared_by"], text=response_data["message_shared_by"], queue="short", is_async=True)
-        except requests.Timeout:
-            frappe.throw("Request timed out after 30 seconds")
-        except requests.RequestException as e:
-            frappe.throw(f"An error occurred: {e}")
+    for response_data in post_to_integrations(FREE_MEMBERSHIP_REDEMPTION_ENDPOINT, request_body):
+        outbox = [{"text": response_data[key]} for key in ("message", "message_2") if response_data.get(key)]
+        if outbox:
+            enqueue(method=send_messages, crm_lead_doc=crm_lead_doc, whatsapp_id=whatsapp_id, messages=outbox, queue="short", is_async=True, enqueue_after_commit=True)
+        if response_data.get("shared_by") and response_data.get("message_shared_by"):
+            reference_name, doctype = get_lead_or_deal_from_number(response_data["shared_by"])
+            shared_by_crm_lead_doc = frappe.get_doc(doctype, reference_name)
+            enqueue(method=send_message, crm_lead_doc=shared_by_crm_lead_doc, whatsapp_id=response_data["shared_by"], text=response_data["message_shared_by"], queue="short", is_async=True, enqueue_after_commit=True)
 
 def handle_checkout_login(crm_lead_doc, whatsapp_id, message):
     frappe.flags.skip_lead_status_update = True
@@ -3249,35 +3243,17 @@ def handle_checkout_login(crm_lead_doc, whatsapp_id, message):
         parts = message.split("OTP:", 1)
         message = parts[1].strip() if len(parts) > 1 else "XXXXXX"
 
-    integration_settings = frappe.db.get_all("Integration Settings", filters={"active": 1}, pluck="name")
-    for integration_setting in integration_settings:
-        integration_settings_doc = frappe.get_doc("Integration Settings", integration_setting)
-        url = integration_settings_doc.site_url + CHECKOUT_LOGIN_ENDPOINT
-
-        headers = {
-            "Authorization": "Basic {0}".format(integration_settings_doc.get_password("access_token")),
-            "Content-Type": "application/json"
-        }
-
-        request_body = {
+    def build_request_body(integration_settings_doc):
+        return {
             "mobile_no": whatsapp_id,
             "first_name": crm_lead_doc.lead_name,
             "otp": message,
             "outlet": integration_settings_doc.outlet,
         }
 
-        try:
-            response = requests.post(url, json=request_body, headers=headers, timeout=30)  # 30 seconds timeout
-            response.raise_for_status()
-            response_data = response.json()
-
-            if response_data.get("message") and response_data.get("cta_url") and response_data.get("cta_label"):
-                send_interactive_cta_message_with_delay(crm_lead_doc, whatsapp_id, response_data["message"], response_data["cta_label"], response_data["cta_url"])
-
-        except requests.Timeout:
-            frappe.throw("Request timed out after 30 seconds")
-        except requests.RequestException as e:
-            frappe.throw(f"An error occurred: {e}")
+    for response_data in post_to_integrations(CHECKOUT_LOGIN_ENDPOINT, build_request_body):
+        if response_data.get("message") and response_data.get("cta_url") and response_data.get("cta_label"):
+            send_interactive_cta_message(crm_lead_doc, whatsapp_id, response_data["message"], response_data["cta_label"], response_data["cta_url"])
 
 def handle_registration(crm_lead_doc, whatsapp_id, message):
     frappe.flags.skip_lead_status_update = True
@@ -3285,33 +3261,14 @@ def handle_registration(crm_lead_doc, whatsapp_id, message):
     parts = message.split("OTP:", 1)
     message = parts[1].strip() if len(parts) > 1 else "XXXXXX"
 
-    integration_settings = frappe.db.get_all("Integration Settings", filters={"active": 1}, pluck="name")
-    for integration_setting in integration_settings:
-        integration_settings_doc = frappe.get_doc("Integration Settings", integration_setting)
-        url = integration_settings_doc.site_url + REGISTRATION_ENDPOINT
-
-        headers = {
-            "Authorization": "Basic {0}".format(integration_settings_doc.get_password("access_token")),
-            "Content-Type": "application/json"
-        }
-
-        request_body = {
-            "mobile_no": whatsapp_id,
-            "otp": message,
-        }
-
-        try:
-            response = requests.post(url, json=request_body, headers=headers, timeout=30)  # 30 seconds timeout
-            response.raise_for_status()
-            response_data = response.json()
-
-            if response_data.get("message") and response_data.get("cta_url") and response_data.get("cta_label"):
-                send_interactive_cta_message_with_delay(crm_lead_doc, whatsapp_id, response_data["message"], response_data["cta_label"], response_data["cta_url"])
+    request_body = {
+        "mobile_no": whatsapp_id,
+        "otp": message,
+    }
 
-        except requests.Timeout:
-            frappe.throw("Request timed out after 30 seconds")
-        except requests.RequestException as e:
-            frappe.throw(f"An error occurred: {e}")
+    for response_data in post_to_integrations(REGISTRATION_ENDPOINT, request_body):
+        if response_data.get("message") and response_data.get("cta_url") and response_data.get("cta_label"):
+            send_interactive_cta_message(crm_lead_doc, whatsapp_id, response_data["message"], response_data["cta_label"], response_data["cta_url"])
 
 def handle_reset_password(crm_lead_doc, whatsapp_id, message):
     frappe.flags.skip_lead_status_update = True
@@ -3319,30 +3276,11 @@ def handle_reset_password(crm_lead_doc, whatsapp_id, message):
     parts = message.split("OTP:", 1)
     message = parts[1].strip() if len(parts) > 1 else "XXXXXX"
 
-    integration_settings = frappe.db.get_all("Integration Settings", filters={"active": 1}, pluck="name")
-    for integration_setting in integration_settings:
-        integration_settings_doc = frappe.get_doc("Integration Settings", integration_setting)
-        url = integration_settings_doc.site_url + RESET_PASSWORD_ENDPOINT
-
-        headers = {
-            "Authorization": "Basic {0}".format(integration_settings_doc.get_password("access_token")),
-            "Content-Type": "application/json"
-        }
-
-        request_body = {
-            "mobile_no": whatsapp_id,
-            "otp": message,
-        }
-
-        try:
-            response = requests.post(url, json=request_body, headers=headers, timeout=30)  # 30 seconds timeout
-            response.raise_for_status()
-            response_data = response.json()
-
-            if response_data.get("message") and response_data.get("cta_url") and response_data.get("cta_label"):
-                send_interactive_cta_message_with_delay(crm_lead_doc, whatsapp_id, response_data["message"], response_data["cta_label"], response_data["cta_url"])
+    request_body = {
+        "mobile_no": whatsapp_id,
+        "otp": message,
+    }
 
-        except requests.Timeout:
-            frappe.throw("Request timed out after 30 seconds")
-        except requests.RequestException as e:
-            frappe.throw(f"An error occurred: {e}")
\ No newline at end of file
+    for response_data in post_to_integrations(RESET_PASSWORD_ENDPOINT, request_body):
+        if response_data.get("message") and response_data.get("cta_url") and response_data.get("cta_label"):
+            send_interactive_cta_message(crm_lead_doc, whatsapp_id, response_data["message"], response_data["cta_label"], response_data["cta_url"])
\ No newline at end of file
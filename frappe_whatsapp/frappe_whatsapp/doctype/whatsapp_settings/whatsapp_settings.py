@@ -1,8 +1,10 @@
 # Copyright (c) 2022, Shridhar Patil and contributors
 # For license information, please see license.txt
 
-# import frappe
 from frappe.model.document import Document
 
 class WhatsAppSettings(Document):
-	pass
+	def on_update(self):
+		from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.whatsapp_message import clear_whatsapp_credentials
+
+		clear_whatsapp_credentials()
@@ -0,0 +1,14 @@
+import frappe
+
+
+def execute():
+	"""Keep one Booking Follow Up per CRM Lead before crm_lead becomes unique."""
+	if not frappe.db.table_exists("Booking Follow Up"):
+		return
+
+	seen = set()
+	for follow_up in frappe.db.get_all("Booking Follow Up", fields=["name", "crm_lead"], order_by="creation asc"):
+		if follow_up.crm_lead in seen:
+			frappe.db.delete("Booking Follow Up", {"name": follow_up.name})
+		else:
+			seen.add(follow_up.crm_lead)
@@ -1,17 +1,20 @@
 import frappe
-from frappe.utils.user import get_users_with_role
 
 def whatsapp_template_query(user):
     if not user:
         user = frappe.session.user
 
-    user_roles = frappe.get_roles()
+    user_roles = frappe.get_roles(user)
 
     if "System Manager" in user_roles:
         return ""
 
     if "Booking Centre" in user_roles:
-        users = get_users_with_role("Booking Centre")
-        return """`tabWhatsApp Templates`.owner IN ({0}) """.format(",".join(frappe.db.escape(user) for user in users))
+        # same set as get_users_with_role, resolved by the database instead of inlining every escaped name
+        return """`tabWhatsApp Templates`.owner IN (
+            SELECT `tabHas Role`.parent FROM `tabHas Role`
+            INNER JOIN `tabUser` ON `tabUser`.name = `tabHas Role`.parent
+            WHERE `tabHas Role`.role = 'Booking Centre' AND `tabHas Role`.parenttype = 'User' AND `tabUser`.enabled = 1
+        ) """
 
-    return """`tabWhatsApp Templates`.owner = "{0}" """.format(user)
\ No newline at end of file
+    return """`tabWhatsApp Templates`.owner = {0} """.format(frappe.db.escape(user))
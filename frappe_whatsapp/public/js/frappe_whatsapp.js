@@ -62,7 +62,7 @@ $(document).on('app_ready', function () {
 										},
 										freeze: true,
 										callback: (r) => {
-											frappe.msgprint(__("Successfully Sent to: " + values.mobile_no));
+											frappe.msgprint(__("Queued for sending to: " + values.mobile_no));
 											dialog.hide();
 										}
 									});
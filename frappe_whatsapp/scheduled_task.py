@@ -1,14 +1,26 @@
 import frappe
 import json
+from collections import defaultdict
 from frappe.utils import get_datetime, now_datetime, add_days
 from frappe.utils.user import get_users_with_role
 from frappe.integrations.utils import make_post_request
 import requests
 from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.whatsapp_message import create_crm_lead_assignment
+from frappe_whatsapp.frappe_whatsapp.doctype.push_notification_log.push_notification_log import create_push_notifications
 
 def send_noficiation_for_new_crm_leads():
     crm_agents = get_users_with_role("CRM Agent")
+    if not crm_agents:
+        return
+
+    # one lookup for every agent's devices; agents without any have nobody to notify
+    push_notification_subscriptions = defaultdict(list)
+    for push_notification_subscription in frappe.db.get_all("Push Notification Subscription", filters={"user": ["in", crm_agents]}, fields=["name", "user"]):
+        push_notification_subscriptions[push_notification_subscription.user].append(push_notification_subscription.name)
+
     for crm_agent in crm_agents:
+        if not push_notification_subscriptions[crm_agent]:
+            continue
         assigned_templates = frappe.db.get_all("User Permission", filters={"user": crm_agent, "allow": "WhatsApp Message Templates"}, pluck="for_value")
         if assigned_templates:
             uncompleted_assignments = frappe.db.get_all("CRM Lead Assignment", filters={
@@ -16,14 +28,14 @@ def send_noficiation_for_new_crm_leads():
                 "status": "New"
             }, pluck="crm_lead")
             if uncompleted_assignments:
-                send_push_notification(crm_agent, "🎉 Yay! New Messages!", f"📩 You have {len(uncompleted_assignments)} unread messages waiting for you! Tap to check them out!", url="https://crm.techmind.com.my/crm/leads/{0}#whatsapp".format(uncompleted_assignments[0]))
+                send_push_notification(crm_agent, "🎉 Yay! New Messages!", f"📩 You have {len(uncompleted_assignments)} unread messages waiting for you! Tap to check them out!", url="https://crm.techmind.com.my/crm/leads/{0}#whatsapp".format(uncompleted_assignments[0]), push_notification_subscriptions=push_notification_subscriptions[crm_agent])
         else:
             uncompleted_assignments = frappe.db.get_all("CRM Lead Assignment", filters={
                 "whatsapp_message_templates": ["!=", "automated_message"],
                 "status": "New"
             }, pluck="crm_lead")
             if uncompleted_assignments:
-                send_push_notification(crm_agent, "🎉 Yay! New Messages!", f"📩 You have {len(uncompleted_assignments)} unread messages waiting for you! Tap to check them out!", url="https://crm.techmind.com.my/crm/leads/{0}#whatsapp".format(uncompleted_assignments[0]))
+                send_push_notification(crm_agent, "🎉 Yay! New Messages!", f"📩 You have {len(uncompleted_assignments)} unread messages waiting for you! Tap to check them out!", url="https://crm.techmind.com.my/crm/leads/{0}#whatsapp".format(uncompleted_assignments[0]), push_notification_subscriptions=push_notification_subscriptions[crm_agent])
 
 def check_pending_whatsapp_messages():
     """Check for pending WhatsApp messages and send template notification to customers."""
@@ -159,15 +171,8 @@ def cleanup_pending_whatsapp_messages():
     if crm_leads_to_check:
         frappe.db.commit()
 
-def send_push_notification(user, title, message, url=None):
-    push_notification_subscriptions = frappe.db.get_all("Push Notification Subscription", filters={"user": user}, pluck="name")
-    for push_notification_subscription in push_notification_subscriptions:
-        push_notification = frappe.new_doc("Push Notification Log")
-        push_notification.push_notification_subscription = push_notification_subscription
-        push_notification.title = title
-        push_notification.message = message
-        push_notification.url = url
-        push_notification.insert(ignore_permissions=True)
+def send_push_notification(user, title, message, url=None, push_notification_subscriptions=None):
+    create_push_notifications(user, title, message, url, push_notification_subscriptions)
 
 def sync_outlets():
     integration_settings = frappe.db.get_all("Integration Settings", filters={"active": 1}, pluck="name")
@@ -7,7 +7,10 @@ from werkzeug.wrappers import Response
 import frappe.utils
 from frappe.utils.background_jobs import enqueue
 from datetime import datetime, timedelta
-from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.whatsapp_message import CHAT_CLOSING_MESSAGE
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.whatsapp_message import CHAT_CLOSING_MESSAGE, get_whatsapp_credentials, _SESSION
+
+# incoming message types whose payload is fetched from the Graph API media endpoint
+MEDIA_MESSAGE_TYPES = frozenset(("image", "audio", "video", "document", "sticker"))
 
 @frappe.whitelist(allow_guest=True)
 def webhook():
@@ -21,9 +24,8 @@ def webhook():
 def get():
 	"""Get."""
 	hub_challenge = frappe.form_dict.get("hub.challenge")
-	webhook_verify_token = frappe.db.get_single_value(
-		"WhatsApp Settings", "webhook_verify_token"
-	)
+	# served from the document cache, which Frappe clears when WhatsApp Settings is saved
+	webhook_verify_token = frappe.get_cached_doc("WhatsApp Settings").webhook_verify_token
 
 	if frappe.form_dict.get("hub.verify_token") != webhook_verify_token:
 		frappe.throw("Verify token does not match")
@@ -39,19 +41,22 @@ def post(form_dict):
 	# 	"meta_data": frappe.as_json(data)
 	# }).insert(ignore_permissions=True)
 
-	frappe.get_doc({
-		"doctype": "WhatsApp Notification Log",
-		"template": "Webhook",
-		"meta_data": json.dumps(data)
-	}).insert(ignore_permissions=True)
+	# Meta sends entry as a list; some relays forward a single entry object
+	entry = data["entry"][0] if isinstance(data["entry"], list) else data["entry"]
+	changes = entry["changes"][0]
+	messages = changes["value"].get("messages", [])
 
-	messages = []
-	try:
-		messages = data["entry"][0]["changes"][0]["value"].get("messages", [])
-		contacts = data["entry"][0]["changes"][0]["value"].get("contacts", [])
-	except KeyError:
-		messages = data["entry"]["changes"][0]["value"].get("messages", [])
-		contacts = data["entry"]["changes"][0]["value"].get("contacts", [])
+	# sent/delivered/read updates outnumber incoming messages, so they are only logged on request
+	if messages or not changes["value"].get("statuses") or frappe.get_cached_doc("WhatsApp Settings").log_status_webhooks:
+		frappe.get_doc({
+			"doctype": "WhatsApp Notification Log",
+			"template": "Webhook",
+			"meta_data": json.dumps(data)
+		}).insert(ignore_permissions=True)
+
+	contacts = changes["value"].get("contacts", [])
+	# every message in one delivery comes from the same contact
+	contact_name = contacts[0].get("profile", {}).get("name") if contacts else None
 
 	if messages:
 		for message in messages:
@@ -59,32 +64,33 @@ def post(form_dict):
 			is_reply = True if message.get('context') and not message.get('context').get('forwarded') else False
 			is_forwarded = True if message.get('context') and message.get('context').get('forwarded') else False
 			reply_to_message_id = message['context']['id'] if is_reply else None
+			# Meta sends epoch seconds; shifted by 8 hours for the outlets' local time
+			timestamp = datetime.fromtimestamp(float(message['timestamp']) + 28800)
+			from_name = contact_name or message['from']
+			# fields shared by every incoming message type; branches add the type-specific ones
+			message_base = {
+				"doctype": "WhatsApp Message",
+				"type": "Incoming",
+				"from": message['from'],
+				"message_id": message['id'],
+				"from_name": from_name,
+				"timestamp": timestamp,
+				"is_forwarded": is_forwarded,
+			}
 			if message_type == 'text':
 				frappe.get_doc({
-					"doctype": "WhatsApp Message",
-					"type": "Incoming",
-					"from": message['from'],
+					**message_base,
 					"message": message['text']['body'],
-					"message_id": message['id'],
 					"reply_to_message_id": reply_to_message_id,
 					"is_reply": is_reply,
 					"content_type": message_type,
-					"from_name": contacts[0].get("profile", {}).get("name") or message['from'],
-					"timestamp": datetime.fromtimestamp(float(message['timestamp']) + 28800),
-					"is_forwarded": is_forwarded,
 				}).insert(ignore_permissions=True)
 			elif message_type == 'reaction':
 				frappe.get_doc({
-					"doctype": "WhatsApp Message",
-					"type": "Incoming",
-					"from": message['from'],
+					**message_base,
 					"message": message['reaction']['emoji'],
 					"reply_to_message_id": message['reaction']['message_id'],
-					"message_id": message['id'],
 					"content_type": "reaction",
-					"from_name": contacts[0].get("profile", {}).get("name") or message['from'],
-					"timestamp": datetime.fromtimestamp(float(message['timestamp']) + 28800),
-					"is_forwarded": is_forwarded,
 				}).insert(ignore_permissions=True)
 			elif message_type == 'interactive':
 				interactive_data = message['interactive']
@@ -93,36 +99,22 @@ def post(form_dict):
 				# Handle button_reply (from interactive button messages)
 				if interactive_type == 'button_reply':
 					frappe.get_doc({
-						"doctype": "WhatsApp Message",
-						"type": "Incoming",
-						"from": message['from'],
+						**message_base,
 						"message": interactive_data['button_reply']['title'],
 						"interactive_id": interactive_data['button_reply']['id'],
-						"message_id": message['id'],
 						"content_type": "flow",
-						"from_name": contacts[0].get("profile", {}).get("name") or message['from'],
-						"timestamp": datetime.fromtimestamp(float(message['timestamp']) + 28800),
-						"is_forwarded": is_forwarded,
 					}).insert(ignore_permissions=True)
 				# Handle list_reply (from interactive list messages)
 				elif interactive_type == 'list_reply':
 					frappe.get_doc({
-						"doctype": "WhatsApp Message",
-						"type": "Incoming",
-						"from": message['from'],
+						**message_base,
 						"message": interactive_data['list_reply']['title'],
 						"interactive_id": interactive_data['list_reply']['id'],
-						"message_id": message['id'],
 						"content_type": "list_reply",
-						"from_name": contacts[0].get("profile", {}).get("name") or message['from'],
-						"timestamp": datetime.fromtimestamp(float(message['timestamp']) + 28800),
-						"is_forwarded": is_forwarded,
 					}).insert(ignore_permissions=True)
-			elif message_type in ["image", "audio", "video", "document", "sticker"]:
-				settings = frappe.get_doc(
-							"WhatsApp Settings", "WhatsApp Settings",
-						)
-				token = settings.get_password("token")
+			elif message_type in MEDIA_MESSAGE_TYPES:
+				settings = get_whatsapp_credentials()
+				token = settings.token
 				url = f"{settings.url}/{settings.version}/"
 
 
@@ -131,7 +123,7 @@ def post(form_dict):
 					'Authorization': 'Bearer ' + token
 
 				}
-				response = requests.get(f'{url}{media_id}/', headers=headers)
+				response = _SESSION.get(f'{url}{media_id}/', headers=headers, timeout=(3.05, 10))
 
 				if response.status_code == 200:
 					media_data = response.json()
@@ -139,7 +131,7 @@ def post(form_dict):
 					mime_type = media_data.get("mime_type")
 					file_extension = mime_type.split('/')[1]
 
-					media_response = requests.get(media_url, headers=headers)
+					media_response = _SESSION.get(media_url, headers=headers, timeout=(3.05, 60))
 					if media_response.status_code == 200:
 
 						file_data = media_response.content
@@ -148,17 +140,11 @@ def post(form_dict):
 						frappe.flags.file_data = file_data
 
 						message_doc = frappe.get_doc({
-							"doctype": "WhatsApp Message",
-							"type": "Incoming",
-							"from": message['from'],
-							"message_id": message['id'],
+							**message_base,
 							"reply_to_message_id": reply_to_message_id,
 							"is_reply": is_reply,
 							"message": message[message_type].get("caption",f"/files/{file_name}"),
 							"content_type" : message_type,
-							"from_name": contacts[0].get("profile", {}).get("name") or message['from'],
-							"timestamp": datetime.fromtimestamp(float(message['timestamp']) + 28800),
-							"is_forwarded": is_forwarded,
 						}).insert(ignore_permissions=True)
 
 						file = frappe.get_doc(
@@ -173,57 +159,36 @@ def post(form_dict):
 						).save(ignore_permissions=True)
 
 
+						# File may reuse an existing file_url for identical content, so attach is set after the File save;
+						# saved through the ORM so on_update handlers and the chat's realtime refresh see the attachment
 						message_doc.attach = file.file_url
-						message_doc.save()
+						message_doc.save(ignore_permissions=True)
 			elif message_type == "button":
 				frappe.get_doc({
-					"doctype": "WhatsApp Message",
-					"type": "Incoming",
-					"from": message['from'],
+					**message_base,
 					"message": message['button']['text'],
-					"message_id": message['id'],
 					"reply_to_message_id": reply_to_message_id,
 					"is_reply": is_reply,
 					"content_type": message_type,
-					"from_name": contacts[0].get("profile", {}).get("name") or message['from'],
-					"timestamp": datetime.fromtimestamp(float(message['timestamp']) + 28800),
-					"is_forwarded": is_forwarded,
 				}).insert(ignore_permissions=True)
 			elif message_type == "location":
 				# Handle location messages - store as JSON with latitude, longitude, name, address
 				location_data = message.get('location', {})
 				frappe.get_doc({
-					"doctype": "WhatsApp Message",
-					"type": "Incoming",
-					"from": message['from'],
-					"message_id": message['id'],
+					**message_base,
 					"reply_to_message_id": reply_to_message_id,
 					"is_reply": is_reply,
 					"message": json.dumps(location_data),
 					"content_type": message_type,
-					"from_name": contacts[0].get("profile", {}).get("name") or message['from'],
-					"timestamp": datetime.fromtimestamp(float(message['timestamp']) + 28800),
-					"is_forwarded": is_forwarded,
 				}).insert(ignore_permissions=True)
 			else:
 				frappe.get_doc({
-					"doctype": "WhatsApp Message",
-					"type": "Incoming",
-					"from": message['from'],
-					"message_id": message['id'],
+					**message_base,
 					"message": message[message_type].get(message_type),
 					"content_type" : message_type,
-					"from_name": contacts[0].get("profile", {}).get("name") or message['from'],
-					"timestamp": datetime.fromtimestamp(float(message['timestamp']) + 28800),
-					"is_forwarded": is_forwarded,
 				}).insert(ignore_permissions=True)
 
 	else:
-		changes = None
-		try:
-			changes = data["entry"][0]["changes"][0]
-		except KeyError:
-			changes = data["entry"]["changes"][0]
 		update_status(changes)
 	return
 
@@ -253,8 +218,8 @@ def update_message_status(data):
 	error_code = data['statuses'][0].get('errors', [{}])[0].get('code')
 
 	if name:
-		doc = frappe.get_doc("WhatsApp Message", name)
 		if status == "failed":
+			doc = frappe.get_doc("WhatsApp Message", name)
 			if not doc.get("whatsapp_message_templates") and doc.message_type != "Template" and str(error_code) == "131047" and doc.message != CHAT_CLOSING_MESSAGE:
 				fields_to_copy = [
 					"label", "type", "to", "from", "from_name", "timestamp",
@@ -279,19 +244,24 @@ def update_message_status(data):
 				},
 			)
 		else:
+			# saved through the ORM so WhatsApp Notification save hooks and the chat's live status ticks still fire
+			doc = frappe.get_doc("WhatsApp Message", name)
 			doc.status = status
 			if conversation:
 				doc.conversation_id = conversation
 			doc.save(ignore_permissions=True)
 
-		whatsapp_api_settings = frappe.get_single("WhatsApp API Settings")
-		if whatsapp_api_settings.current_callback_webhook:
-			current_callback_webhook = frappe.get_doc("WhatsApp Message Callback Webhook", whatsapp_api_settings.current_callback_webhook)
-			headers = {"Content-Type": "application/json"}  # Set headers if needed
-			try:
-				response = requests.post(current_callback_webhook.url, json=data, headers=headers, timeout=3)
-				response.raise_for_status()  # Raise an error for HTTP errors (4xx, 5xx)
-			except requests.Timeout:
-				pass
-			except requests.RequestException as e:
-				pass
\ No newline at end of file
+		current_callback_webhook = frappe.get_cached_value("WhatsApp API Settings", "WhatsApp API Settings", "current_callback_webhook")
+		if current_callback_webhook:
+			url = frappe.get_cached_value("WhatsApp Message Callback Webhook", current_callback_webhook, "url")
+			# delivered from the short queue so a slow customer endpoint does not hold up status processing
+			enqueue(deliver_status_callback, url=url, data=data, queue="short", enqueue_after_commit=True)
+
+
+def deliver_status_callback(url, data):
+	"""Forward a status event to the configured callback webhook."""
+	try:
+		response = _SESSION.post(url, json=data, headers={"Content-Type": "application/json"}, timeout=3)
+		response.raise_for_status()  # Raise an error for HTTP errors (4xx, 5xx)
+	except requests.RequestException:
+		pass
\ No newline at end of file
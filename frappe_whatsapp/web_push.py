@@ -1,4 +1,5 @@
 import frappe
+from frappe_whatsapp.frappe_whatsapp.doctype.push_notification_log.push_notification_log import create_push_notifications
 
 @frappe.whitelist()
 def subscribe_push_notification():
@@ -20,11 +21,4 @@ def subscribe_push_notification():
         push_notification_subscription_doc.insert(ignore_permissions=True)
 
 def send_push_notification(user, title, message, url=None):
-    push_notification_subscriptions = frappe.db.get_all("Push Notification Subscription", filters={"user": user}, pluck="name")
-    for push_notification_subscription in push_notification_subscriptions:
-        push_notification = frappe.new_doc("Push Notification Log")
-        push_notification.push_notification_subscription = push_notification_subscription
-        push_notification.title = title
-        push_notification.message = message
-        push_notification.url = url
-        push_notification.insert(ignore_permissions=True)
+    create_push_notifications(user, title, message, url)